@@ -20,8 +20,24 @@ from sharkpylib.gismo.exceptions import *
 import core
 import gui as main_gui
 from plugins.SHARKtools_qc_sensors import gui
+from plugins.SHARKtools_qc_sensors.engine import BatchLoader
+from plugins.SHARKtools_qc_sensors.engine import configure_tracing
+from plugins.SHARKtools_qc_sensors.engine import FileCatalog
+from plugins.SHARKtools_qc_sensors.engine import forget_file
+from plugins.SHARKtools_qc_sensors.engine import forget_load_job
+from plugins.SHARKtools_qc_sensors.engine import get_instrumentation
+from plugins.SHARKtools_qc_sensors.engine import get_tracer
+from plugins.SHARKtools_qc_sensors.engine import index_loaded_file
+from plugins.SHARKtools_qc_sensors.engine import instrumented
+from plugins.SHARKtools_qc_sensors.engine import MatchCache
+from plugins.SHARKtools_qc_sensors.engine import ParallelQCRunner
+from plugins.SHARKtools_qc_sensors.engine import ParsedFileCache
+from plugins.SHARKtools_qc_sensors.engine import TaskCancelled
+from plugins.SHARKtools_qc_sensors.engine import TaskExecutor
 from plugins.plugin_app import PluginApp
 
+tracer = get_tracer(__name__)
+
 ALL_PAGES = dict()
 ALL_PAGES['PageStart'] = gui.PageStart
 ALL_PAGES['PageTimeSeries'] = gui.PageTimeSeries
@@ -87,13 +103,49 @@ class App(PluginApp):
         self.user_manager = self.main_app.user_manager
         self.user = self.main_app.user
 
-        self.session = spl.gismo.GISMOsession(root_directory=self.root_directory,
-                                                users_directory=self.users_directory,
-                                                log_directory=self.log_directory,
-                                                user=self.user.name,
-                                                sampling_types_factory=self.sampling_types_factory,
-                                                qc_routines_factory=self.qc_routines_factory,
-                                                save_pkl=False)
+        # Debug events from the gui modules. Off unless trace_level is set (or the QC_SENSORS_TRACE variable).
+        configure_tracing(level=self.user.process.setdefault('trace_level', 'OFF'),
+                          file_path=os.path.join(self.log_directory, 'trace.log'))
+
+        # Also used to create the sessions in the worker processes of the batch loader
+        self.session_kwargs = dict(root_directory=self.root_directory,
+                                   users_directory=self.users_directory,
+                                   log_directory=self.log_directory,
+                                   user=self.user.name)
+
+        self.session = spl.gismo.GISMOsession(sampling_types_factory=self.sampling_types_factory,
+                                              qc_routines_factory=self.qc_routines_factory,
+                                              save_pkl=False,
+                                              **self.session_kwargs)
+
+        # Cache of parsed data files. Reloading a file that has not changed is then a memory-map instead of a parse.
+        self.file_cache = ParsedFileCache(os.path.join(self.plugin_directory, 'cache', 'files'),
+                                          max_size_mb=self.user.process.setdefault('file_cache_max_size_mb', 2000))
+
+        # Metadata (station, time, position etc.) of the loaded files. Updated when files are loaded.
+        self.file_catalog = FileCatalog()
+
+        # Keeps track of the matching of main and reference file in the compare workflow
+        self.match_cache = MatchCache()
+
+        # Heavy operations (loading, qc, matching, saving) are run in worker threads. Callbacks are called in the
+        # UI thread.
+        self.task_executor = TaskExecutor(nr_workers=self.user.process.setdefault('task_nr_workers', 2))
+        # Widgets that change the session. Disabled while a task is working on the session.
+        self._session_widgets = []
+        self._session_disabled_widgets = []
+        self.task_executor.busy_callbacks.append(self._on_busy_changed)
+        self.task_executor.attach(self)
+
+        # Coalesces redraws of maps and plots to at most one per view and Tk idle
+        self.redraw_scheduler = gui.RedrawScheduler(self, is_locked=self.is_session_locked)
+
+        # Timing of the communicate functions and page callbacks. Shown on the start page.
+        self.instrumentation = get_instrumentation()
+        self.instrumentation.set_options(enabled=self.user.process.setdefault('instrumentation', True),
+                                         profile=self.user.process.setdefault('instrumentation_profile', False),
+                                         trace_memory=self.user.process.setdefault('instrumentation_trace_memory',
+                                                                                   False))
 
         self.default_platform_settings = None
 
@@ -174,22 +226,145 @@ class App(PluginApp):
 
         # self.info_widget = tkw.LabelFrameLabel(self.frame_info, pack=False)
 
+        # Shown while a task is working on the session
+        self.frame_session_lock = tk.Frame(self.frame_info)
+        self.frame_session_lock.grid(row=0, column=0, sticky='w')
+        self.label_session_lock = tk.Label(self.frame_session_lock)
+        self.label_session_lock.grid(row=0, column=0, sticky='w', padx=5)
+        tk.Button(self.frame_session_lock, text='Cancel',
+                  command=lambda: self.task_executor.cancel(group='session')).grid(row=0, column=1, sticky='w')
+        self.frame_session_lock.grid_remove()
+
         tkw.grid_configure(self.frame_info)
 
         tkw.grid_configure(self.frame_bot)
 
+    def run_task(self, name, function, *args, group='session', **kwargs):
+        """
+        Runs function in a worker thread. See engine.tasks.TaskExecutor.submit for arguments.
+        Tasks working on the session are run one at a time (group="session").
+        :param name:
+        :param function:
+        :return: engine.tasks.Task
+        """
+        return self.task_executor.submit(name, function, *args, group=group, **kwargs)
+
+    def is_busy(self, name=None):
+        return self.task_executor.is_busy(name=name)
+
+    def cancel_tasks(self, name=None):
+        return self.task_executor.cancel(name=name)
+
+    def _on_busy_changed(self, busy):
+        try:
+            self.configure(cursor='watch' if busy else '')
+        except tk.TclError:
+            pass
+        self._update_session_lock()
+
+    def is_session_locked(self):
+        """
+        GISMOsession is not thread safe. The session is locked while a task in the "session" group is queued or
+        running. Widgets should not read or change the session while it is locked.
+        :return: bool
+        """
+        return self.task_executor.is_busy(group='session')
+
+    def add_session_widget(self, widget):
+        """
+        Adds a widget (e.g. a button) that changes the session. The widget is disabled while the session is locked.
+        :param widget: tk widget with option state
+        :return:
+        """
+        self._session_widgets.append(widget)
+
+    def check_session_lock(self, title):
+        """
+        Call first in callbacks that use the session and that are not disabled while it is locked (e.g. flagging
+        in a plot). Tells the user to wait if the session is locked.
+        :param title:
+        :return: True if the session is locked
+        """
+        tasks = self.task_executor.get_active_tasks(group='session')
+        if not tasks:
+            return False
+        names = ', '.join(sorted({task.name for task in tasks}))
+        main_gui.show_information(title, f'Please wait until "{names}" is finished!')
+        return True
+
+    def _update_session_lock(self):
+        """
+        Disables the widgets that change the session while it is locked and shows the running tasks. The rest of the
+        GUI is still usable. Redraws and hover updates check is_session_locked themselves.
+        """
+        tasks = self.task_executor.get_active_tasks(group='session')
+        if not tasks:
+            if not self.frame_session_lock.winfo_ismapped() and not self._session_disabled_widgets:
+                return
+            # Only widgets disabled here are enabled. Others might have been disabled for another reason.
+            for widget in self._session_disabled_widgets:
+                try:
+                    widget.configure(state='normal')
+                except tk.TclError:
+                    # Widget destroyed
+                    pass
+            self._session_disabled_widgets = []
+            self.frame_session_lock.grid_remove()
+            self.redraw_scheduler.resume()
+            return
+        self.label_session_lock.configure(text=', '.join(f'{task.name}...' for task in tasks))
+        self.frame_session_lock.grid()
+        for widget in self._session_widgets:
+            if widget in self._session_disabled_widgets:
+                continue
+            try:
+                if str(widget.cget('state')) == 'disabled':
+                    continue
+                widget.configure(state='disabled')
+            except tk.TclError:
+                continue
+            self._session_disabled_widgets.append(widget)
+
+    def run_qc(self, file_id_list, routine_options, on_done=None, on_error=None):
+        """
+        Runs automatic qc in a worker thread with the files split across a process pool.
+        :param file_id_list:
+        :param routine_options: list of (qc_routine, options)
+        :param on_done: called with a engine.qc_runner.QCReport
+        :param on_error:
+        :return: engine.tasks.Task
+        """
+        runner = ParallelQCRunner(self.session,
+                                  session_kwargs=self.session_kwargs,
+                                  nr_processes=self.user.process.setdefault('qc_nr_processes', os.cpu_count() or 1))
+
+        def run(task):
+            return runner.run(file_id_list, routine_options,
+                              cancel_token=task.cancel_token,
+                              progress_callback=task.report_progress)
+
+        return self.run_task('Run QC', instrumented('app.App.run_qc (task)')(run),
+                             pass_task=True,
+                             on_progress=self._on_qc_progress,
+                             on_done=on_done,
+                             on_error=on_error)
+
+    def _on_qc_progress(self, nr_done, nr_files, file_id):
+        self.main_app.update_help_information(f'Running automatic qc...{nr_done} of {nr_files} files done')
+
     def run_progress(self, run_function, message=''):
 
         def run_thread():
             self.progress_widget.run_progress(run_function, message=message)
 
+        def on_finished(*args):
+            self.progress_running = False
+
         if self.progress_running:
             main_gui.show_information('Progress is running', 'A progress is running, please wait until it is finished!')
             return
         self.progress_running = True
-        # run_thread = lambda: self.progress_widget.run_progress(run_function, message=message)
-        threading.Thread(target=run_thread).start()
-        self.progress_running = False
+        self.run_task(message or 'Progress', run_thread, group=None, on_done=on_finished, on_error=on_finished)
 
     def run_progress_in_toplevel(self, run_function, message=''):
         """
@@ -199,20 +374,21 @@ class App(PluginApp):
         :return:
         """
         def run_thread():
-            self.frame_toplevel_progress = tk.Toplevel(self)
-            self.progress_widget_toplevel = tkw.ProgressbarWidget(self.frame_toplevel_progress, sticky='nsew', in_rows=True)
-            self.frame_toplevel_progress.update_idletasks()
-            self.progress_widget_toplevel.update_idletasks()
-            self.progress_widget.run_progress(run_function, message=message)
-            self.frame_toplevel_progress.destroy()
+            try:
+                self.frame_toplevel_progress = tk.Toplevel(self)
+                self.progress_widget_toplevel = tkw.ProgressbarWidget(self.frame_toplevel_progress, sticky='nsew', in_rows=True)
+                self.frame_toplevel_progress.update_idletasks()
+                self.progress_widget_toplevel.update_idletasks()
+                self.progress_widget.run_progress(run_function, message=message)
+                self.frame_toplevel_progress.destroy()
+            finally:
+                self.progress_running_toplevel = False
 
         if self.progress_running_toplevel:
             self.main_app.show_information('Progress is running', 'A progress is running, please wait until it is finished!')
             return
-        self.progress_running = True
-        # run_thread = lambda: self.progress_widget.run_progress(run_function, message=message)
+        self.progress_running_toplevel = True
         threading.Thread(target=run_thread).start()
-        self.progress_running = False
 
     #===========================================================================
     def startup_pages(self):
@@ -224,7 +400,7 @@ class App(PluginApp):
             # Destroy old page if called as an update
             try:
                 self.frames[page_name].destroy()
-                print(Page, u'Destroyed')
+                tracer.debug('page_destroyed', page=page_name)
             except:
                 pass
             frame = Page(self.container, self)
@@ -337,6 +513,7 @@ class App(PluginApp):
         # Load file button
         self.button_load_file = tk.Button(frame_load, text='Load file', command=self._load_file, bg='lightgreen', font=(30))
         self.button_load_file.grid(row=0, column=0, padx=padx, pady=pady, sticky='nsew')
+        self.add_session_widget(self.button_load_file)
         self.button_load_file.configure(state='disabled')
         tkw.grid_configure(frame_load)
 
@@ -362,8 +539,14 @@ class App(PluginApp):
         tkw.grid_configure(frame)
 
     def _delete_source(self, file_id, *args, **kwargs):
+        if self.check_session_lock('Remove source'):
+            return
         file_id = file_id.split(':')[-1].strip()
         self.session.remove_file(file_id)
+        forget_file(file_id)
+        forget_load_job(file_id)
+        self.match_cache.invalidate(file_id)
+        self.file_catalog.remove(file_id)
         self.update_all()
 
     def _get_data_file_paths(self, sampling_type):
@@ -478,27 +661,14 @@ class App(PluginApp):
             string = 'open_directory'
         self.user.path.set(string, directory)
 
+    @instrumented()
     def _load_file(self):
 
-        def load_file(data_file_path, **kwargs):
-            self.main_app.update_help_information('')
-            self.button_load_file.configure(state='disabled')
-
-            settings_file = self.combobox_widget_settings_file.get_value()
-            sampling_type = self.combobox_widget_sampling_type.get_value()
-
-            self.session.load_file(sampling_type=sampling_type,
-                                   data_file_path=data_file_path,
-                                   settings_file=settings_file,
-                                   # settings_file_path=settings_file_path,
-                                   reload=False,
-                                   root_directory=self.root_directory,
-                                   **kwargs)
-
         # self.reset_help_information()
         data_file_path = self.stringvar_data_file.get()
         settings_file = self.combobox_widget_settings_file.get_value()
         settings_file_path = self.settings_files.get_path(settings_file)
+        sampling_type = self.combobox_widget_sampling_type.get_value()
 
         # sampling_type = self.combobox_widget_sampling_type.get_value()
         
@@ -520,48 +690,115 @@ class App(PluginApp):
         else:
             data_file_list = [data_file_path]
 
-        for file_path in data_file_list:
-            # Load file
-            try:
-                load_file(file_path)
-                # self.run_progress(load_file, message='Loading file...please wait...')
-            except GISMOExceptionMissingPath as e:
-                self.logger.debug(e)
-                main_gui.show_information('Invalid path',
-                                          'The path "{}" given in i settings file "{} can not be found'.format(e.message,
-                                                                                                          settings_file_path))
-                self.main_app.update_help_information('Please try again with a different settings file.')
-
-            except GISMOExceptionMissingInputArgument as e:
-                self.logger.debug(e)
-                if 'depth' in e.message:
-                    platform_depth = self.entry_widget_platform_depth.get_value()
-                    if not platform_depth:
-                        main_gui.show_information('No depth found!',
-                                                  'You need to provide platform depth for this sampling type!')
-                        return
-                    load_file(file_path, depth=platform_depth)
-            except GISMOExceptionInvalidParameter as e:
-                self.logger.debug(e)
-                main_gui.show_information('Invalid parameter',
-                                          f'Could not find parameter {e}. Settings file might have wrong information.')
-                return
-            except GISMOExceptionQCfieldError:
-                main_gui.show_error('QC field error',
-                                     f'Something is wrong with the qf columns in file: {file_path}')
-                return
-            except Exception as e:
-                self.logger.debug(e)
-                main_gui.show_internal_error(e)
-                return
+        if self.check_session_lock('Load files'):
+            return
+
+        self.main_app.update_help_information('')
+        self.button_load_file.configure(state='disabled')
+
+        # Platform depth is only used if the sampling type asks for it
+        platform_depth = self.entry_widget_platform_depth.get_value() or None
+
+        file_cache = None
+        if self.user.process.setdefault('use_file_cache', True):
+            file_cache = self.file_cache
+            file_cache.max_size_mb = self.user.process.setdefault('file_cache_max_size_mb', 2000)
+        loader = BatchLoader(self.session,
+                             session_kwargs=self.session_kwargs,
+                             nr_processes=self.user.process.setdefault('load_nr_processes', os.cpu_count() or 1),
+                             cache=file_cache)
+
+        index_files = self.user.process.setdefault('save_incremental', False)
+
+        def load(task):
+            report = loader.load(data_file_list,
+                                 sampling_type=sampling_type,
+                                 settings_file=settings_file,
+                                 settings_file_path=settings_file_path,
+                                 root_directory=self.root_directory,
+                                 depth=platform_depth,
+                                 progress_callback=task.report_progress)
+            if index_files:
+                # Row offsets of the original files used by incremental save
+                for file_id in report.loaded:
+                    index_loaded_file(self.session, file_id)
+            return report
+
+        self.run_task('Load files', instrumented('app.App._load_file (task)')(load),
+                      pass_task=True,
+                      on_progress=self._on_load_progress,
+                      on_done=lambda report: self._on_load_done(report, data_file_list),
+                      on_error=self._on_load_error)
+
+    def _on_load_done(self, report, data_file_list):
+        for file_path, (category, message) in report.errors.items():
+            self.logger.debug(f'Could not load file {file_path} ({category}): {message}')
 
         self.stringvar_data_file.set('')
 
+        self.file_catalog.update(self.session)
         self._update_loaded_files_widget()
         self.update_all()
         self.button_load_file.configure(state='normal')
 
-        self.main_app.update_help_information('File loaded! Please continue.', bg='green')
+        if not report.nr_errors:
+            self.main_app.update_help_information('File loaded! Please continue.', bg='green')
+            return
+
+        if report.nr_loaded:
+            self.main_app.update_help_information(f'{report.nr_loaded} of {len(data_file_list)} files loaded!',
+                                                  bg='yellow')
+        else:
+            self.main_app.update_help_information('No files loaded!', fg='red')
+        main_gui.show_warning('Load files', report.get_summary())
+
+    def _on_load_error(self, exception):
+        self.button_load_file.configure(state='normal')
+        # Files loaded before the error or cancellation are kept
+        self.file_catalog.update(self.session)
+        self._update_loaded_files_widget()
+        self.update_all()
+        if isinstance(exception, TaskCancelled):
+            self.main_app.update_help_information('Loading cancelled!', bg='yellow')
+            return
+        self.main_app.update_help_information('No files loaded!', fg='red')
+        main_gui.show_error('Load files', f'Could not load files:\n{exception}')
+
+    def _on_load_progress(self, nr_done, nr_files, file_path):
+        self.main_app.update_help_information(f'Loading files...{nr_done} of {nr_files} done '
+                                              f'({os.path.basename(file_path)})')
+
+    def clear_file_cache(self):
+        """
+        Removes all parsed files from the file cache.
+        :return: (number of removed files, number of removed bytes)
+        """
+        nr_removed, removed_size = self.file_cache.clear()
+        self.logger.info(f'{nr_removed} files ({removed_size} bytes) removed from file cache')
+        return nr_removed, removed_size
+
+    def set_instrumentation_options(self, profile=None, trace_memory=None):
+        """
+        Turns cProfile and tracemalloc capture of the instrumented functions on or off. Saved in the user settings.
+        :param profile:
+        :param trace_memory:
+        :return:
+        """
+        if profile is not None:
+            self.user.process.set('instrumentation_profile', profile)
+        if trace_memory is not None:
+            self.user.process.set('instrumentation_trace_memory', trace_memory)
+        self.instrumentation.set_options(profile=profile, trace_memory=trace_memory)
+
+    def dump_timing(self):
+        """
+        Writes the timing of the instrumented functions to the log directory. The redraw counters are logged.
+        :return: path to the written summary
+        """
+        counters = self.redraw_scheduler.get_counters()
+        self.logger.info(f'Redraws: {counters["requests"]} requested, {counters["renders"]} rendered, '
+                         f'{counters["saved"]} saved by coalescing')
+        return self.instrumentation.dump(self.log_directory)
 
     def _update_loaded_files_widget(self):
         loaded_files = [] 
@@ -638,7 +875,7 @@ class App(PluginApp):
         
         for page_name, frame in self.frames.items():
             if self.pages_started.get(page_name):
-                print('page_name', page_name)
+                tracer.debug('update_page', page=page_name)
                 frame.update_page()
 
     #===========================================================================
@@ -761,7 +998,8 @@ class App(PluginApp):
                 self.settings.settings_are_modified = False
             else:
                 return
-        
+
+        self.task_executor.shutdown()
         self.destroy()  # Closes window
         self.quit()     # Terminates program
         
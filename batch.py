@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+Loads files, runs automatic qc and saves the result without the GUI. Run from the SHARKtools root directory:
+
+    python -m plugins.SHARKtools_qc_sensors.batch --sampling-type "Ferrybox CMEMS" --settings-file <name> \
+        --files "incoming/ferrybox/*.txt" --qc-routine <routine> --output-directory qc_done --report report.json
+
+The session is created the same way as in App.startup. Options of the qc routines are read from
+qc_routine_options.json of the user (or the file given with --qc-options).
+The exit code is 0 if all files were loaded, checked and saved, 1 if any file failed and 2 if the run was stopped.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import platform
+
+from sharkpylib.file.file_handlers import SamplingTypeSettingsDirectory
+
+from plugins.SHARKtools_qc_sensors.engine import BatchLoader
+from plugins.SHARKtools_qc_sensors.engine import create_session
+from plugins.SHARKtools_qc_sensors.engine import FileSaver
+from plugins.SHARKtools_qc_sensors.engine import index_loaded_file
+from plugins.SHARKtools_qc_sensors.engine import ParallelQCRunner
+from plugins.SHARKtools_qc_sensors.engine import ParsedFileCache
+
+logger = logging.getLogger(__name__)
+
+REPORT_FORMAT_VERSION = 1
+
+PLUGIN_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_STOPPED = 'stopped'
+
+EXIT_CODES = {STATUS_OK: 0,
+              STATUS_FAILED: 1,
+              STATUS_STOPPED: 2}
+
+
+def get_file_paths(patterns):
+    """
+    Returns the files matching the given glob patterns. ** matches any number of directories.
+    :param patterns: list of glob patterns (or file paths)
+    :return: sorted list of unique file paths
+    """
+    file_paths = set()
+    for pattern in patterns:
+        for file_path in glob.glob(os.path.expanduser(pattern), recursive=True):
+            if os.path.isfile(file_path):
+                file_paths.add(os.path.abspath(file_path))
+    return sorted(file_paths)
+
+
+def get_default_routine_options(session, qc_routine, user=None):
+    """
+    Returns the default options of qc_routine given by session.get_qc_routine_options. Same defaults as the qc
+    routine options in the GUI: options given as a type or as a tuple of choices have no default.
+    :param session: GISMOsession
+    :param qc_routine:
+    :param user: used for the "user" option
+    :return: dict
+    """
+    defaults = {}
+    for key, value in session.get_qc_routine_options(qc_routine).items():
+        if key.lower() == 'user':
+            if user:
+                defaults[key] = user
+        elif type(value) == list:
+            defaults[key] = list(value)
+        elif type(value) in (str, float, int):
+            defaults[key] = value
+    return defaults
+
+
+def get_routine_options(qc_routines, qc_options_file_path=None, session=None, user=None):
+    """
+    Returns the qc routines with their options as given to ParallelQCRunner.run.
+    :param qc_routines: list of qc routine names in the order they should be run
+    :param qc_options_file_path: qc_routine_options.json. Has the qc routine as key and a dict with options as value.
+    :param session: If given, options missing in the file are taken from the session defaults.
+                    See get_default_routine_options.
+    :param user: see get_default_routine_options
+    :return: list of (qc_routine, options)
+    """
+    all_options = {}
+    if qc_options_file_path:
+        with open(qc_options_file_path) as fid:
+            all_options = json.load(fid)
+    routine_options = []
+    for qc_routine in qc_routines:
+        options = get_default_routine_options(session, qc_routine, user=user) if session else {}
+        options.update(all_options.get(qc_routine, {}))
+        routine_options.append((qc_routine, options))
+    return routine_options
+
+
+class BatchRunReport(object):
+    """
+    Machine readable result of a batch run. One entry per data file.
+    """
+    def __init__(self, arguments=None):
+        self.arguments = arguments or {}
+        self.time_started = time.time()
+        self.files = {}
+        self.qc_routines = []
+        self.qc_errors = []
+        self.timing = {}
+        self.stopped = False
+
+    def add_file(self, file_path):
+        self.files[file_path] = dict(file_id=None,
+                                     loaded=False,
+                                     load_error=None,
+                                     qc_failures=[],
+                                     saved_file_path=None,
+                                     saved_incremental=False,
+                                     save_error=None)
+
+    def get_file_by_id(self, file_id):
+        for item in self.files.values():
+            if item['file_id'] == file_id:
+                return item
+        return None
+
+    @property
+    def status(self):
+        if self.stopped:
+            return STATUS_STOPPED
+        for item in self.files.values():
+            if not item['saved_file_path'] or item['load_error'] or item['qc_failures'] or item['save_error']:
+                return STATUS_FAILED
+        return STATUS_OK
+
+    def to_dict(self):
+        return dict(format_version=REPORT_FORMAT_VERSION,
+                    status=self.status,
+                    time_started=time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.time_started)),
+                    duration=time.time() - self.time_started,
+                    python=platform.python_version(),
+                    arguments=self.arguments,
+                    qc_routines=self.qc_routines,
+                    qc_errors=self.qc_errors,
+                    timing=self.timing,
+                    nr_files=len(self.files),
+                    nr_saved=len([item for item in self.files.values() if item['saved_file_path']]),
+                    files=self.files)
+
+
+class BatchRun(object):
+    """
+    Load -> automatic qc -> save for a list of files of one sampling type. Each step is run in parallel with the
+    same classes as the GUI (BatchLoader, ParallelQCRunner and FileSaver). A file that fails in one step is
+    reported and left out of the following steps.
+    """
+    def __init__(self, session_kwargs, nr_load_processes=None, nr_qc_processes=None, nr_save_workers=4,
+                 file_cache_directory=None):
+        """
+        :param session_kwargs: passed to create_session (root_directory, users_directory, log_directory, user)
+        :param nr_load_processes:
+        :param nr_qc_processes:
+        :param nr_save_workers:
+        :param file_cache_directory: Parsed files are cached here if given. See ParsedFileCache.
+        """
+        self.session_kwargs = session_kwargs
+        self.session = create_session(**session_kwargs)
+        self.nr_load_processes = nr_load_processes
+        self.nr_qc_processes = nr_qc_processes
+        self.nr_save_workers = nr_save_workers
+        self.file_cache = ParsedFileCache(file_cache_directory) if file_cache_directory else None
+
+    def run(self, file_paths, sampling_type, settings_file, output_directory, routine_options=None,
+            depth=None, overwrite=False, fsync=False, incremental=False, report=None):
+        """
+        :param file_paths: data files
+        :param sampling_type:
+        :param settings_file: name of a file in the sampling type settings directory or a path to a settings file
+        :param output_directory: the checked files are saved here with their original names
+        :param routine_options: list of (qc_routine, options). No qc is run if empty.
+        :param depth: platform depth for sampling types that need it
+        :param overwrite: Replace existing files in output_directory
+        :param fsync: Flush each file to disk when saved
+        :param incremental: Only rewrite the changed flags when possible
+        :param report: BatchRunReport to add the result to
+        :return: BatchRunReport
+        """
+        report = report or BatchRunReport()
+        for file_path in file_paths:
+            report.add_file(file_path)
+        file_ids = self._load(report, file_paths, sampling_type, settings_file, depth, incremental)
+        if routine_options and file_ids:
+            file_ids = self._run_qc(report, file_ids, routine_options)
+        if file_ids and not report.stopped:
+            self._save(report, file_ids, output_directory, overwrite, fsync, incremental)
+        return report
+
+    def _load(self, report, file_paths, sampling_type, settings_file, depth, incremental):
+        if os.path.isfile(settings_file):
+            settings_file_path = settings_file
+        else:
+            settings_file_path = SamplingTypeSettingsDirectory().get_path(settings_file)
+        loader = BatchLoader(self.session,
+                             session_kwargs=self.session_kwargs,
+                             nr_processes=self.nr_load_processes,
+                             cache=self.file_cache)
+        t0 = time.time()
+        load_report = loader.load(file_paths,
+                                  sampling_type=sampling_type,
+                                  settings_file=settings_file,
+                                  settings_file_path=settings_file_path,
+                                  root_directory=self.session_kwargs.get('root_directory'),
+                                  depth=depth,
+                                  progress_callback=self._on_progress('Loaded'))
+        report.timing['load'] = time.time() - t0
+
+        for file_path, (category, message) in load_report.errors.items():
+            report.files[file_path]['load_error'] = dict(category=category, message=message)
+            logger.error(f'Could not load {file_path}: {message}')
+
+        file_ids = []
+        for file_id in load_report.loaded:
+            if not file_id:
+                continue
+            item = report.files.get(os.path.abspath(self.session.get_file_path(file_id)))
+            if item is not None:
+                item['file_id'] = file_id
+                item['loaded'] = True
+            if incremental:
+                index_loaded_file(self.session, file_id)
+            file_ids.append(file_id)
+        logger.info(f'{len(file_ids)} of {len(file_paths)} files loaded in {report.timing["load"]:.1f} s')
+        return file_ids
+
+    def _run_qc(self, report, file_ids, routine_options):
+        runner = ParallelQCRunner(self.session,
+                                  session_kwargs=self.session_kwargs,
+                                  nr_processes=self.nr_qc_processes)
+        t0 = time.time()
+        qc_report = runner.run(file_ids, routine_options, progress_callback=self._on_qc_progress)
+        report.timing['qc'] = time.time() - t0
+        report.timing['qc_routines'] = dict(qc_report.timing)
+        report.qc_routines = list(qc_report.qc_routines)
+
+        for qc_routine, e, tb in qc_report.errors:
+            report.qc_errors.append(dict(qc_routine=qc_routine,
+                                         error=f'{e.__class__.__name__}: {e}',
+                                         traceback=tb))
+            logger.error(f'QC routine {qc_routine} failed: {e}')
+        if qc_report.stopped:
+            report.stopped = True
+            return []
+
+        failed_file_ids = set()
+        for qc_routine, file_id, message in qc_report.failures:
+            item = report.get_file_by_id(file_id)
+            if item is not None:
+                item['qc_failures'].append(dict(qc_routine=qc_routine, message=message))
+            failed_file_ids.add(file_id)
+            logger.error(f'QC routine {qc_routine} failed for {file_id}: {message}')
+        logger.info(f'QC done for {len(file_ids)} files in {report.timing["qc"]:.1f} s')
+        # Files that failed a routine are not saved since they are only partly checked
+        return [file_id for file_id in file_ids if file_id not in failed_file_ids]
+
+    def _save(self, report, file_ids, output_directory, overwrite, fsync, incremental):
+        os.makedirs(output_directory, exist_ok=True)
+        save_file_paths = {}
+        for file_id in file_ids:
+            save_file_path = os.path.join(output_directory, os.path.basename(self.session.get_file_path(file_id)))
+            save_file_paths.setdefault(os.path.normcase(save_file_path), []).append(file_id)
+
+        file_path_mapping = {}
+        for file_id in file_ids:
+            item = report.get_file_by_id(file_id)
+            save_file_path = os.path.join(output_directory, os.path.basename(self.session.get_file_path(file_id)))
+            same_name = save_file_paths[os.path.normcase(save_file_path)]
+            if len(same_name) > 1:
+                # Files with the same name in different input directories. None of them is saved.
+                others = [self.session.get_file_path(other) for other in same_name if other != file_id]
+                item['save_error'] = f'Same file name as: {", ".join(others)}'
+                logger.error(f'Not saved, {len(same_name)} input files would be saved as: {save_file_path}')
+                continue
+            if os.path.exists(save_file_path) and not overwrite:
+                item['save_error'] = f'File exists: {save_file_path}'
+                logger.error(f'Not saved, file exists: {save_file_path}')
+                continue
+            file_path_mapping[file_id] = save_file_path
+
+        saver = FileSaver(self.session, nr_workers=self.nr_save_workers, fsync=fsync, incremental=incremental)
+        save_report = saver.save(file_path_mapping,
+                                 user=self.session_kwargs.get('user') or 'batch',
+                                 progress_callback=self._on_progress('Saved'))
+        report.timing['save'] = save_report.duration
+
+        for file_id in save_report.saved:
+            item = report.get_file_by_id(file_id)
+            item['saved_file_path'] = file_path_mapping[file_id]
+            item['saved_incremental'] = file_id in save_report.saved_incremental
+        for file_id, message in save_report.errors.items():
+            report.get_file_by_id(file_id)['save_error'] = message
+            logger.error(f'Could not save {file_id}: {message}')
+        logger.info(save_report.get_summary())
+
+    @staticmethod
+    def _on_progress(text):
+        def on_progress(nr_done, nr_files, name):
+            logger.debug(f'{text} {nr_done} of {nr_files}: {os.path.basename(str(name))}')
+        return on_progress
+
+    @staticmethod
+    def _on_qc_progress(nr_done, nr_files, file_id):
+        logger.debug(f'QC of {file_id} done ({nr_done} of {nr_files} files)')
+
+
+def get_argument_parser():
+    root_directory = os.path.dirname(os.path.dirname(PLUGIN_DIRECTORY))
+    parser = argparse.ArgumentParser(description='Load, run automatic qc and save data files without the GUI')
+    parser.add_argument('--sampling-type', required=True, help='e.g. "Ferrybox CMEMS" or "Fixed platforms CMEMS"')
+    parser.add_argument('--settings-file', required=True,
+                        help='Name of a sampling type settings file (or a path to one)')
+    parser.add_argument('--files', required=True, nargs='+', metavar='GLOB',
+                        help='Data files. Glob patterns are expanded, ** matches subdirectories')
+    parser.add_argument('--output-directory', required=True, help='Checked files are saved here')
+    parser.add_argument('--qc-routine', action='append', default=[], dest='qc_routines', metavar='QC_ROUTINE',
+                        help='QC routine to run. Can be given several times, the routines are run in the given order')
+    parser.add_argument('--qc-options', help='qc_routine_options.json with the options of the qc routines. '
+                                             'Default is the file of the user')
+    parser.add_argument('--depth', help='Platform depth for sampling types that need it')
+    parser.add_argument('--root-directory', default=root_directory, help='SHARKtools root directory')
+    parser.add_argument('--users-directory', help='Default is <root-directory>/users')
+    parser.add_argument('--log-directory', help='Default is <root-directory>/log')
+    parser.add_argument('--user', default='default')
+    parser.add_argument('--load-processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--qc-processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--save-workers', type=int, default=4)
+    parser.add_argument('--file-cache', help='Directory for cached parsed files')
+    parser.add_argument('--overwrite', action='store_true', help='Replace existing files in the output directory')
+    parser.add_argument('--fsync', action='store_true', help='Flush each saved file to disk')
+    parser.add_argument('--incremental', action='store_true', help='Only rewrite the changed flags when possible')
+    parser.add_argument('--report', help='Json file the run report is written to. Default is stdout')
+    parser.add_argument('--log-level', default='INFO')
+    return parser
+
+
+def main(argv=None):
+    args = get_argument_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    users_directory = args.users_directory or os.path.join(args.root_directory, 'users')
+    log_directory = args.log_directory or os.path.join(args.root_directory, 'log')
+    os.makedirs(log_directory, exist_ok=True)
+
+    qc_options_file_path = args.qc_options
+    if not qc_options_file_path:
+        user_file_path = os.path.join(users_directory, args.user, 'qc_routine_options.json')
+        if os.path.isfile(user_file_path):
+            qc_options_file_path = user_file_path
+
+    report = BatchRunReport(arguments=dict(vars(args), qc_options=qc_options_file_path))
+    file_paths = get_file_paths(args.files)
+    if not file_paths:
+        logger.error('No files matches the given patterns')
+    else:
+        batch_run = BatchRun(dict(root_directory=args.root_directory,
+                                  users_directory=users_directory,
+                                  log_directory=log_directory,
+                                  user=args.user),
+                             nr_load_processes=args.load_processes,
+                             nr_qc_processes=args.qc_processes,
+                             nr_save_workers=args.save_workers,
+                             file_cache_directory=args.file_cache)
+        batch_run.run(file_paths,
+                      sampling_type=args.sampling_type,
+                      settings_file=args.settings_file,
+                      output_directory=args.output_directory,
+                      routine_options=get_routine_options(args.qc_routines,
+                                                          qc_options_file_path,
+                                                          session=batch_run.session,
+                                                          user=args.user),
+                      depth=args.depth,
+                      overwrite=args.overwrite,
+                      fsync=args.fsync,
+                      incremental=args.incremental,
+                      report=report)
+
+    report_dict = report.to_dict()
+    if not file_paths:
+        report_dict['status'] = STATUS_FAILED
+    if args.report:
+        with open(args.report, 'w') as fid:
+            json.dump(report_dict, fid, indent=4, default=str)
+    else:
+        json.dump(report_dict, sys.stdout, indent=4, default=str)
+        sys.stdout.write('\n')
+    return EXIT_CODES[report_dict['status']]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+Headless benchmarks of the communicate layer. Run from the SHARKtools root directory:
+
+    python -m plugins.SHARKtools_qc_sensors.benchmarks.run --size small --output report.json
+    python -m plugins.SHARKtools_qc_sensors.benchmarks.run --size small --compare report.json
+"""
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# latin-1 maps every byte to one character so the template content is written back unchanged
+ENCODING = 'latin-1'
+CHUNK_SIZE = 50000
+
+EXAMPLE_FILES_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'example_files')
+
+FIXED_PLATFORM_TEMPLATE = 'Asko_33022_201705151000_201711130800_OK.txt'
+CTD_TEMPLATE = 'ctd_profile_SBE09_1044_20181205_1536_34_01_0154.txt'
+SHARKWEB_TEMPLATE = 'sharkweb_data_2016_feb-may.txt'
+
+KIND_FIXED_PLATFORM = 'fixed_platform'
+KIND_CTD = 'ctd'
+KIND_SHARKWEB = 'sharkweb'
+
+# Number of rows/files per dataset size
+SIZES = {'small': dict(fixed_platform_rows=20000, fixed_platform_files=1, ctd_files=20, sharkweb_rows=10000),
+         'medium': dict(fixed_platform_rows=250000, fixed_platform_files=4, ctd_files=200, sharkweb_rows=100000),
+         'large': dict(fixed_platform_rows=2000000, fixed_platform_files=4, ctd_files=2000, sharkweb_rows=1000000)}
+
+
+class TemplateFile(object):
+    """
+    Data file from example_files split in metadata lines (starting with "//"), header and data rows.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file_name = os.path.basename(file_path)
+        with open(file_path, 'rb') as fid:
+            content = fid.read()
+        self.newline = '\r\n' if b'\r\n' in content else '\n'
+        self.metadata = []
+        self.header = None
+        self.rows = []
+        for line in content.decode(ENCODING).splitlines():
+            if self.header is None:
+                if line.startswith('//') or not line.strip():
+                    self.metadata.append(line)
+                    continue
+                self.header = line
+            elif line.strip():
+                self.rows.append(line)
+        self.separator = '\t'
+        for separator in ['\t', ';', ',']:
+            if separator in self.header:
+                self.separator = separator
+                break
+        self.columns = [item.strip() for item in self.header.split(self.separator)]
+
+    def get_column_index(self, column):
+        return self.columns.index(column)
+
+    def get_head(self, metadata=None):
+        """
+        Returns metadata and header as written to file.
+        :param metadata: list of metadata lines to use instead of the ones in the template
+        :return: str
+        """
+        lines = list(self.metadata if metadata is None else metadata) + [self.header]
+        return self.newline.join(lines) + self.newline
+
+
+def _write_file(file_path, head, lines, newline):
+    with open(file_path, 'w', encoding=ENCODING, newline='') as fid:
+        fid.write(head)
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) == CHUNK_SIZE:
+                fid.write(newline.join(chunk) + newline)
+                chunk = []
+        if chunk:
+            fid.write(newline.join(chunk) + newline)
+
+
+def generate_fixed_platform_files(directory, nr_rows, nr_files=1, template_path=None, time_step='1h'):
+    """
+    Writes fixed platform files (Asko format) with nr_rows each. The files follow each other in time.
+    The values of the template are repeated and the time column is continued with time_step.
+    :param directory:
+    :param nr_rows: rows per file
+    :param nr_files:
+    :param template_path:
+    :param time_step: pandas frequency string
+    :return: list of file paths
+    """
+    template = TemplateFile(template_path or os.path.join(EXAMPLE_FILES_DIRECTORY, FIXED_PLATFORM_TEMPLATE))
+    sep = template.separator
+    values = [row.split(sep, 1)[1] for row in template.rows]
+    start = pd.to_datetime(template.rows[0].split(sep, 1)[0], format='%Y%m%d%H%M')
+    step = pd.Timedelta(time_step)
+    name_prefix = '_'.join(template.file_name.split('_')[:2])
+
+    file_paths = []
+    for file_nr in range(nr_files):
+        time_strings = pd.date_range(start + file_nr * nr_rows * step, periods=nr_rows,
+                                     freq=step).strftime('%Y%m%d%H%M')
+        file_name = f'{name_prefix}_{time_strings[0]}_{time_strings[-1]}_OK.txt'
+        file_path = os.path.join(directory, file_name)
+        lines = (f'{time_string}{sep}{values[k % len(values)]}' for k, time_string in enumerate(time_strings))
+        _write_file(file_path, template.get_head(), lines, template.newline)
+        file_paths.append(file_path)
+    logger.info(f'{nr_files} fixed platform file(s) with {nr_rows} rows written to {directory}')
+    return file_paths
+
+
+def generate_ctd_files(directory, nr_files, template_path=None, time_step='6h', position_jitter=0.1, seed=0):
+    """
+    Writes nr_files ctd profiles (ctd_profile_SBE09 format). Each profile is a copy of the template with a new
+    time, serial number and a slightly changed position.
+    :param directory:
+    :param nr_files:
+    :param template_path:
+    :param time_step: pandas frequency string between profiles
+    :param position_jitter: max change of latitude and longitude in degrees
+    :param seed: seed for the position jitter
+    :return: list of file paths
+    """
+    template = TemplateFile(template_path or os.path.join(EXAMPLE_FILES_DIRECTORY, CTD_TEMPLATE))
+    sep = template.separator
+    # ctd_profile_SBE09_1044_20181205_1536_34_01_0154.txt
+    parts = os.path.splitext(template.file_name)[0].split('_')
+    start = pd.to_datetime(parts[4] + parts[5], format='%Y%m%d%H%M')
+    first_serno = int(parts[-1])
+    step = pd.Timedelta(time_step)
+    rng = np.random.default_rng(seed)
+
+    time_columns = {col: template.get_column_index(col) for col in ['YEAR', 'MONTH', 'DAY', 'HOUR', 'MINUTE']}
+    lat_index = template.get_column_index('LATITUDE_DD')
+    lon_index = template.get_column_index('LONGITUDE_DD')
+    rows = [row.split(sep) for row in template.rows]
+
+    file_paths = []
+    for file_nr in range(nr_files):
+        time = start + file_nr * step
+        serno = f'{(first_serno + file_nr) % 10000:04d}'
+        name_parts = parts[2:4] + [time.strftime('%Y%m%d'), time.strftime('%H%M')] + parts[6:-1] + [serno]
+        metadata_values = {'MYEAR': time.strftime('%Y'),
+                           'SDATE': time.strftime('%Y-%m-%d'),
+                           'STIME': time.strftime('%H:%M'),
+                           'SERNO': serno,
+                           'FILE_NAME': '_'.join(name_parts) + '.cnv'}
+        metadata = []
+        for line in template.metadata:
+            split_line = line.split(';')
+            if len(split_line) == 3 and split_line[0] == '//METADATA' and split_line[1] in metadata_values:
+                line = ';'.join(split_line[:2] + [metadata_values[split_line[1]]])
+            metadata.append(line)
+
+        time_values = {'YEAR': time.strftime('%Y'),
+                       'MONTH': time.strftime('%m'),
+                       'DAY': time.strftime('%d'),
+                       'HOUR': time.strftime('%H'),
+                       'MINUTE': time.strftime('%M')}
+        lat_diff, lon_diff = rng.uniform(-position_jitter, position_jitter, 2)
+
+        def get_lines():
+            for row in rows:
+                row = list(row)
+                for col, index in time_columns.items():
+                    row[index] = time_values[col]
+                row[lat_index] = f'{float(row[lat_index]) + lat_diff:.5f}'
+                row[lon_index] = f'{float(row[lon_index]) + lon_diff:.5f}'
+                yield sep.join(row)
+
+        file_path = os.path.join(directory, '_'.join(['ctd', 'profile'] + name_parts) + '.txt')
+        _write_file(file_path, template.get_head(metadata), get_lines(), template.newline)
+        file_paths.append(file_path)
+    logger.info(f'{nr_files} ctd files written to {directory}')
+    return file_paths
+
+
+def generate_sharkweb_file(directory, nr_rows, template_path=None):
+    """
+    Writes one sharkweb file with nr_rows. The rows of the template are repeated and each repetition is moved
+    one day forward so that all visits are unique.
+    :param directory:
+    :param nr_rows:
+    :param template_path:
+    :return: list with the file path
+    """
+    template = TemplateFile(template_path or os.path.join(EXAMPLE_FILES_DIRECTORY, SHARKWEB_TEMPLATE))
+    sep = template.separator
+    date_index = template.get_column_index('Sampling date')
+    sample_id_index = template.get_column_index('Shark sample id')
+    rows = [row.split(sep) for row in template.rows]
+    dates = pd.to_datetime([row[date_index] for row in rows], format='%Y-%m-%d')
+
+    def get_lines():
+        for k in range(nr_rows):
+            repetition, row_nr = divmod(k, len(rows))
+            row = rows[row_nr]
+            if repetition:
+                row = list(row)
+                row[date_index] = (dates[row_nr] + pd.Timedelta(days=repetition)).strftime('%Y-%m-%d')
+                row[sample_id_index] = f'{row[sample_id_index]}+{repetition}'
+            yield sep.join(row)
+
+    file_path = os.path.join(directory, f'sharkweb_data_benchmark_{nr_rows}.txt')
+    _write_file(file_path, template.get_head(), get_lines(), template.newline)
+    logger.info(f'Sharkweb file with {nr_rows} rows written to {directory}')
+    return [file_path]
+
+
+def generate_dataset(directory, size='small', **kwargs):
+    """
+    Writes all benchmark files for the given size. Files are only written once per directory and size.
+    :param directory:
+    :param size: key in SIZES
+    :param kwargs: overrides the number of rows/files in SIZES
+    :return: dict with lists of file paths: {KIND_FIXED_PLATFORM: [...], KIND_CTD: [...], KIND_SHARKWEB: [...]}
+    """
+    nr = dict(SIZES[size])
+    nr.update({key: value for key, value in kwargs.items() if value is not None})
+    name = '_'.join([size] + [str(nr[key]) for key in sorted(nr)])
+    dataset_directory = os.path.join(directory, name)
+    sub_directories = {kind: os.path.join(dataset_directory, kind)
+                       for kind in [KIND_FIXED_PLATFORM, KIND_CTD, KIND_SHARKWEB]}
+    done_file_path = os.path.join(dataset_directory, 'done')
+
+    if not os.path.exists(done_file_path):
+        for sub_directory in sub_directories.values():
+            os.makedirs(sub_directory, exist_ok=True)
+            for file_name in os.listdir(sub_directory):
+                os.remove(os.path.join(sub_directory, file_name))
+        generate_fixed_platform_files(sub_directories[KIND_FIXED_PLATFORM],
+                                      nr_rows=nr['fixed_platform_rows'],
+                                      nr_files=nr['fixed_platform_files'])
+        generate_ctd_files(sub_directories[KIND_CTD], nr_files=nr['ctd_files'])
+        generate_sharkweb_file(sub_directories[KIND_SHARKWEB], nr_rows=nr['sharkweb_rows'])
+        with open(done_file_path, 'w') as fid:
+            fid.write(name)
+
+    return {kind: sorted(os.path.join(sub_directory, file_name) for file_name in os.listdir(sub_directory))
+            for kind, sub_directory in sub_directories.items()}
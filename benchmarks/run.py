@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+Runs the functions in gui.communicate on generated data with stub widgets and a real GISMOsession.
+Writes a json report with timing and memory per function that can be compared with the report of another version:
+
+    python -m plugins.SHARKtools_qc_sensors.benchmarks.run --size medium --output new.json --compare old.json
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import matplotlib.dates as dates
+
+from sharkpylib.file.file_handlers import SamplingTypeSettingsDirectory
+
+from plugins.SHARKtools_qc_sensors import engine
+from plugins.SHARKtools_qc_sensors.gui import communicate
+
+from plugins.SHARKtools_qc_sensors.benchmarks import generate
+from plugins.SHARKtools_qc_sensors.benchmarks import stubs
+
+logger = logging.getLogger(__name__)
+
+REPORT_FORMAT_VERSION = 1
+
+PLUGIN_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLING_TYPES = {generate.KIND_FIXED_PLATFORM: 'Fixed platforms CMEMS',
+                  generate.KIND_CTD: 'CTD DV',
+                  generate.KIND_SHARKWEB: 'PhysicalChemical SHARK'}
+
+DEFAULT_SETTINGS_FILE = 'dv_standard_ctd_updated.json'
+
+# Not used as parameters in the benchmarks
+EXCLUDED_PARAMETERS = ['time', 'lat', 'lon', 'depth', 'visit_id', 'visit_depth_id']
+
+
+def get_git_commit(directory):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def get_max_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kB on linux, bytes on mac
+    factor = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / factor
+
+
+def measure(function, repeat=3, setup=None, memory=True):
+    """
+    Times function repeat times. setup (if given) is called before each call and is not timed.
+    Memory is measured in an extra call since tracemalloc slows down the function.
+    :param function:
+    :param repeat:
+    :param setup:
+    :param memory: Measure the peak of memory allocated during the call
+    :return: dict
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    result = dict(best_s=min(times),
+                  median_s=statistics.median(times),
+                  mean_s=statistics.mean(times),
+                  times_s=times,
+                  peak_mb=None)
+    if memory:
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            function()
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+class BenchmarkRunner(object):
+    """
+    Loads a generated dataset in a session and runs each benchmark on it. A benchmark that fails is reported
+    with its error and does not stop the other benchmarks.
+    """
+    def __init__(self, session, dataset, work_directory, repeat=3, memory=True, render=False, parameters=None):
+        """
+        :param session: GISMOsession
+        :param dataset: file paths per kind, see generate.generate_dataset
+        :param work_directory: saved files are written here
+        :param repeat: number of timed calls per benchmark
+        :param memory: measure memory peak
+        :param render: render the figure (Agg) each time the plot calls its targets
+        :param parameters: parameter to use per kind. The first numeric parameter is used if not given.
+        """
+        self.session = session
+        self.dataset = dataset
+        self.work_directory = work_directory
+        self.repeat = repeat
+        self.memory = memory
+        self.render = render
+        self.parameters = parameters or {}
+        self.file_ids = {}
+        self.results = []
+
+    def _add_result(self, name, function, info=None, **kwargs):
+        logger.info(f'Running benchmark: {name}')
+        result = dict(name=name, info=info or {}, error=None)
+        try:
+            result.update(measure(function, repeat=kwargs.pop('repeat', self.repeat),
+                                  memory=kwargs.pop('memory', self.memory), **kwargs))
+        except Exception as e:
+            logger.error(f'Benchmark {name} failed: {e}')
+            result['error'] = f'{e.__class__.__name__}: {e}'
+        self.results.append(result)
+        return result
+
+    def load(self, settings_files, root_directory=None, depth=None, nr_processes=None, session_kwargs=None):
+        """
+        Loads all files in the dataset. The load time of each kind is added to the results.
+        :param settings_files: settings file name per kind
+        :param root_directory:
+        :param depth: platform depth for the fixed platform files
+        :param nr_processes: passed to engine.BatchLoader
+        :param session_kwargs: passed to engine.BatchLoader
+        :return:
+        """
+        settings_directory = SamplingTypeSettingsDirectory()
+        loader = engine.BatchLoader(self.session, session_kwargs=session_kwargs, nr_processes=nr_processes)
+        for kind, file_paths in self.dataset.items():
+            settings_file = settings_files.get(kind, DEFAULT_SETTINGS_FILE)
+            reports = []
+
+            def load():
+                reports.append(loader.load(file_paths,
+                                           sampling_type=SAMPLING_TYPES[kind],
+                                           settings_file=settings_file,
+                                           settings_file_path=settings_directory.get_path(settings_file),
+                                           root_directory=root_directory,
+                                           depth=depth))
+
+            result = self._add_result(f'load_{kind}', load, repeat=1, memory=False,
+                                      info=dict(nr_files=len(file_paths)))
+            if not reports:
+                continue
+            report = reports[0]
+            result['info']['nr_loaded'] = report.nr_loaded
+            if report.nr_errors:
+                result['error'] = report.get_summary()
+            self.file_ids[kind] = [file_id for file_id in report.loaded if file_id]
+
+    def _get_file_id(self, kind):
+        file_ids = self.file_ids.get(kind)
+        if not file_ids:
+            raise Exception(f'No {kind} files loaded')
+        return file_ids[0]
+
+    def _get_gismo_object(self, kind):
+        return self.session.get_gismo_object(self._get_file_id(kind))
+
+    def _get_parameter(self, kind, file_id=None):
+        file_id = file_id or self._get_file_id(kind)
+        if self.parameters.get(kind):
+            return self.parameters[kind]
+        gismo_object = self.session.get_gismo_object(file_id)
+        for par in self.session.get_parameter_list(file_id):
+            if par in EXCLUDED_PARAMETERS:
+                continue
+            values = pd.to_numeric(pd.Series(np.asarray(gismo_object.get_data(par)[par])), errors='coerce')
+            if values.notna().any():
+                self.parameters[kind] = par
+                return par
+        raise Exception(f'No numeric parameter in {file_id}')
+
+    def _get_flag_widget(self, gismo_object):
+        return stubs.StubFlagWidget(gismo_object.settings.get_flag_list())
+
+    def run(self):
+        for function in [self.bench_update_time_series_plot,
+                         self.bench_flag_data_time_series,
+                         self.bench_update_profile_plot,
+                         self.bench_update_profile_plot_background,
+                         self.bench_get_merge_data,
+                         self.bench_plot_map_background_data,
+                         self.bench_save_files,
+                         self.bench_file_cache]:
+            try:
+                function()
+            except Exception as e:
+                # Setup of the benchmark failed, e.g. no files of the needed kind could be loaded
+                logger.error(f'Benchmark {function.__name__} failed: {e}')
+                self.results.append(dict(name=function.__name__[len('bench_'):], info={},
+                                         error=f'{e.__class__.__name__}: {e}'))
+        return self.results
+
+    def bench_update_time_series_plot(self):
+        gismo_object = self._get_gismo_object(generate.KIND_FIXED_PLATFORM)
+        par = self._get_parameter(generate.KIND_FIXED_PLATFORM)
+        flag_widget = self._get_flag_widget(gismo_object)
+        plot_object = stubs.StubPlot(render=self.render)
+
+        def function():
+            communicate.update_time_series_plot(gismo_object=gismo_object,
+                                                par=par,
+                                                plot_object=plot_object,
+                                                flag_widget=flag_widget)
+            if self.render:
+                plot_object.call_targets()
+
+        self._add_result('update_time_series_plot', function,
+                         info=dict(nr_rows=len(gismo_object.df), parameter=par))
+
+    def bench_flag_data_time_series(self):
+        gismo_object = self._get_gismo_object(generate.KIND_FIXED_PLATFORM)
+        par = self._get_parameter(generate.KIND_FIXED_PLATFORM)
+        flags = gismo_object.settings.get_flag_list()
+        flag_widget = self._get_flag_widget(gismo_object)
+        plot_object = stubs.StubPlot()
+
+        # Flag 10 % of the series in the middle
+        time_num = dates.date2num(pd.to_datetime(np.asarray(gismo_object.get_data('time')['time'])))
+        plot_object.set_mark_range(np.nanpercentile(time_num, 45), np.nanpercentile(time_num, 55))
+
+        # Change flag between the calls so that each call flags the data
+        flag_cycle = [flags[-1], flags[0]]
+        calls = []
+
+        def setup():
+            flag_widget.selection.flag = flag_cycle[len(calls) % 2]
+            calls.append(None)
+
+        def function():
+            communicate.flag_data_time_series(flag_widget=flag_widget,
+                                              gismo_object=gismo_object,
+                                              plot_object=plot_object,
+                                              par=par)
+
+        self._add_result('flag_data_time_series', function, setup=setup,
+                         info=dict(nr_rows=len(gismo_object.df), parameter=par))
+
+    def bench_update_profile_plot(self):
+        gismo_object = self._get_gismo_object(generate.KIND_CTD)
+        par = self._get_parameter(generate.KIND_CTD)
+        flag_widget = self._get_flag_widget(gismo_object)
+        plot_object = stubs.StubPlot(render=self.render)
+
+        def function():
+            communicate.update_profile_plot(gismo_object=gismo_object,
+                                            par=par,
+                                            plot_object=plot_object,
+                                            flag_widget=flag_widget)
+            if self.render:
+                plot_object.call_targets()
+
+        self._add_result('update_profile_plot', function,
+                         info=dict(nr_rows=len(gismo_object.df), parameter=par))
+
+    def bench_update_profile_plot_background(self):
+        file_ids = self.file_ids.get(generate.KIND_CTD, [])[1:]
+        if not file_ids:
+            raise Exception('At least two ctd files are needed')
+        gismo_objects = [self.session.get_gismo_object(file_id) for file_id in file_ids]
+        par = self._get_parameter(generate.KIND_CTD)
+        flag_widget = self._get_flag_widget(gismo_objects[0])
+        plot_object = stubs.StubPlot(render=self.render)
+        info = dict(nr_files=len(gismo_objects), nr_rows=sum(len(obj.df) for obj in gismo_objects), parameter=par)
+
+        def function():
+            communicate.update_profile_plot_background(gismo_objects=gismo_objects,
+                                                       par=par,
+                                                       plot_object=plot_object,
+                                                       flag_widget=flag_widget,
+                                                       call_targets=self.render)
+
+        # The first call reads all files, later calls use the cache unless flags have been changed
+        self._add_result('update_profile_plot_background_cold', function,
+                         setup=engine.get_profile_background_cache().clear, info=info)
+        self._add_result('update_profile_plot_background_cached', function, info=info)
+
+    def bench_get_merge_data(self):
+        file_id = self._get_file_id(generate.KIND_CTD)
+        ref_file_id = self._get_file_id(generate.KIND_SHARKWEB)
+        par = self._get_parameter(generate.KIND_CTD)
+        ref_parameters = [p for p in self.session.get_parameter_list(ref_file_id) if p not in EXCLUDED_PARAMETERS]
+        compare_par = self.parameters.get(generate.KIND_SHARKWEB)
+        if not compare_par:
+            compare_par = par if par in ref_parameters else ref_parameters[0]
+        controller = stubs.StubController(self.session, file_id, ref_file_id, par)
+        compare_widget = stubs.StubCompareWidget(compare_par)
+        flag_widget = self._get_flag_widget(controller.current_gismo_object)
+        info = dict(nr_rows=len(controller.current_gismo_object.df),
+                    nr_ref_rows=len(self.session.get_gismo_object(ref_file_id).df),
+                    parameter=par,
+                    compare_parameter=compare_par)
+
+        def function():
+            communicate.get_merge_data(controller, compare_widget, flag_widget)
+
+        def clear_match_cache():
+            controller.parent_app.match_cache = stubs.StubApp().match_cache
+
+        self._add_result('get_merge_data_cold', function, setup=clear_match_cache, info=info)
+        self._add_result('get_merge_data_cached', function, info=info)
+
+    def bench_plot_map_background_data(self):
+        current_file_id = self._get_file_id(generate.KIND_FIXED_PLATFORM)
+        map_widget = stubs.StubMap()
+        user = stubs.StubUser()
+        info = dict(nr_files=len(self.session.get_file_id_list()))
+
+        def function():
+            communicate.plot_map_background_data(map_widget=map_widget,
+                                                 session=self.session,
+                                                 user=user,
+                                                 current_file_id=current_file_id)
+
+        self._add_result('plot_map_background_data_cold', function,
+                         setup=engine.get_background_layer_cache(self.session).clear, info=info)
+        self._add_result('plot_map_background_data_cached', function, info=info)
+        info['nr_points'] = map_widget.get_nr_points()
+
+    def bench_save_files(self):
+        file_id_list = self.session.get_file_id_list()
+        save_directory = os.path.join(self.work_directory, 'saved')
+        save_widget = stubs.StubSaveWidget(save_directory)
+        run_task = stubs.SynchronousTaskRunner()
+        os.makedirs(save_directory, exist_ok=True)
+
+        def setup():
+            # Files that exist would need confirmation from the user
+            for file_name in os.listdir(save_directory):
+                os.remove(os.path.join(save_directory, file_name))
+
+        def function():
+            communicate.save_files(file_id_list=file_id_list,
+                                   session=self.session,
+                                   save_widget=save_widget,
+                                   run_task=run_task,
+                                   user='benchmark')
+            report = run_task.results['Save files']
+            if report.nr_errors:
+                raise Exception(report.get_summary())
+
+        self._add_result('save_files', function, setup=setup, info=dict(nr_files=len(file_id_list)))
+
+    def bench_file_cache(self):
+        # Compare with load_<kind>. A hit unpickles the string (object) columns, only numeric columns are mapped.
+        cache = engine.ParsedFileCache(os.path.join(self.work_directory, 'file_cache'))
+        for kind, file_ids in self.file_ids.items():
+            keys = []
+            for nr, file_id in enumerate(file_ids):
+                key = f'{kind}_{nr}'
+                if cache.put(key, self.session.get_gismo_object(file_id), evict=False):
+                    keys.append(key)
+
+            def function(keys=keys):
+                for key in keys:
+                    if cache.get(key) is None:
+                        raise Exception(f'Could not read cache entry {key}')
+
+            self._add_result(f'file_cache_hit_{kind}', function, info=dict(nr_files=len(keys)))
+        cache.clear()
+
+
+def compare_reports(old_report, new_report):
+    """
+    Returns a table with the time and memory of new_report relative to old_report.
+    :param old_report: dict
+    :param new_report: dict
+    :return: str
+    """
+    old_results = {result['name']: result for result in old_report['results']}
+    lines = [f'Compared with {old_report["meta"].get("git_commit") or "?"} ({old_report["meta"]["created"]})',
+             f'{"benchmark":<40}{"old [s]":>12}{"new [s]":>12}{"ratio":>8}{"old [MB]":>12}{"new [MB]":>12}']
+    for result in new_report['results']:
+        old = old_results.get(result['name'])
+        if result.get('error') or not old or old.get('error'):
+            lines.append(f'{result["name"]:<40}{"-":>12}{"-":>12}{"-":>8}')
+            continue
+        ratio = result['best_s'] / old['best_s'] if old['best_s'] else float('nan')
+        old_mb = '-' if old.get('peak_mb') is None else f'{old["peak_mb"]:.1f}'
+        new_mb = '-' if result.get('peak_mb') is None else f'{result["peak_mb"]:.1f}'
+        lines.append(f'{result["name"]:<40}{old["best_s"]:>12.4f}{result["best_s"]:>12.4f}{ratio:>8.2f}'
+                     f'{old_mb:>12}{new_mb:>12}')
+    return '\n'.join(lines)
+
+
+def format_report(report):
+    lines = [f'{"benchmark":<40}{"best [s]":>12}{"median [s]":>12}{"peak [MB]":>12}']
+    for result in report['results']:
+        if result.get('error') and 'best_s' not in result:
+            lines.append(f'{result["name"]:<40}  failed: {result["error"]}')
+            continue
+        peak = '-' if result.get('peak_mb') is None else f'{result["peak_mb"]:.1f}'
+        lines.append(f'{result["name"]:<40}{result["best_s"]:>12.4f}{result["median_s"]:>12.4f}{peak:>12}')
+        if result.get('error'):
+            lines.append(f'    {result["error"]}')
+    return '\n'.join(lines)
+
+
+def _parse_kind_values(items):
+    values = {}
+    for item in items or []:
+        kind, value = item.split('=', 1)
+        if kind not in SAMPLING_TYPES:
+            raise argparse.ArgumentTypeError(f'Unknown kind "{kind}". Use one of {", ".join(SAMPLING_TYPES)}')
+        values[kind] = value
+    return values
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks of the communicate layer on generated data')
+    parser.add_argument('--size', default='small', choices=sorted(generate.SIZES))
+    parser.add_argument('--fixed-platform-rows', type=int, help='Overrides the rows per fixed platform file')
+    parser.add_argument('--fixed-platform-files', type=int, help='Overrides the number of fixed platform files')
+    parser.add_argument('--ctd-files', type=int, help='Overrides the number of ctd files')
+    parser.add_argument('--sharkweb-rows', type=int, help='Overrides the rows in the sharkweb file')
+    parser.add_argument('--work-directory', default=os.path.join(tempfile.gettempdir(), 'qc_sensors_benchmarks'),
+                        help='Generated files are kept here and reused between runs')
+    parser.add_argument('--root-directory', default=os.path.dirname(os.path.dirname(PLUGIN_DIRECTORY)),
+                        help='SHARKtools root directory')
+    parser.add_argument('--settings-file', action='append', metavar='KIND=NAME',
+                        help=f'Settings file per kind ({", ".join(SAMPLING_TYPES)}). '
+                             f'Default is {DEFAULT_SETTINGS_FILE}')
+    parser.add_argument('--parameter', action='append', metavar='KIND=PARAMETER',
+                        help='Parameter used per kind. Default is the first numeric parameter')
+    parser.add_argument('--depth', default='1', help='Platform depth for the fixed platform files')
+    parser.add_argument('--load-nr-processes', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true', help='Do not measure memory (faster)')
+    parser.add_argument('--render', action='store_true', help='Render the figures (Agg) in the plot benchmarks')
+    parser.add_argument('--output', help='Json file the report is written to')
+    parser.add_argument('--compare', help='Json report of an earlier run to compare with')
+    return parser
+
+
+def main(argv=None):
+    args = get_argument_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    dataset = generate.generate_dataset(os.path.join(args.work_directory, 'data'),
+                                        size=args.size,
+                                        fixed_platform_rows=args.fixed_platform_rows,
+                                        fixed_platform_files=args.fixed_platform_files,
+                                        ctd_files=args.ctd_files,
+                                        sharkweb_rows=args.sharkweb_rows)
+
+    run_directory = tempfile.mkdtemp(prefix='run_', dir=args.work_directory)
+    session_kwargs = dict(root_directory=args.root_directory,
+                          users_directory=os.path.join(run_directory, 'users'),
+                          log_directory=os.path.join(run_directory, 'log'),
+                          user='benchmark')
+    for key in ['users_directory', 'log_directory']:
+        os.makedirs(session_kwargs[key])
+    session = engine.create_session(**session_kwargs)
+
+    runner = BenchmarkRunner(session, dataset, run_directory,
+                             repeat=args.repeat,
+                             memory=not args.no_memory,
+                             render=args.render,
+                             parameters=_parse_kind_values(args.parameter))
+    t0 = time.time()
+    runner.load(_parse_kind_values(args.settings_file),
+                root_directory=args.root_directory,
+                depth=args.depth,
+                nr_processes=args.load_nr_processes,
+                session_kwargs=session_kwargs)
+    runner.run()
+
+    report = dict(meta=dict(format_version=REPORT_FORMAT_VERSION,
+                            created=time.strftime('%Y-%m-%d %H:%M:%S'),
+                            git_commit=get_git_commit(PLUGIN_DIRECTORY),
+                            python=platform.python_version(),
+                            platform=platform.platform(),
+                            numpy=np.__version__,
+                            pandas=pd.__version__,
+                            size=args.size,
+                            nr_files={kind: len(file_paths) for kind, file_paths in dataset.items()},
+                            repeat=args.repeat,
+                            render=args.render,
+                            duration_s=time.time() - t0,
+                            max_rss_mb=get_max_rss_mb()),
+                  results=runner.results)
+
+    print(format_report(report))
+    if args.output:
+        with open(args.output, 'w') as fid:
+            json.dump(report, fid, indent=4)
+    if args.compare:
+        with open(args.compare) as fid:
+            print(compare_reports(json.load(fid), report))
+    return report
+
+
+if __name__ == '__main__':
+    main()
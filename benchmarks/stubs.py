@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+Widgets without tkinter used to run the functions in gui.communicate headless.
+Only the attributes and methods used by communicate are implemented.
+"""
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from plugins.SHARKtools_qc_sensors.engine import CancelToken
+from plugins.SHARKtools_qc_sensors.engine import MatchCache
+
+FLAG_COLORS = ['navy', 'green', 'orange', 'red', 'gray', 'purple', 'black', 'blue', 'brown', 'pink']
+
+
+class StubPlot(object):
+    """
+    Replaces sharkpylib.plot.plot_selector.Plot. Lines are added to a real matplotlib figure so that the cost of
+    creating artists is included. The figure is rendered (Agg) in call_targets if render is True.
+    """
+    def __init__(self, render=False):
+        self.fig = Figure(figsize=(12, 6))
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111)
+        self.render = render
+        self.lines = {}
+        self.mark_range_orientation = 'horizontal'
+        self.mark_from = None
+        self.mark_to = None
+        self.nr_target_calls = 0
+
+    def reset_plot(self):
+        self.ax.clear()
+        self.lines = {}
+
+    def set_x_label(self, label):
+        self.ax.set_xlabel(label)
+
+    def set_y_label(self, label):
+        self.ax.set_ylabel(label)
+
+    def set_title(self, title):
+        self.ax.set_title(title)
+
+    def set_data(self, x=None, y=None, line_id=None, call_targets=True, **prop):
+        self.delete_data(line_id)
+        self.lines[line_id] = self.ax.plot(x, y, **prop)[0]
+        if call_targets:
+            self.call_targets()
+
+    def delete_data(self, line_id):
+        line = self.lines.pop(line_id, None)
+        if line is not None and line in self.ax.lines:
+            line.remove()
+
+    def call_targets(self):
+        self.nr_target_calls += 1
+        if self.render:
+            self.ax.relim()
+            self.ax.autoscale_view()
+            self.fig.canvas.draw()
+
+    def get_xlim(self):
+        return self.ax.get_xlim()
+
+    def get_ylim(self):
+        return self.ax.get_ylim()
+
+    def set_mark_range(self, mark_from, mark_to, orientation='horizontal'):
+        self.mark_from = mark_from
+        self.mark_to = mark_to
+        self.mark_range_orientation = orientation
+
+    def get_mark_from_value(self):
+        return self.mark_from
+
+    def get_mark_to_value(self):
+        return self.mark_to
+
+    def get_nr_points(self):
+        return sum(len(line.get_xdata()) for line in self.ax.lines)
+
+
+class StubMap(object):
+    """
+    Replaces the map widget. Only counts items and points.
+    """
+    def __init__(self):
+        self.items = {}
+
+    def delete_all_markers(self):
+        self.items = {}
+
+    def delete_all_map_items(self):
+        self.items = {}
+
+    def add_line(self, lat, lon, marker_id=None, **kwargs):
+        self.items[marker_id] = len(lat)
+
+    def add_markers(self, lat, lon, marker_id=None, **kwargs):
+        self.items[marker_id] = len(lat)
+
+    def get_nr_points(self):
+        return sum(self.items.values())
+
+
+class StubFlagSelection(object):
+    def __init__(self, flags, flag=None):
+        self.selected_flags = list(flags)
+        self.selected_descriptions = [str(flag) for flag in flags]
+        self.flag = flag if flag is not None else flags[-1]
+        self.colors = {flag: FLAG_COLORS[k % len(FLAG_COLORS)] for k, flag in enumerate(flags)}
+        self.markersize = {flag: 4 for flag in flags}
+
+    def get_prop(self, flag):
+        return dict(color=self.colors[flag], markersize=self.markersize[flag])
+
+    def get(self, key):
+        return getattr(self, key, None)
+
+
+class StubFlagWidget(object):
+    """
+    Replaces tkw.FlagWidget. All flags are selected and data is flagged with flag.
+    """
+    def __init__(self, flags, flag=None):
+        self.selection = StubFlagSelection(flags, flag=flag)
+
+    def get_selection(self):
+        return self.selection
+
+
+class StubSaveWidget(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_directory(self):
+        return self.directory
+
+
+class StubCompareWidget(object):
+    def __init__(self, parameter, time=12, dist=5000, depth=2):
+        self.parameter = parameter
+        self.time = time
+        self.dist = dist
+        self.depth = depth
+
+    def get_parameter(self):
+        return self.parameter
+
+
+class StubApp(object):
+    def __init__(self):
+        self.match_cache = MatchCache()
+
+
+class StubController(object):
+    """
+    Replaces the page (controller) given to the compare functions in communicate.
+    """
+    def __init__(self, session, file_id, ref_file_id, parameter):
+        self.session = session
+        self.current_file_id = file_id
+        self.current_ref_file_id = ref_file_id
+        self.current_parameter = parameter
+        self.parent_app = StubApp()
+
+    @property
+    def current_gismo_object(self):
+        return self.session.get_gismo_object(self.current_file_id)
+
+
+class StubUser(object):
+    """
+    Replaces the user object. Each group is a dict so setdefault works as for the user settings.
+    """
+    def __init__(self):
+        self.map_prop = {}
+        self.process = {}
+
+
+class StubTask(object):
+    def __init__(self):
+        self.cancel_token = CancelToken()
+        self.progress = None
+
+    def report_progress(self, *args):
+        self.progress = args
+
+
+class SynchronousTaskRunner(object):
+    """
+    Replaces App.run_task. The function is run directly and the result is stored under the task name.
+    on_done and on_error are not called since they show message boxes. Exceptions are raised.
+    """
+    def __init__(self):
+        self.results = {}
+
+    def __call__(self, name, function, *args, group=None, on_done=None, on_error=None, on_progress=None,
+                 pass_task=False, **kwargs):
+        if pass_task:
+            kwargs['task'] = StubTask()
+        self.results[name] = function(*args, **kwargs)
+        return self.results[name]
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+#----------------------------------------------------------
+from .loader import BatchLoader
+from .loader import can_register_gismo_objects
+from .loader import create_session
+from .loader import forget_load_job
+from .loader import get_load_job
+from .loader import LoadReport
+from .loader import register_gismo_object
+
+from .cache import ParsedFileCache
+
+from .flag_index import bump_column_version
+from .flag_index import bump_flags_version
+from .flag_index import FlagIndex
+from .flag_index import get_column_version
+from .flag_index import get_flag_index
+from .flag_index import get_flags_version
+from .flag_index import get_qf_column
+from .flag_index import invalidate_flag_index
+from .flag_index import remove_flag_index
+
+from .flagging import flag_data
+from .flagging import forget_file
+from .flagging import get_time_array
+from .flagging import get_time_mask
+from .flagging import register_flagged_rows
+
+from .contour import ContourGrid
+from .contour import get_contour_grid
+from .contour import get_contour_parameters
+
+from .decimate import decimate_for_view
+from .decimate import minmax_indices
+
+from .merge import build_match_data
+from .merge import get_float_data
+from .merge import to_float_array
+
+from .catalog import FileCatalog
+from .catalog import get_file_metadata
+from .catalog import get_time_extent
+
+from .map_layers import BackgroundLayerCache
+from .map_layers import get_background_layer_cache
+
+from .matching import find_matching_rows
+from .matching import get_match_index
+from .matching import MatchCache
+from .matching import MatchIndex
+from .matching import remove_match_index
+
+from .qc_runner import ParallelQCRunner
+from .qc_runner import QCReport
+
+from .tasks import CancelToken
+from .tasks import Task
+from .tasks import TaskCancelled
+from .tasks import TaskExecutor
+
+from .instrumentation import CallStats
+from .instrumentation import get_instrumentation
+from .instrumentation import instrumented
+from .instrumentation import Instrumentation
+
+from .tracing import array_summary
+from .tracing import configure_tracing
+from .tracing import get_tracer
+from .tracing import Tracer
+
+from .html_export import HtmlExporter
+from .html_export import HtmlExportReport
+from .html_export import HtmlPlotJob
+
+from .incremental import get_dirty_rows
+from .incremental import index_loaded_file
+from .incremental import RowIndex
+
+from .saver import FileSaver
+from .saver import save_file_atomic
+from .saver import SaveReport
+
+from .profiles import get_profile_background_cache
+from .profiles import ProfileBackgroundCache
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import logging
+
+import numpy as np
+import sharkpylib as spl
+
+logger = logging.getLogger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+BUFFER_ALIGNMENT = 64
+
+OBJECT_FILE_NAME = 'object.pkl'
+BUFFER_FILE_NAME = 'buffers.bin'
+INDEX_FILE_NAME = 'index.json'
+
+
+class ParsedFileCache(object):
+    """
+    On disk cache of parsed gismo objects.
+
+    Each entry is a directory with:
+        object.pkl  - the pickled object without its array data (pickle protocol 5)
+        buffers.bin - the numeric column data stored contiguously (out-of-band pickle buffers)
+        index.json  - offsets of the buffers and information about the source file
+
+    On get the buffer file is memory-mapped (copy-on-write) and handed to pickle, so numeric columns
+    are not parsed or copied. Columns of object dtype (e.g. the strings read from the data file) are in object.pkl
+    and are unpickled on each get. This is still several times faster than parsing the file. Entries are keyed on the data file (path, size, mtime), sampling type,
+    settings file and platform depth. The total size is kept below max_size_mb by removing the least
+    recently used entries.
+    """
+    def __init__(self, directory, max_size_mb=2000):
+        self.directory = directory
+        self.max_size_mb = max_size_mb
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def get_key(self, data_file_path, sampling_type=None, settings_file=None, settings_file_path=None, depth=None):
+        """
+        Returns the cache key for the given file. None if the file does not exist.
+        :param data_file_path:
+        :param sampling_type:
+        :param settings_file:
+        :param settings_file_path: If given, changes in the settings file also invalidates the entry.
+        :param depth:
+        :return: str
+        """
+        if not os.path.isfile(data_file_path):
+            return None
+        stat = os.stat(data_file_path)
+        key_info = [CACHE_FORMAT_VERSION,
+                    getattr(spl, '__version__', ''),
+                    os.path.abspath(data_file_path),
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    sampling_type,
+                    settings_file,
+                    str(depth)]
+        if settings_file_path and os.path.isfile(settings_file_path):
+            key_info.append(os.stat(settings_file_path).st_mtime_ns)
+        return hashlib.sha1(json.dumps(key_info).encode()).hexdigest()
+
+    def _get_entry_directory(self, key):
+        return os.path.join(self.directory, key)
+
+    def has(self, key):
+        return bool(key) and os.path.isfile(os.path.join(self._get_entry_directory(key), INDEX_FILE_NAME))
+
+    def get(self, key):
+        """
+        Returns the cached object for the given key. None if not in cache or if the entry can not be read.
+        :param key:
+        :return:
+        """
+        if not self.has(key):
+            return None
+        entry_directory = self._get_entry_directory(key)
+        index_file_path = os.path.join(entry_directory, INDEX_FILE_NAME)
+        try:
+            with open(index_file_path) as fid:
+                index = json.load(fid)
+            buffers = []
+            if index['buffers']:
+                # Copy-on-write: flagging changes the data in memory but never the cache file
+                mm = np.memmap(os.path.join(entry_directory, BUFFER_FILE_NAME), dtype=np.uint8, mode='c')
+                for offset, nbytes in index['buffers']:
+                    buffers.append(mm[offset:offset + nbytes])
+            with open(os.path.join(entry_directory, OBJECT_FILE_NAME), 'rb') as fid:
+                obj = pickle.loads(fid.read(), buffers=buffers)
+        except Exception as e:
+            logger.warning(f'Could not read cache entry {key}: {e}')
+            self.remove(key)
+            return None
+        # Used for least recently used eviction
+        os.utime(index_file_path)
+        return obj
+
+    def put(self, key, obj, source_info=None, evict=True):
+        """
+        Adds obj to the cache. The entry is written to a temporary directory first and then renamed,
+        so several processes can write to the cache at the same time.
+        :param key:
+        :param obj:
+        :param source_info: dict stored in the index file (e.g. file path and sampling type)
+        :param evict: Set to False if eviction is handled by the caller (e.g. in worker processes).
+        :return: True if the entry was written
+        """
+        if not key:
+            return False
+        entry_directory = self._get_entry_directory(key)
+        temp_directory = f'{entry_directory}.{os.getpid()}.tmp'
+        try:
+            pickle_buffers = []
+            data = pickle.dumps(obj, protocol=5, buffer_callback=pickle_buffers.append)
+            if os.path.exists(temp_directory):
+                shutil.rmtree(temp_directory)
+            os.makedirs(temp_directory)
+            buffer_index = []
+            with open(os.path.join(temp_directory, BUFFER_FILE_NAME), 'wb') as fid:
+                offset = 0
+                for pickle_buffer in pickle_buffers:
+                    raw = pickle_buffer.raw()
+                    padding = -offset % BUFFER_ALIGNMENT
+                    fid.write(b'\0' * padding)
+                    offset += padding
+                    fid.write(raw)
+                    buffer_index.append((offset, raw.nbytes))
+                    offset += raw.nbytes
+            with open(os.path.join(temp_directory, OBJECT_FILE_NAME), 'wb') as fid:
+                fid.write(data)
+            with open(os.path.join(temp_directory, INDEX_FILE_NAME), 'w') as fid:
+                json.dump(dict(buffers=buffer_index,
+                               source=source_info or {},
+                               created=time.time()), fid)
+            if os.path.exists(entry_directory):
+                shutil.rmtree(entry_directory, ignore_errors=True)
+            os.replace(temp_directory, entry_directory)
+        except Exception as e:
+            logger.warning(f'Could not write cache entry {key}: {e}')
+            shutil.rmtree(temp_directory, ignore_errors=True)
+            return False
+        if evict:
+            self.evict()
+        return True
+
+    def remove(self, key):
+        """
+        Removes the entry. Returns False if the entry could not be removed (e.g. memory-mapped on Windows).
+        :param key:
+        :return:
+        """
+        entry_directory = self._get_entry_directory(key)
+        if not os.path.exists(entry_directory):
+            return True
+        try:
+            shutil.rmtree(entry_directory)
+        except OSError as e:
+            logger.debug(f'Could not remove cache entry {key}: {e}')
+            return False
+        return True
+
+    def _get_entries(self):
+        """
+        :return: list of (last_used, size_in_bytes, key)
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            entry_directory = self._get_entry_directory(key)
+            if key.endswith('.tmp') or not os.path.isdir(entry_directory):
+                continue
+            index_file_path = os.path.join(entry_directory, INDEX_FILE_NAME)
+            if not os.path.isfile(index_file_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_directory, file_name))
+                       for file_name in os.listdir(entry_directory))
+            entries.append((os.path.getmtime(index_file_path), size, key))
+        return entries
+
+    def get_size(self):
+        """
+        :return: Total size of the cache in bytes
+        """
+        return sum(size for _, size, _ in self._get_entries())
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is smaller than max_size_mb.
+        :return: number of removed entries
+        """
+        max_size = self.max_size_mb * 1024 * 1024
+        entries = sorted(self._get_entries())
+        total_size = sum(size for _, size, _ in entries)
+        nr_removed = 0
+        for last_used, size, key in entries:
+            if total_size <= max_size:
+                break
+            if self.remove(key):
+                total_size -= size
+                nr_removed += 1
+        return nr_removed
+
+    def clear(self):
+        """
+        Removes all entries in the cache.
+        :return: (number of removed entries, number of removed bytes)
+        """
+        nr_removed = 0
+        removed_size = 0
+        for last_used, size, key in self._get_entries():
+            if self.remove(key):
+                nr_removed += 1
+                removed_size += size
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        return nr_removed, removed_size
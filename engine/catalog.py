@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+import weakref
+
+import numpy as np
+import pandas as pd
+from sharkpylib.gismo.exceptions import *
+
+from .flagging import get_time_array
+
+logger = logging.getLogger(__name__)
+
+CATALOG_COLUMNS = ['sampling_type',
+                   'station',
+                   'time_first',
+                   'time_last',
+                   'lat',
+                   'lon',
+                   'lat_min',
+                   'lat_max',
+                   'lon_min',
+                   'lon_max',
+                   'depth_min',
+                   'depth_max']
+
+# Filter keys that are evaluated by the catalog. Other keys are passed on to session.get_filtered_file_id_list.
+CATALOG_FILTER_KEYS = ['startswith', 'stations', 'time_from', 'time_to', 'lat_min', 'lat_max', 'lon_min', 'lon_max']
+
+
+def _get_nan_extent(array):
+    array = np.asarray(array, dtype=float)
+    if not len(array) or np.all(np.isnan(array)):
+        return np.nan, np.nan, np.nan
+    return np.nanmin(array), np.nanmax(array), np.nanmean(array)
+
+
+def get_time_extent(gismo_object):
+    """
+    Returns the first and last time in gismo_object.
+    :param gismo_object:
+    :return: tuple of np.datetime64 (NaT if the file has no valid time)
+    """
+    time_array = get_time_array(gismo_object)
+    valid_time = time_array[~np.isnat(time_array)]
+    if not len(valid_time):
+        return np.datetime64('NaT'), np.datetime64('NaT')
+    return valid_time.min(), valid_time.max()
+
+
+def get_file_metadata(gismo_object, sampling_type=None, parameters=None):
+    """
+    Collects the metadata for one gismo object.
+    :param gismo_object:
+    :param sampling_type:
+    :param parameters: list of parameters in the file
+    :return: dict
+    """
+    time_first, time_last = get_time_extent(gismo_object)
+    data = gismo_object.get_data('lat', 'lon')
+    lat_min, lat_max, lat = _get_nan_extent(data['lat'])
+    lon_min, lon_max, lon = _get_nan_extent(data['lon'])
+    try:
+        depth_min, depth_max, _ = _get_nan_extent(gismo_object.get_data('depth')['depth'])
+    except GISMOException:
+        depth_min, depth_max = np.nan, np.nan
+    return dict(sampling_type=sampling_type,
+                station=gismo_object.get_station_name(),
+                time_first=time_first,
+                time_last=time_last,
+                lat=lat,
+                lon=lon,
+                lat_min=lat_min,
+                lat_max=lat_max,
+                lon_min=lon_min,
+                lon_max=lon_max,
+                depth_min=depth_min,
+                depth_max=depth_max,
+                parameters=frozenset(parameters or []))
+
+
+class FileCatalog(object):
+    """
+    Metadata for all files loaded in a GISMOsession, one row per file_id in a dataframe.
+    The metadata is collected once when a file is loaded (see update) so that filtering and listing of files does not
+    need to touch the gismo objects.
+    """
+    def __init__(self):
+        self.df = pd.DataFrame(columns=CATALOG_COLUMNS)
+        self.df.index.name = 'file_id'
+        self.parameters = {}
+        self._objects = {}
+
+    def __len__(self):
+        return len(self.df)
+
+    def __contains__(self, file_id):
+        return file_id in self.df.index
+
+    def update(self, session):
+        """
+        Adds files that are new or reloaded in session and removes files that are no longer loaded.
+        Files already in the catalog are not touched.
+        :param session: GISMOsession
+        :return: list of added file_ids
+        """
+        loaded = {}
+        for sampling_type in session.get_sampling_types():
+            for file_id in session.get_file_id_list(sampling_type=sampling_type):
+                loaded[file_id] = sampling_type
+
+        removed = [file_id for file_id in self.df.index if file_id not in loaded]
+        if removed:
+            self.remove(removed)
+
+        rows = {}
+        for file_id, sampling_type in loaded.items():
+            gismo_object = session.get_gismo_object(file_id)
+            ref = self._objects.get(file_id)
+            if ref is not None and ref() is gismo_object:
+                continue
+            try:
+                parameters = session.get_parameter_list(file_id)
+            except GISMOException:
+                parameters = []
+            metadata = get_file_metadata(gismo_object, sampling_type=sampling_type, parameters=parameters)
+            self.parameters[file_id] = metadata.pop('parameters')
+            self._objects[file_id] = weakref.ref(gismo_object)
+            rows[file_id] = metadata
+
+        if rows:
+            new_df = pd.DataFrame.from_dict(rows, orient='index', columns=CATALOG_COLUMNS)
+            new_df.index.name = 'file_id'
+            df = self.df.drop(index=[file_id for file_id in rows if file_id in self.df.index])
+            self.df = pd.concat([df, new_df]) if len(df) else new_df
+            logger.debug(f'{len(rows)} files added to catalog')
+        return list(rows)
+
+    def remove(self, file_id):
+        """
+        :param file_id: str or list of file_ids
+        :return:
+        """
+        if not isinstance(file_id, (list, tuple, set)):
+            file_id = [file_id]
+        self.df = self.df.drop(index=[f_id for f_id in file_id if f_id in self.df.index])
+        for f_id in file_id:
+            self.parameters.pop(f_id, None)
+            self._objects.pop(f_id, None)
+
+    def clear(self):
+        self.df = self.df.iloc[0:0]
+        self.parameters = {}
+        self._objects = {}
+
+    def get_file_id_list(self, startswith=None):
+        """
+        Returns the file_ids in the catalog (sorted) that starts with startswith.
+        :param startswith: str or list of str
+        :return: list
+        """
+        return self._get_file_ids(self._get_startswith_mask(startswith))
+
+    def _get_file_ids(self, boolean):
+        return sorted(self.df.index[boolean])
+
+    def _get_startswith_mask(self, startswith):
+        if not startswith:
+            return np.ones(len(self.df), dtype=bool)
+        if isinstance(startswith, (list, tuple, set)):
+            startswith = tuple(startswith)
+        return np.asarray(self.df.index.str.startswith(startswith), dtype=bool)
+
+    def get_filter_mask(self, startswith=None, stations=None, time_from=None, time_to=None,
+                        lat_min=None, lat_max=None, lon_min=None, lon_max=None, **kwargs):
+        """
+        Returns a boolean array (one value per row in self.df) for the files that matches the filter.
+        A file matches the time and position filter if its extent overlaps the given range.
+        Files without time or position are not removed by that part of the filter.
+        :return: boolean array
+        """
+        df = self.df
+        boolean = self._get_startswith_mask(startswith)
+        if stations:
+            boolean &= df['station'].isin(stations).values
+        if time_from:
+            boolean &= ~(df['time_last'].values < np.datetime64(pd.Timestamp(time_from).tz_localize(None)))
+        if time_to:
+            boolean &= ~(df['time_first'].values > np.datetime64(pd.Timestamp(time_to).tz_localize(None)))
+        if lat_min is not None:
+            boolean &= ~(df['lat_max'].values.astype(float) < float(lat_min))
+        if lat_max is not None:
+            boolean &= ~(df['lat_min'].values.astype(float) > float(lat_max))
+        if lon_min is not None:
+            boolean &= ~(df['lon_max'].values.astype(float) < float(lon_min))
+        if lon_max is not None:
+            boolean &= ~(df['lon_min'].values.astype(float) > float(lon_max))
+        return boolean
+
+    def get_filtered_file_id_list(self, session=None, **kwargs):
+        """
+        Same as session.get_filtered_file_id_list but evaluated on the catalog.
+        Filter keys not handled by the catalog (see CATALOG_FILTER_KEYS) are passed on to
+        session.get_filtered_file_id_list if they have a value.
+        :param session: Only needed if kwargs contains keys not handled by the catalog
+        :return: sorted list of file_ids
+        """
+        file_id_list = self._get_file_ids(self.get_filter_mask(**kwargs))
+        other_keys = {key: value for key, value in kwargs.items() if key not in CATALOG_FILTER_KEYS and value}
+        if other_keys and session is not None and file_id_list:
+            other_keys['startswith'] = kwargs.get('startswith')
+            matching = set(session.get_filtered_file_id_list(**other_keys))
+            file_id_list = [file_id for file_id in file_id_list if file_id in matching]
+        return file_id_list
+
+    def get_table_data(self, file_id_list, time_format='%Y-%m-%d %H:%M'):
+        """
+        Returns rows with file_id, station and first time of the given files.
+        :param file_id_list:
+        :param time_format:
+        :return: list of lists
+        """
+        df = self.df.loc[list(file_id_list)]
+        time_strings = pd.to_datetime(df['time_first']).dt.strftime(time_format).fillna('')
+        return [list(item) for item in zip(df.index, df['station'], time_strings)]
+
+    def get_time_extent(self, file_id_list=None):
+        """
+        Returns the first and last time of the given files (all files if None).
+        Based on the per file extents so the time of the individual rows are never touched.
+        :param file_id_list:
+        :return: tuple of pd.Timestamp (NaT if there are no files)
+        """
+        df = self.df if file_id_list is None else self.df.loc[list(file_id_list)]
+        return pd.to_datetime(df['time_first']).min(), pd.to_datetime(df['time_last']).max()
+
+    def get_station_list(self):
+        return sorted(set(self.df['station'].dropna()))
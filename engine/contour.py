@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import functools
+import logging
+import re
+import weakref
+
+import numpy as np
+
+from .flag_index import get_column_version
+
+logger = logging.getLogger(__name__)
+
+# Depth given in the parameter name, e.g. TEMP_5 for temperature at 5 m.
+DEPTH_PATTERN = re.compile(r'_\d*')
+
+# file_id: (weakref to gismo_object, {contour_par: ContourGrid}). See get_contour_grid.
+_contour_grids = {}
+
+
+def get_parameter_depth(par):
+    """
+    Returns the depth given in par. 0 if there is no depth in the name.
+    :param par:
+    :return: int
+    """
+    found = DEPTH_PATTERN.findall(par)
+    if found and found[0].strip('_'):
+        return int(found[0].strip('_'))
+    return 0
+
+
+@functools.lru_cache(maxsize=64)
+def _get_contour_parameters(parameter_tuple):
+    by_base = {}
+    for par in parameter_tuple:
+        by_base.setdefault(DEPTH_PATTERN.sub('', par), []).append(par)
+    contour_parameters = {}
+    for base_par, par_list in by_base.items():
+        if len(par_list) < 2:
+            continue
+        depths = {par: get_parameter_depth(par) for par in par_list}
+        contour_parameters[base_par] = tuple(sorted(depths, key=lambda par: depths[par], reverse=True))
+    return contour_parameters
+
+
+def get_contour_parameters(parameter_list):
+    """
+    Groups parameters that are given at several depths, e.g. TEMP_5, TEMP_10 and TEMP_15.
+    The result is cached for the given parameter list.
+    :param parameter_list:
+    :return: dict with the parameter name without depth as key and the parameters sorted on depth (deepest first)
+    """
+    return {base_par: list(par_list) for base_par, par_list in
+            _get_contour_parameters(tuple(parameter_list)).items()}
+
+
+class ContourGrid(object):
+    """
+    Values of one multi depth parameter as a contiguous 2D float array with one row per depth
+    (the layout expected by the contour plot) and one column per time.
+    A row is only read again from the gismo object when the flags of that parameter have been changed.
+    """
+    def __init__(self, gismo_object, par_list):
+        self._gismo_object_ref = weakref.ref(gismo_object)
+        self.par_list = list(par_list)
+        self.depth = np.array([get_parameter_depth(par) for par in self.par_list], dtype=float)
+        self.time = np.asarray(gismo_object.get_data('time')['time'])
+        self.values = np.empty((len(self.par_list), len(self.time)), dtype=float)
+        self._versions = [None] * len(self.par_list)
+        self.nr_reads = 0
+
+    @property
+    def gismo_object(self):
+        return self._gismo_object_ref()
+
+    def get_stale_parameters(self):
+        gismo_object = self.gismo_object
+        return [par for par, version in zip(self.par_list, self._versions)
+                if version != get_column_version(gismo_object, par)]
+
+    def get_data(self):
+        """
+        Returns time, depth and values. Parameters with changed flags are read in one call to get_data.
+        :return: tuple (time array, depth array, 2D float array)
+        """
+        stale = self.get_stale_parameters()
+        if stale:
+            gismo_object = self.gismo_object
+            data = gismo_object.get_data(*stale)
+            for par in stale:
+                row = self.par_list.index(par)
+                self.values[row] = np.asarray(data[par], dtype=float)
+                self._versions[row] = get_column_version(gismo_object, par)
+            self.nr_reads += len(stale)
+            logger.debug(f'{len(stale)} of {len(self.par_list)} contour rows read')
+        return self.time, self.depth, self.values
+
+
+def get_contour_grid(gismo_object, contour_par, par_list):
+    """
+    Returns the cached ContourGrid for contour_par in gismo_object. A new grid is created if the file has been
+    reloaded or if par_list has changed.
+    :param gismo_object:
+    :param contour_par: parameter name without depth, see get_contour_parameters
+    :param par_list: the parameters of contour_par
+    :return: ContourGrid
+    """
+    ref, grids = _contour_grids.get(gismo_object.file_id, (None, None))
+    if ref is None or ref() is not gismo_object:
+        grids = {}
+        _contour_grids[gismo_object.file_id] = (weakref.ref(gismo_object), grids)
+    grid = grids.get(contour_par)
+    if grid is None or grid.par_list != list(par_list):
+        grid = ContourGrid(gismo_object, par_list)
+        grids[contour_par] = grid
+    return grid
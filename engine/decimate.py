@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import numpy as np
+
+
+def minmax_indices(values, max_points, positions=None):
+    """
+    Min/max decimation. The rows are split in max_points/2 consecutive buckets and the row with the min and the
+    max value in each bucket is kept. Peaks and outliers are therefore always visible.
+    :param values: 1D float array without NaN
+    :param max_points: Approximate max number of returned positions
+    :param positions: Row positions (sorted) in values to decimate. All rows if None.
+    :return: sorted int array with positions in values
+    """
+    if positions is None:
+        positions = np.arange(len(values))
+    nr_values = len(positions)
+    if nr_values <= max_points or max_points < 2:
+        return positions
+
+    nr_buckets = max(max_points // 2, 1)
+    bucket_size = int(np.ceil(nr_values / nr_buckets))
+    nr_buckets = int(np.ceil(nr_values / bucket_size))
+    padding = nr_buckets * bucket_size - nr_values
+
+    bucket_values = values[positions]
+    low = np.concatenate([bucket_values, np.full(padding, np.inf)]).reshape(nr_buckets, bucket_size)
+    high = np.concatenate([bucket_values, np.full(padding, -np.inf)]).reshape(nr_buckets, bucket_size)
+
+    offset = np.arange(nr_buckets) * bucket_size
+    index_min = offset + np.argmin(low, axis=1)
+    index_max = offset + np.argmax(high, axis=1)
+    index = np.unique(np.concatenate([index_min, index_max]))
+    return positions[index]
+
+
+def decimate_for_view(values, max_points, view_mask=None):
+    """
+    Decimates with full resolution (max_points) inside the view and a coarse resolution (max_points/4)
+    outside the view. The points outside the view keeps the extremes so that "zoom to data" still works.
+    :param values: 1D float array used for min/max selection
+    :param max_points:
+    :param view_mask: boolean array, True for rows inside the view. All rows are treated as inside if None.
+    :return: sorted int array with row positions to plot
+    """
+    if view_mask is None:
+        return minmax_indices(values, max_points)
+    inside = np.flatnonzero(view_mask)
+    outside = np.flatnonzero(~view_mask)
+    coarse = max(max_points // 4, 2)
+    return np.union1d(minmax_indices(values, max_points, positions=inside),
+                      minmax_indices(values, coarse, positions=outside))
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from .incremental import mark_all_dirty
+
+# One FlagIndex per file_id. See get_flag_index.
+_flag_indices = {}
+
+# Counter per file_id that is increased every time flags are changed. See get_flags_version.
+_flags_versions = {}
+
+# Counters per file_id and parameter used to invalidate data cached per parameter. See get_column_version.
+# The counter under key None is for changes where the affected parameters are not known.
+_column_versions = {}
+
+
+def get_qf_column(gismo_object, par):
+    """
+    Returns the name of the quality flag column of par in the data of gismo_object.
+    :param gismo_object:
+    :param par:
+    :return: str or None if not found
+    """
+    df = getattr(gismo_object, 'df', None)
+    if df is None:
+        return None
+    names = []
+    try:
+        names.append(gismo_object.get_qf_par(par))
+    except Exception:
+        pass
+    try:
+        mapping = gismo_object.settings.get_data('parameter_mapping')
+        names.append(f'{mapping.get("qf_prefix") or ""}{par}{mapping.get("qf_suffix") or ""}')
+    except Exception:
+        pass
+    for name in names:
+        if name and name != par and name in df.columns:
+            return name
+    return None
+
+
+def to_flag_keys(qf_values):
+    """
+    Returns the flags as strings, the same representation as str(flag) for the flags in the settings.
+    Missing flags are given as empty strings.
+    :param qf_values: array or pd.Series with flags (str, int or float)
+    :return: pd.Series of str
+    """
+    qf_values = pd.Series(qf_values)
+    keys = qf_values.astype(str).str.strip().str.replace(r'\.0+$', '', regex=True)
+    keys[qf_values.isna().to_numpy()] = ''
+    return keys
+
+
+def group_positions(keys):
+    """
+    Groups row positions by key with one sort.
+    :param keys: array with one key per row
+    :return: dict with key as key and sorted int array of row positions as value
+    """
+    codes, uniques = pd.factorize(np.asarray(keys))
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    # Rows without a key (code -1) are first in order
+    groups = np.split(order[np.count_nonzero(codes < 0):], np.cumsum(counts)[:-1])
+    return {key: group for key, group in zip(uniques, groups)}
+
+
+class FlagIndex(object):
+    """
+    Row positions of each flag for the parameters in a gismo object: {par: {flag: int array}}.
+    The positions for a parameter are built the first time they are asked for (one read of the parameter and its
+    QF column) and are then moved between flags with move() when data is flagged.
+    Flags are used as keys in their string representation.
+    """
+    def __init__(self, gismo_object):
+        self._gismo_object_ref = weakref.ref(gismo_object)
+        self.file_id = gismo_object.file_id
+        self._index = {}
+
+    @property
+    def gismo_object(self):
+        return self._gismo_object_ref()
+
+    def _build(self, par):
+        gismo_object = self.gismo_object
+        qf_column = get_qf_column(gismo_object, par)
+        if qf_column is None:
+            # The QF column is not known. One masked read per flag.
+            flag_positions = {}
+            for flag in gismo_object.settings.get_flag_list():
+                data = gismo_object.get_data(par, mask_options={'include_flags': [flag]})
+                flag_positions[str(flag)] = np.flatnonzero(~np.isnan(np.asarray(data[par], dtype=float)))
+            self._index[par] = flag_positions
+            return
+        values = pd.to_numeric(pd.Series(np.asarray(gismo_object.get_data(par)[par])), errors='coerce')
+        keys = to_flag_keys(gismo_object.df[qf_column].to_numpy())
+        # Rows without a value are not shown for any flag
+        keys[values.isna().to_numpy()] = np.nan
+        self._index[par] = group_positions(keys.to_numpy(dtype=object))
+
+    def has_par(self, par):
+        return par in self._index
+
+    def get_positions(self, par, flag):
+        """
+        Returns the sorted row positions of par that has the given flag.
+        :param par:
+        :param flag:
+        :return: int array
+        """
+        if par not in self._index:
+            self._build(par)
+        return self._index[par].get(str(flag), np.array([], dtype=int))
+
+    def get_flag_positions(self, par, flags):
+        """
+        :param par:
+        :param flags: list of flags
+        :return: dict with flag (as given) as key and row positions as value
+        """
+        return {flag: self.get_positions(par, flag) for flag in flags}
+
+    def get_combined_positions(self, par, flags):
+        """
+        Returns sorted row positions of par that has any of the given flags.
+        :param par:
+        :param flags:
+        :return: int array
+        """
+        positions = [self.get_positions(par, flag) for flag in flags]
+        if not positions:
+            return np.array([], dtype=int)
+        return np.sort(np.concatenate(positions))
+
+    def move(self, par, positions, to_flag, from_flags=None):
+        """
+        Moves the given row positions to to_flag. Only positions that currently has one of from_flags are moved
+        (all flags if from_flags is None). Should be called with the same arguments as the flagging of the data.
+        :param par:
+        :param positions: int array or boolean mask of rows that are flagged
+        :param to_flag:
+        :param from_flags: list of flags
+        :return: dict with the moved positions for each flag they where moved from
+        """
+        if par not in self._index:
+            # Built from the (already flagged) data the next time it is needed
+            return {}
+        positions = np.asarray(positions)
+        if positions.dtype == bool:
+            positions = np.flatnonzero(positions)
+        flag_positions = self._index[par]
+        to_flag = str(to_flag)
+        if from_flags is None:
+            from_flags = list(flag_positions)
+        moved = {}
+        for flag in from_flags:
+            flag = str(flag)
+            if flag == to_flag or flag not in flag_positions:
+                continue
+            is_moved = np.isin(flag_positions[flag], positions, assume_unique=True)
+            if not is_moved.any():
+                continue
+            moved[flag] = flag_positions[flag][is_moved]
+            flag_positions[flag] = flag_positions[flag][~is_moved]
+        if moved:
+            all_moved = np.concatenate(list(moved.values()))
+            current = flag_positions.get(to_flag, np.array([], dtype=int))
+            flag_positions[to_flag] = np.union1d(current, all_moved)
+        return moved
+
+    def invalidate(self, par=None, keep_par=None):
+        """
+        Removes the index for par (all parameters if par is None). keep_par is never removed.
+        :param par:
+        :param keep_par:
+        :return:
+        """
+        if par is not None:
+            self._index.pop(par, None)
+            return
+        for key in list(self._index):
+            if key != keep_par:
+                self._index.pop(key)
+
+
+def get_flag_index(gismo_object):
+    """
+    Returns the FlagIndex for the given gismo_object. A new index is created if the file has been reloaded.
+    :param gismo_object:
+    :return: FlagIndex
+    """
+    flag_index = _flag_indices.get(gismo_object.file_id)
+    if flag_index is None or flag_index.gismo_object is not gismo_object:
+        flag_index = FlagIndex(gismo_object)
+        _flag_indices[gismo_object.file_id] = flag_index
+    return flag_index
+
+
+def remove_flag_index(file_id):
+    _flag_indices.pop(file_id, None)
+
+
+def invalidate_flag_index(file_id, par=None):
+    """
+    Use when flags are changed outside the plugin, e.g. by automatic qc or when flagging by depth.
+    :param file_id: str or list of file_ids
+    :param par: If None the index for all parameters are removed.
+    :return:
+    """
+    if not isinstance(file_id, (list, tuple, set)):
+        file_id = [file_id]
+    for f_id in file_id:
+        bump_flags_version(f_id)
+        bump_column_version(f_id, par)
+        # The changed rows are not known
+        mark_all_dirty(f_id)
+        flag_index = _flag_indices.get(f_id)
+        if flag_index:
+            flag_index.invalidate(par)
+
+
+def bump_flags_version(file_id):
+    _flags_versions[file_id] = _flags_versions.get(file_id, 0) + 1
+
+
+def get_flags_version(gismo_object):
+    """
+    Returns a value that changes when the flags in gismo_object are changed or when the file is reloaded.
+    Used as part of cache keys.
+    :param gismo_object:
+    :return: tuple
+    """
+    return id(gismo_object), _flags_versions.get(gismo_object.file_id, 0)
+
+
+def bump_column_version(file_id, par=None):
+    """
+    Tells caches that the data of par in file_id has changed.
+    :param file_id:
+    :param par: None if all parameters might have changed
+    :return:
+    """
+    versions = _column_versions.setdefault(file_id, {})
+    versions[par] = versions.get(par, 0) + 1
+
+
+def get_column_version(gismo_object, par):
+    """
+    Returns a value that changes when the flags of par in gismo_object are changed or when the file is reloaded.
+    :param gismo_object:
+    :param par:
+    :return: tuple
+    """
+    versions = _column_versions.get(gismo_object.file_id, {})
+    return id(gismo_object), versions.get(None, 0), versions.get(par, 0)
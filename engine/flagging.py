@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from .flag_index import bump_column_version
+from .flag_index import bump_flags_version
+from .flag_index import get_flag_index
+from .flag_index import remove_flag_index
+from .incremental import mark_all_dirty
+from .incremental import mark_dirty_rows
+
+# file_id: (weakref to gismo_object, datetime64 array). See get_time_array.
+_time_arrays = {}
+
+
+def get_time_array(gismo_object):
+    """
+    Returns the time column of gismo_object as a datetime64[ns] array. The array is converted once per file.
+    :param gismo_object:
+    :return: np.ndarray
+    """
+    ref, time_array = _time_arrays.get(gismo_object.file_id, (None, None))
+    if ref is None or ref() is not gismo_object:
+        time_array = pd.to_datetime(np.asarray(gismo_object.get_data('time')['time'])).values
+        _time_arrays[gismo_object.file_id] = (weakref.ref(gismo_object), time_array)
+    return time_array
+
+
+def forget_file(file_id):
+    """
+    Removes the time array and the flag index of a file that is removed from the session.
+    :param file_id:
+    :return:
+    """
+    _time_arrays.pop(file_id, None)
+    remove_flag_index(file_id)
+
+
+def to_datetime64(value):
+    """
+    Converts a datetime (e.g. from matplotlib.dates.num2date) to a timezone naive numpy.datetime64.
+    :param value:
+    :return: np.datetime64
+    """
+    value = pd.Timestamp(value)
+    if value.tzinfo is not None:
+        value = value.tz_localize(None)
+    return value.to_datetime64()
+
+
+def get_time_mask(gismo_object, time_start=None, time_end=None):
+    """
+    Returns a boolean array that is True for the rows within time_start and time_end (both included).
+    :param gismo_object:
+    :param time_start:
+    :param time_end:
+    :return: boolean array
+    """
+    time_array = get_time_array(gismo_object)
+    boolean = np.ones(len(time_array), dtype=bool)
+    if time_start is not None:
+        boolean &= time_array >= to_datetime64(time_start)
+    if time_end is not None:
+        boolean &= time_array <= to_datetime64(time_end)
+    return boolean
+
+
+def get_dependent_parameters(gismo_object, par):
+    """
+    Returns the parameters that are flagged together with par according to the sampling type settings.
+    :param gismo_object:
+    :param par:
+    :return: list or None if not known
+    """
+    try:
+        return list(gismo_object.settings.get_data('dependent_parameters', par) or [])
+    except Exception:
+        return None
+
+
+def _bump_column_versions(gismo_object, par):
+    dependent_parameters = get_dependent_parameters(gismo_object, par)
+    if dependent_parameters is None:
+        bump_column_version(gismo_object.file_id)
+        return
+    for p in [par] + dependent_parameters:
+        bump_column_version(gismo_object.file_id, p)
+
+
+def _invalidate_dependent_parameters(flag_index, gismo_object, par):
+    # Dependent parameters are flagged as well but their rows are not known here
+    dependent_parameters = get_dependent_parameters(gismo_object, par)
+    if dependent_parameters is None:
+        flag_index.invalidate(keep_par=par)
+        return
+    for p in dependent_parameters:
+        if p != par:
+            flag_index.invalidate(p)
+
+
+def register_flagged_rows(gismo_object, flag_nr, par, positions, flags=None):
+    """
+    Updates the flag index, cache versions and changed rows after par has been flagged in gismo_object outside
+    flag_data, e.g. with session.flag_data by depth.
+    :param gismo_object:
+    :param flag_nr: the new flag
+    :param par:
+    :param positions: boolean mask or int array with the rows that where flagged
+    :param flags: Only rows that had one of these flags where flagged
+    :return: dict with the row positions that where moved from each flag
+    """
+    positions = np.asarray(positions)
+    if positions.dtype == bool:
+        positions = np.flatnonzero(positions)
+    bump_flags_version(gismo_object.file_id)
+    _bump_column_versions(gismo_object, par)
+    mark_dirty_rows(gismo_object.file_id, positions)
+    flag_index = get_flag_index(gismo_object)
+    moved = flag_index.move(par, positions, flag_nr, from_flags=flags)
+    _invalidate_dependent_parameters(flag_index, gismo_object, par)
+    return moved
+
+
+def flag_data(gismo_object, flag_nr, par, index=None, flags=None, **kwargs):
+    """
+    Flags par in gismo_object and keeps the flag index updated.
+    Rows are given by index, a boolean mask or an array of row positions. They are translated to the (unique)
+    timestamps of the rows with one vectorized lookup before they are passed to gismo_object.flag_data.
+    If index is None kwargs (e.g. time_start/time_end) are passed on to gismo_object.flag_data.
+
+    :param gismo_object:
+    :param flag_nr: the new flag
+    :param par:
+    :param index: boolean mask or int array of row positions
+    :param flags: Only rows that has one of these flags are flagged
+    :return: dict with the row positions that where moved from each flag (empty if not known)
+    """
+    if index is None:
+        gismo_object.flag_data(flag_nr, par, flags=flags, **kwargs)
+        time_kwargs = {key: kwargs[key] for key in ['time_start', 'time_end'] if key in kwargs}
+        if set(kwargs) - set(time_kwargs) <= {'qc_routine'}:
+            # The flagged rows are the rows in the time window
+            return register_flagged_rows(gismo_object, flag_nr, par, get_time_mask(gismo_object, **time_kwargs),
+                                         flags=flags)
+        bump_flags_version(gismo_object.file_id)
+        _bump_column_versions(gismo_object, par)
+        get_flag_index(gismo_object).invalidate()
+        mark_all_dirty(gismo_object.file_id)
+        return {}
+
+    index = np.asarray(index)
+    if index.dtype == bool:
+        positions = np.flatnonzero(index)
+    else:
+        positions = index.astype(int)
+    if not len(positions):
+        return {}
+
+    time_array = get_time_array(gismo_object)
+    times = np.unique(time_array[positions])
+    gismo_object.flag_data(flag_nr, par, time=times, flags=flags, **kwargs)
+    # gismo_object flags by time so rows with the same time as the given rows are flagged as well
+    return register_flagged_rows(gismo_object, flag_nr, par, np.isin(time_array, times), flags=flags)
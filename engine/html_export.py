@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .flag_index import get_flag_index
+from .flagging import get_time_array
+
+logger = logging.getLogger(__name__)
+
+
+class HtmlPlotJob(object):
+    """
+    Everything needed to write one html plot. Holds only plain data so that it can be sent to a worker process.
+    """
+    def __init__(self, file_path, title='', yaxis_title=''):
+        self.file_path = file_path
+        self.title = title
+        self.yaxis_title = yaxis_title
+        self.traces = []
+
+    def add_trace(self, x, y, name=''):
+        self.traces.append((name, x, y))
+
+
+def get_flag_traces(gismo_object, par, flags, descriptions=None):
+    """
+    Returns time and values of par split by flag. The values are read once and split with the flag index instead of
+    one masked get_data per flag. The time array is cached per file (see flagging.get_time_array). If the flag index
+    is not built, building it costs one more read of par and its qf column.
+    :param gismo_object:
+    :param par:
+    :param flags: list of flags
+    :param descriptions: list of flag descriptions used in the trace names
+    :return: list of (name, time, values)
+    """
+    if descriptions is None:
+        descriptions = flags
+    time_array = get_time_array(gismo_object)
+    values = np.asarray(gismo_object.get_data(par)[par])
+    flag_positions = get_flag_index(gismo_object).get_flag_positions(par, flags)
+    traces = []
+    for flag, description in zip(flags, descriptions):
+        positions = flag_positions[flag]
+        traces.append((f'{flag} ({description})', time_array[positions], values[positions]))
+    return traces
+
+
+def write_html_plot(job):
+    """
+    Writes the html plot described by job. Runs in a worker process.
+    :param job: HtmlPlotJob
+    :return: time in seconds
+    """
+    import sharkpylib.plot.html_plot as html_plot
+    t0 = time.time()
+    plot_object = html_plot.PlotlyPlot(title=job.title, yaxis_title=job.yaxis_title)
+    for name, x, y in job.traces:
+        plot_object.add_scatter_data(x, y, name=name, mode='markers')
+    plot_object.plot_to_file(job.file_path)
+    return time.time() - t0
+
+
+class HtmlExportReport(object):
+    """
+    Result of HtmlExporter.export. One entry per file.
+    """
+    def __init__(self):
+        self.written = []
+        self.errors = {}
+        self.file_timing = {}
+        self.duration = 0
+
+    @property
+    def nr_written(self):
+        return len(self.written)
+
+    @property
+    def nr_errors(self):
+        return len(self.errors)
+
+    def get_summary(self, max_files=10):
+        lines = [f'{self.nr_written} html file(s) written']
+        if self.errors:
+            lines[0] += f', {self.nr_errors} file(s) could not be written:'
+            for file_path, message in sorted(self.errors.items())[:max_files]:
+                lines.append(f'    {os.path.basename(file_path)}: {message}')
+            if self.nr_errors > max_files:
+                lines.append(f'    ...and {self.nr_errors - max_files} more')
+        return '\n'.join(lines)
+
+
+class HtmlExporter(object):
+    """
+    Writes html plots in a process pool. Building and writing plotly figures is cpu bound so threads would not help.
+    """
+    def __init__(self, nr_processes=None):
+        """
+        :param nr_processes: Number of worker processes. Plots are written in the calling process if 1.
+        """
+        self.nr_processes = nr_processes or os.cpu_count() or 1
+
+    def export(self, jobs, cancel_token=None, progress_callback=None):
+        """
+        :param jobs: list of HtmlPlotJob
+        :param cancel_token: engine.tasks.CancelToken
+        :param progress_callback: called with (nr_done, nr_files, file_path) after each file
+        :return: HtmlExportReport
+        """
+        report = HtmlExportReport()
+        t0 = time.time()
+
+        def add_result(job, function):
+            try:
+                report.file_timing[job.file_path] = function()
+                report.written.append(job.file_path)
+            except Exception as e:
+                logger.error(f'Could not write {job.file_path}: {e}')
+                report.errors[job.file_path] = f'{e.__class__.__name__}: {e}'
+            if progress_callback:
+                progress_callback(report.nr_written + report.nr_errors, len(jobs), job.file_path)
+
+        nr_processes = min(self.nr_processes, len(jobs))
+        if nr_processes <= 1:
+            for job in jobs:
+                if cancel_token:
+                    cancel_token.raise_if_cancelled()
+                add_result(job, lambda: write_html_plot(job))
+        else:
+            with ProcessPoolExecutor(max_workers=nr_processes) as executor:
+                futures = {executor.submit(write_html_plot, job): job for job in jobs}
+                try:
+                    for future in as_completed(futures):
+                        add_result(futures[future], future.result)
+                        if cancel_token:
+                            cancel_token.raise_if_cancelled()
+                except BaseException:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+        report.duration = time.time() - t0
+        logger.debug(f'{report.nr_written} html files written in {report.duration:.2f} s '
+                     f'using {nr_processes} process(es)')
+        return report
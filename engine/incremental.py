@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Rows with changed flags since the file was loaded or last saved to its original path, per file_id.
+# ALL_ROWS means that the changed rows are not known (e.g. after automatic qc).
+ALL_ROWS = 'all'
+_dirty_rows = {}
+
+# One RowIndex per file path. See get_row_index.
+_row_indices = {}
+
+METADATA_PREFIX = b'//'
+BUFFER_SIZE = 1024 * 1024
+
+
+def mark_dirty_rows(file_id, positions):
+    """
+    Marks rows (row positions in the gismo object) as having changed flags.
+    :param file_id:
+    :param positions: int array
+    :return:
+    """
+    current = _dirty_rows.get(file_id)
+    if current is ALL_ROWS:
+        return
+    positions = np.asarray(positions, dtype=np.int64)
+    if current is not None:
+        positions = np.concatenate([current, positions])
+    _dirty_rows[file_id] = np.unique(positions)
+
+
+def mark_all_dirty(file_id):
+    _dirty_rows[file_id] = ALL_ROWS
+
+
+def get_dirty_rows(file_id):
+    """
+    :param file_id:
+    :return: sorted int array, ALL_ROWS or None if nothing has changed
+    """
+    return _dirty_rows.get(file_id)
+
+
+def clear_dirty_rows(file_id):
+    _dirty_rows.pop(file_id, None)
+
+
+def get_file_state(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class RowIndex(object):
+    """
+    Byte offset of every data row in a text data file. Metadata lines (starting with "//") and the header are
+    skipped. The separator is taken from the header. The file is read in binary mode so the offsets are exact
+    regardless of encoding.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.state = get_file_state(file_path)
+        self.has_metadata = False
+        self.header = []
+        self.header_offset = None
+        self.separator = '\t'
+        offsets = []
+        with open(file_path, 'rb') as fid:
+            offset = 0
+            for line in fid:
+                if self.header_offset is None:
+                    if line.startswith(METADATA_PREFIX) or not line.strip():
+                        self.has_metadata = self.has_metadata or line.startswith(METADATA_PREFIX)
+                        offset += len(line)
+                        continue
+                    self.header_offset = offset
+                    header = line.decode('utf-8', errors='replace').rstrip('\r\n')
+                    for separator in ['\t', ';', ',']:
+                        if separator in header:
+                            self.separator = separator
+                            break
+                    self.header = [item.strip() for item in header.split(self.separator)]
+                elif line.strip():
+                    offsets.append(offset)
+                offset += len(line)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def is_valid(self):
+        return os.path.exists(self.file_path) and get_file_state(self.file_path) == self.state
+
+
+def get_row_index(file_path):
+    """
+    Returns the RowIndex for file_path. The index is rebuilt if the file has changed since it was built.
+    :param file_path:
+    :return: RowIndex
+    """
+    key = os.path.abspath(file_path)
+    row_index = _row_indices.get(key)
+    if row_index is None or not row_index.is_valid():
+        row_index = RowIndex(key)
+        _row_indices[key] = row_index
+    return row_index
+
+
+def index_loaded_file(session, file_id):
+    """
+    Builds the row index for the original file of file_id. Should be called when the file is loaded so that
+    later changes to the file can be detected. Flags changed before the file was reloaded are forgotten.
+    :param session: GISMOsession
+    :param file_id:
+    :return: RowIndex or None if the file can not be read
+    """
+    clear_dirty_rows(file_id)
+    try:
+        return get_row_index(session.get_file_path(file_id))
+    except (OSError, TypeError) as e:
+        logger.debug(f'No row index for {file_id}: {e}')
+        return None
+
+
+def get_qf_columns(gismo_object, header):
+    """
+    Returns the quality flag columns that are both in header and in the data of gismo_object.
+    QF columns are identified by the qf_prefix/qf_suffix in the parameter mapping of the sampling type settings.
+    :param gismo_object:
+    :param header: list of column names in the file
+    :return: list
+    """
+    try:
+        mapping = gismo_object.settings.get_data('parameter_mapping')
+    except Exception:
+        return []
+    prefix = mapping.get('qf_prefix') or ''
+    suffix = mapping.get('qf_suffix') or ''
+    if not (prefix or suffix):
+        return []
+    df_columns = set(gismo_object.df.columns)
+    return [col for col in header if col in df_columns and len(col) > len(prefix) + len(suffix) and
+            col.startswith(prefix) and col.endswith(suffix)]
+
+
+def get_key_column(gismo_object, header, qf_columns):
+    """
+    Returns the column used to check that the rows in the file are the rows in the data: time if it is in the file,
+    otherwise the first column in the file (that is not a QF column) that is also in the data.
+    :param gismo_object:
+    :param header: list of column names in the file
+    :param qf_columns:
+    :return: str or None
+    """
+    df_columns = set(gismo_object.df.columns)
+    for col in ['time'] + list(header):
+        if col in header and col in df_columns and col not in qf_columns:
+            return col
+    return None
+
+
+def _read_fields(source, row_index, row):
+    source.seek(int(row_index.offsets[row]))
+    text = source.readline().decode('latin-1').rstrip('\r\n')
+    return text.split(row_index.separator)
+
+
+def _is_same_value(field, value):
+    field = field.strip()
+    try:
+        if isinstance(value, (pd.Timestamp, np.datetime64)) or hasattr(value, 'isoformat'):
+            return pd.Timestamp(field) == pd.Timestamp(value)
+        if isinstance(value, (float, np.floating, int, np.integer)):
+            if not field:
+                return bool(pd.isna(value))
+            return float(field) == float(value)
+    except (ValueError, TypeError):
+        return False
+    return field == _to_field(value).strip()
+
+
+def rows_match(row_index, rows, key_column, key_values):
+    """
+    Checks that key_column in the file has the values of the data in the given rows and in the first and last row.
+    :param row_index: RowIndex
+    :param rows: int array of row positions
+    :param key_column: column in the file
+    :param key_values: array with a value per row in the data
+    :return: bool
+    """
+    if not len(row_index):
+        return True
+    col_position = row_index.header.index(key_column)
+    check_rows = np.union1d(np.asarray(rows, dtype=np.int64), [0, len(row_index) - 1])
+    with open(row_index.file_path, 'rb') as source:
+        for row in check_rows:
+            fields = _read_fields(source, row_index, row)
+            if col_position >= len(fields) or not _is_same_value(fields[col_position], key_values[row]):
+                logger.debug(f'Row {row} in {row_index.file_path} does not match the data in column {key_column}')
+                return False
+    return True
+
+
+def _to_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return ''
+        if float(value).is_integer():
+            return str(int(value))
+    return str(value)
+
+
+def write_patched_file(source_path, output_path, row_index, rows, columns, values):
+    """
+    Copies source_path to output_path and replaces the fields of the given columns in the given rows.
+    Bytes between the patched rows are copied in blocks without being decoded.
+    :param source_path:
+    :param output_path:
+    :param row_index: RowIndex of source_path
+    :param rows: sorted int array of row positions
+    :param columns: list of column names
+    :param values: dict {column: array with a value per row}
+    :return:
+    """
+    column_positions = [row_index.header.index(col) for col in columns]
+    separator = row_index.separator
+    with open(source_path, 'rb') as source, open(output_path, 'wb') as output:
+        position = 0
+        for row in rows:
+            offset = int(row_index.offsets[row])
+            _copy_bytes(source, output, offset - position)
+            line = source.readline()
+            position = offset + len(line)
+            # latin-1 maps every byte to one character so the unchanged fields are written back byte by byte
+            text = line.decode('latin-1')
+            ending = text[len(text.rstrip('\r\n')):]
+            fields = text[:len(text) - len(ending)].split(separator)
+            for col, col_position in zip(columns, column_positions):
+                if col_position < len(fields):
+                    fields[col_position] = _to_field(values[col][row])
+            output.write((separator.join(fields) + ending).encode('latin-1'))
+        while True:
+            block = source.read(BUFFER_SIZE)
+            if not block:
+                break
+            output.write(block)
+
+
+def _copy_bytes(source, output, nr_bytes):
+    while nr_bytes > 0:
+        block = source.read(min(BUFFER_SIZE, nr_bytes))
+        if not block:
+            break
+        output.write(block)
+        nr_bytes -= len(block)
+
+
+def save_qf_columns(session, file_id, temp_file_path):
+    """
+    Writes the original file of file_id to temp_file_path with only the QF fields of the rows with changed flags
+    replaced. Nothing is written and False is returned if an incremental save is not possible, i.e. when:
+        - the changed rows are not known (e.g. after automatic qc)
+        - the original file has changed since it was loaded
+        - the file has metadata lines. A full save updates them (e.g. with the user) and they are not patched here.
+        - the rows or QF columns of the file can not be mapped to the data, or the key column (time) of the
+          changed rows differs between file and data
+    The caller should then make a full save.
+    :param session: GISMOsession
+    :param file_id:
+    :param temp_file_path: The file that is written. Should replace file_path when done.
+    :return: True if the file was written
+    """
+    rows = get_dirty_rows(file_id)
+    if rows is ALL_ROWS:
+        return False
+    source_path = session.get_file_path(file_id)
+    if not source_path or not os.path.exists(source_path):
+        return False
+    row_index = _row_indices.get(os.path.abspath(source_path))
+    if row_index is None or not row_index.is_valid():
+        # The index is built when the file is loaded. Without it we can not know that the file is unchanged.
+        return False
+    if row_index.has_metadata:
+        return False
+    gismo_object = session.get_gismo_object(file_id)
+    if not hasattr(gismo_object, 'df') or len(gismo_object.df) != len(row_index):
+        return False
+    if rows is None:
+        rows = np.array([], dtype=np.int64)
+    elif len(rows) and rows[-1] >= len(row_index):
+        return False
+    columns = get_qf_columns(gismo_object, row_index.header)
+    if not columns:
+        return False
+    key_column = get_key_column(gismo_object, row_index.header, columns)
+    if not key_column or not rows_match(row_index, rows, key_column, gismo_object.df[key_column].values):
+        return False
+    values = {col: gismo_object.df[col].values for col in columns}
+    write_patched_file(source_path, temp_file_path, row_index, rows, columns, values)
+    logger.debug(f'{len(rows)} rows patched in {len(columns)} QF columns of {file_id}')
+    return True
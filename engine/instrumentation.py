@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import io
+import re
+import json
+import time
+import pstats
+import cProfile
+import inspect
+import logging
+import threading
+import functools
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+
+def get_data_size(arguments):
+    """
+    Returns the number of rows handled in a call. Looks for gismo objects and file lists among the arguments.
+    :param arguments: dict with argument name and value
+    :return: int or None if not known
+    """
+    gismo_object = arguments.get('gismo_object')
+    if gismo_object is None and 'self' in arguments:
+        gismo_object = getattr(arguments['self'], 'current_gismo_object', None)
+    if gismo_object is not None and hasattr(gismo_object, 'df'):
+        return len(gismo_object.df)
+    gismo_objects = arguments.get('gismo_objects')
+    if gismo_objects:
+        return sum(len(obj.df) for obj in gismo_objects if hasattr(obj, 'df'))
+    file_id_list = arguments.get('file_id_list')
+    if file_id_list is not None:
+        return len(file_id_list)
+    return None
+
+
+class CallStats(object):
+    """
+    Timing of one instrumented function. Times are inclusive, i.e. include instrumented functions called within.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.nr_calls = 0
+        self.nr_errors = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.last_time = 0
+        self.last_size = None
+        self.max_size = None
+        self.max_memory = None
+        self.profile_stats = None
+
+    @property
+    def mean_time(self):
+        return self.total_time / self.nr_calls if self.nr_calls else 0
+
+    def add(self, duration, size=None, memory=None, error=False):
+        self.nr_calls += 1
+        self.nr_errors += int(error)
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.last_time = duration
+        if size is not None:
+            self.last_size = size
+            self.max_size = size if self.max_size is None else max(self.max_size, size)
+        if memory is not None:
+            self.max_memory = memory if self.max_memory is None else max(self.max_memory, memory)
+
+    def add_profile(self, profile):
+        if self.profile_stats is None:
+            self.profile_stats = pstats.Stats(profile)
+        else:
+            self.profile_stats.add(profile)
+
+    def get_profile_text(self, nr_lines=30):
+        if self.profile_stats is None:
+            return ''
+        stream = io.StringIO()
+        self.profile_stats.stream = stream
+        self.profile_stats.sort_stats('cumulative').print_stats(nr_lines)
+        return stream.getvalue()
+
+    def to_dict(self):
+        return dict(name=self.name,
+                    nr_calls=self.nr_calls,
+                    nr_errors=self.nr_errors,
+                    total_time=self.total_time,
+                    mean_time=self.mean_time,
+                    max_time=self.max_time,
+                    last_time=self.last_time,
+                    last_size=self.last_size,
+                    max_size=self.max_size,
+                    max_memory=self.max_memory)
+
+
+class Instrumentation(object):
+    """
+    Collects wall time, number of calls and data size of the functions wrapped with instrumented.
+    cProfile and tracemalloc capture are optional since they slow down the calls. They are only done for the
+    outermost instrumented call in each thread.
+    """
+    def __init__(self):
+        self.enabled = True
+        self.profile = False
+        self.trace_memory = False
+        self.time_started = time.time()
+        self._stats = {}
+        self._lock = threading.Lock()
+        # Only one profiler can be active at a time
+        self._profile_lock = threading.Lock()
+        self._local = threading.local()
+
+    def set_options(self, enabled=None, profile=None, trace_memory=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if profile is not None:
+            self.profile = profile
+        if trace_memory is not None:
+            self.trace_memory = trace_memory
+            if trace_memory and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            elif not trace_memory and tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self.time_started = time.time()
+
+    def get_stats(self):
+        """
+        :return: list of CallStats sorted on total time
+        """
+        with self._lock:
+            return sorted(self._stats.values(), key=lambda stats: stats.total_time, reverse=True)
+
+    def _get_call_stats(self, name):
+        stats = self._stats.get(name)
+        if stats is None:
+            stats = CallStats(name)
+            self._stats[name] = stats
+        return stats
+
+    def call(self, name, function, args, kwargs, size_function=None):
+        """
+        Calls function(*args, **kwargs) and records the call under name.
+        """
+        if not self.enabled:
+            return function(*args, **kwargs)
+
+        depth = getattr(self._local, 'depth', 0)
+        outermost = depth == 0
+        profile = None
+        if outermost and self.profile and self._profile_lock.acquire(blocking=False):
+            profile = cProfile.Profile()
+        trace_memory = outermost and self.trace_memory and tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+
+        self._local.depth = depth + 1
+        error = False
+        t0 = time.perf_counter()
+        try:
+            if profile:
+                return profile.runcall(function, *args, **kwargs)
+            return function(*args, **kwargs)
+        except BaseException:
+            error = True
+            raise
+        finally:
+            duration = time.perf_counter() - t0
+            self._local.depth = depth
+            if profile:
+                self._profile_lock.release()
+            memory = None
+            if trace_memory:
+                memory = max(tracemalloc.get_traced_memory()[1] - memory_before, 0)
+            size = None
+            if size_function:
+                try:
+                    size = size_function(args, kwargs)
+                except Exception as e:
+                    logger.debug(f'Could not get data size for {name}: {e}')
+            with self._lock:
+                stats = self._get_call_stats(name)
+                stats.add(duration, size=size, memory=memory, error=error)
+                if profile:
+                    stats.add_profile(profile)
+
+    def get_summary(self):
+        """
+        Returns a text table with the stats of all functions.
+        :return: str
+        """
+        lines = [f'Instrumented calls since {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.time_started))}',
+                 f'{"function":<50}{"calls":>8}{"total [s]":>12}{"mean [ms]":>12}{"max [ms]":>12}'
+                 f'{"last rows":>12}{"max mem [MB]":>14}']
+        for stats in self.get_stats():
+            size = '' if stats.last_size is None else stats.last_size
+            memory = '' if stats.max_memory is None else f'{stats.max_memory / 1024 ** 2:.1f}'
+            lines.append(f'{stats.name:<50}{stats.nr_calls:>8}{stats.total_time:>12.3f}'
+                         f'{stats.mean_time * 1000:>12.1f}{stats.max_time * 1000:>12.1f}{size:>12}{memory:>14}')
+        return '\n'.join(lines)
+
+    def dump(self, directory):
+        """
+        Writes the stats to directory: a text summary, a json file and (if profiling) one .prof file per function.
+        The .prof files can be opened with pstats or snakeviz.
+        :param directory:
+        :return: path to the text summary
+        """
+        os.makedirs(directory, exist_ok=True)
+        time_string = time.strftime('%Y%m%d_%H%M%S')
+        file_path = os.path.join(directory, f'timing_{time_string}.txt')
+        stats_list = self.get_stats()
+        with open(file_path, 'w') as fid:
+            fid.write(self.get_summary())
+            for stats in stats_list:
+                profile_text = stats.get_profile_text()
+                if profile_text:
+                    fid.write(f'\n\n=== {stats.name} ===\n{profile_text}')
+        with open(os.path.join(directory, f'timing_{time_string}.json'), 'w') as fid:
+            json.dump(dict(time_started=self.time_started,
+                           stats=[stats.to_dict() for stats in stats_list]), fid, indent=4)
+        for stats in stats_list:
+            if stats.profile_stats is not None:
+                file_name = re.sub(r'[^\w.-]', '_', f'timing_{time_string}_{stats.name}.prof')
+                stats.profile_stats.dump_stats(os.path.join(directory, file_name))
+        logger.info(f'Timing written to {file_path}')
+        return file_path
+
+
+_instrumentation = Instrumentation()
+
+
+def get_instrumentation():
+    return _instrumentation
+
+
+def instrumented(name=None, size_function=None):
+    """
+    Decorator that records the calls of the function in the Instrumentation object.
+    :param name: Name in the stats. Defaults to module and qualified name (e.g. page_profile.PageProfile._run_qc).
+    :param size_function: called with (args, kwargs) and returns the data size of the call.
+                          Defaults to get_data_size on the named arguments.
+    :return:
+    """
+    def decorator(function):
+        call_name = name or f'{function.__module__.split(".")[-1]}.{function.__qualname__}'
+        get_size = size_function
+        if get_size is None:
+            try:
+                argument_names = list(inspect.signature(function).parameters)
+            except (TypeError, ValueError):
+                argument_names = []
+
+            def get_size(args, kwargs):
+                arguments = dict(zip(argument_names, args))
+                arguments.update(kwargs)
+                return get_data_size(arguments)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            return _instrumentation.call(call_name, function, args, kwargs, size_function=get_size)
+        return wrapper
+    return decorator
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import sharkpylib as spl
+from sharkpylib import gismo
+from sharkpylib.gismo.exceptions import *
+
+from .cache import ParsedFileCache
+
+logger = logging.getLogger(__name__)
+
+ERROR_MISSING_DEPTH = 'missing_depth'
+ERROR_MISSING_PATH = 'missing_path'
+ERROR_INVALID_PARAMETER = 'invalid_parameter'
+ERROR_QC_FIELD = 'qc_field_error'
+ERROR_UNKNOWN = 'unknown'
+
+ERROR_TITLES = {ERROR_MISSING_DEPTH: 'No platform depth given',
+                ERROR_MISSING_PATH: 'Invalid path in settings file',
+                ERROR_INVALID_PARAMETER: 'Invalid parameter',
+                ERROR_QC_FIELD: 'Something is wrong with the qf columns',
+                ERROR_UNKNOWN: 'Unexpected error'}
+
+# Session and file cache used by each worker process. Created once per process by _init_worker.
+_worker_session = None
+_worker_cache = None
+# Arguments to _load_in_session for the files loaded by BatchLoader in this process. Used to load the same file
+# with the same settings in the qc worker processes.
+_load_jobs = {}
+
+
+def create_session(root_directory=None, users_directory=None, log_directory=None, user=None, **kwargs):
+    """
+    Creates a GISMOsession the same way as App.startup does.
+    :param root_directory:
+    :param users_directory:
+    :param log_directory:
+    :param user:
+    :return: GISMOsession
+    """
+    kw = dict(save_pkl=False)
+    kw.update(kwargs)
+    return spl.gismo.GISMOsession(root_directory=root_directory,
+                                  users_directory=users_directory,
+                                  log_directory=log_directory,
+                                  user=user,
+                                  sampling_types_factory=gismo.sampling_types.PluginFactory(),
+                                  qc_routines_factory=gismo.qc_routines.PluginFactory(),
+                                  **kw)
+
+
+def can_register_gismo_objects(session):
+    """
+    Returns True if gismo objects parsed outside of the session can be added to it. This needs
+    GISMOsession.add_gismo_object in sharkpylib. Files are otherwise loaded with GISMOsession.load_file.
+    :param session: GISMOsession
+    :return: bool
+    """
+    return callable(getattr(session, 'add_gismo_object', None))
+
+
+def register_gismo_object(session, gismo_object, sampling_type):
+    """
+    Adds a gismo_object that has been parsed outside of the session (e.g. in a worker process) to the session
+    with GISMOsession.add_gismo_object, which does the same bookkeeping as GISMOsession.load_file.
+    :param session: GISMOsession
+    :param gismo_object:
+    :param sampling_type:
+    :return: file_id
+    """
+    if not can_register_gismo_objects(session):
+        raise GISMOException('The session can not add parsed gismo objects. Load the file with load_file.')
+    session.add_gismo_object(gismo_object, sampling_type=sampling_type)
+    return gismo_object.file_id
+
+
+def _load_in_session(session, data_file_path, sampling_type, settings_file, root_directory=None, depth=None):
+    """
+    Loads one file in the given session. Retries with the given depth if the sampling type needs a platform depth.
+    Returns a result dict. Exceptions are categorized and never raised.
+    :return: dict
+    """
+    result = dict(file_path=data_file_path,
+                  file_id=None,
+                  error=None,
+                  message='')
+    file_id_list_before = set(session.get_file_id_list())
+    kwargs = dict(sampling_type=sampling_type,
+                  data_file_path=data_file_path,
+                  settings_file=settings_file,
+                  reload=False,
+                  root_directory=root_directory)
+    try:
+        try:
+            session.load_file(**kwargs)
+        except GISMOExceptionMissingInputArgument as e:
+            if 'depth' not in e.message:
+                raise
+            if not depth:
+                result['error'] = ERROR_MISSING_DEPTH
+                result['message'] = 'You need to provide platform depth for this sampling type!'
+                return result
+            session.load_file(depth=depth, **kwargs)
+    except GISMOExceptionMissingPath as e:
+        result['error'] = ERROR_MISSING_PATH
+        result['message'] = 'The path "{}" given in settings file "{}" can not be found'.format(e.message,
+                                                                                            settings_file)
+        return result
+    except GISMOExceptionInvalidParameter as e:
+        result['error'] = ERROR_INVALID_PARAMETER
+        result['message'] = f'Could not find parameter {e}. Settings file might have wrong information.'
+        return result
+    except GISMOExceptionQCfieldError:
+        result['error'] = ERROR_QC_FIELD
+        result['message'] = f'Something is wrong with the qf columns in file: {data_file_path}'
+        return result
+    except Exception as e:
+        result['error'] = ERROR_UNKNOWN
+        result['message'] = f'{e.__class__.__name__}: {e}'
+        return result
+
+    new_file_ids = set(session.get_file_id_list()) - file_id_list_before
+    if new_file_ids:
+        result['file_id'] = new_file_ids.pop()
+    return result
+
+
+def _init_worker(session_kwargs, cache_kwargs=None):
+    global _worker_session
+    global _worker_cache
+    _worker_session = create_session(**session_kwargs)
+    _worker_cache = None
+    if cache_kwargs:
+        _worker_cache = ParsedFileCache(**cache_kwargs)
+
+
+def get_load_job(file_id):
+    """
+    Returns the arguments to _load_in_session that the file was loaded with by BatchLoader.
+    :param file_id:
+    :return: dict or None if the file was not loaded by BatchLoader
+    """
+    job = _load_jobs.get(file_id)
+    if job is None:
+        return None
+    return dict(job)
+
+
+def forget_load_job(file_id):
+    """
+    Call when a file is removed from the session.
+    :param file_id:
+    :return:
+    """
+    _load_jobs.pop(file_id, None)
+
+
+def _load_in_worker(job, cache_key=None):
+    """
+    Runs in a worker process. Parses the file and returns the gismo object (pickled on return).
+    The object is removed from the worker session so that the worker does not keep the data in memory.
+    :param job: dict
+    :param cache_key: If given the parsed object is also written to the file cache.
+    :return: dict
+    """
+    result = _load_in_session(_worker_session, **job)
+    result['gismo_object'] = None
+    if result['file_id']:
+        result['gismo_object'] = _worker_session.get_gismo_object(result['file_id'])
+        _worker_session.remove_file(result['file_id'])
+        if _worker_cache and cache_key:
+            # Eviction is done by the main process when the batch is finished
+            _worker_cache.put(cache_key, result['gismo_object'], source_info=_get_source_info(job), evict=False)
+    return result
+
+
+def _get_source_info(job):
+    return dict(file_path=job['data_file_path'],
+                sampling_type=job['sampling_type'],
+                settings_file=job['settings_file'])
+
+
+class LoadReport(object):
+    """
+    Collects the outcome of a batch load. One entry per file path.
+    """
+    def __init__(self):
+        self.loaded = []
+        self.errors = {}
+
+    def add_result(self, result):
+        if result.get('error'):
+            self.errors[result['file_path']] = (result['error'], result['message'])
+        else:
+            self.loaded.append(result['file_id'])
+
+    @property
+    def nr_loaded(self):
+        return len(self.loaded)
+
+    @property
+    def nr_errors(self):
+        return len(self.errors)
+
+    def get_errors_by_category(self):
+        """
+        :return: dict with error category as key and a list of (file_path, message) as value
+        """
+        categories = {}
+        for file_path, (category, message) in self.errors.items():
+            categories.setdefault(category, []).append((file_path, message))
+        return categories
+
+    def get_summary(self, max_files_per_category=10):
+        """
+        Returns a text summary of the load suitable for a popup.
+        :param max_files_per_category:
+        :return: str
+        """
+        lines = [f'{self.nr_loaded} file(s) loaded, {self.nr_errors} file(s) could not be loaded.']
+        for category, items in sorted(self.get_errors_by_category().items()):
+            lines.append('')
+            lines.append(f'{ERROR_TITLES.get(category, category)} ({len(items)}):')
+            for file_path, message in items[:max_files_per_category]:
+                lines.append(f'  {os.path.basename(file_path)}: {message}')
+            if len(items) > max_files_per_category:
+                lines.append(f'  ...and {len(items) - max_files_per_category} more')
+        return '\n'.join(lines)
+
+
+class BatchLoader(object):
+    """
+    Loads several data files into a GISMOsession. Files are parsed concurrently in a process pool
+    and the resulting gismo objects are registered in the session in the calling (main) thread.
+    Files found in the (optional) ParsedFileCache are not parsed at all.
+    Parsed objects are added with GISMOsession.add_gismo_object. If the session does not have it the files are
+    loaded one by one with GISMOsession.load_file instead.
+    """
+    def __init__(self, session, session_kwargs=None, nr_processes=None, cache=None):
+        """
+        :param session: GISMOsession that the loaded files are added to.
+        :param session_kwargs: arguments passed to create_session in the worker processes.
+        :param nr_processes: Max number of worker processes. 1 or less loads files sequentially in the session.
+        :param cache: ParsedFileCache
+        """
+        self.session = session
+        self.session_kwargs = session_kwargs or {}
+        self.nr_processes = nr_processes or os.cpu_count() or 1
+        self.cache = cache
+
+    def load(self, data_file_list, sampling_type=None, settings_file=None, root_directory=None, depth=None,
+             settings_file_path=None, progress_callback=None):
+        """
+        Loads all files in data_file_list. Errors are collected per file in the returned LoadReport.
+        :param data_file_list: list of file paths
+        :param sampling_type:
+        :param settings_file:
+        :param root_directory:
+        :param depth: platform depth used for sampling types that require it
+        :param settings_file_path: used to invalidate cached files when the settings file is changed
+        :param progress_callback: called with (nr_done, nr_files, file_path) after each file
+        :return: LoadReport
+        """
+        report = LoadReport()
+        if not can_register_gismo_objects(self.session):
+            # Parsed objects can not be added to the session. Load everything with session.load_file.
+            logger.info('Session can not add parsed gismo objects. Loading files one by one in the session.')
+            return self._load_in_session(data_file_list, report, sampling_type=sampling_type,
+                                         settings_file=settings_file, root_directory=root_directory, depth=depth,
+                                         progress_callback=progress_callback)
+        jobs = [dict(data_file_path=file_path,
+                     sampling_type=sampling_type,
+                     settings_file=settings_file,
+                     root_directory=root_directory,
+                     depth=depth) for file_path in data_file_list]
+        nr_jobs = len(jobs)
+        results = {}
+        cache_keys = {}
+
+        # Files in cache are memory-mapped directly in this process
+        if self.cache:
+            for job in jobs:
+                file_path = job['data_file_path']
+                cache_keys[file_path] = self.cache.get_key(file_path,
+                                                           sampling_type=sampling_type,
+                                                           settings_file=settings_file,
+                                                           settings_file_path=settings_file_path,
+                                                           depth=depth)
+                gismo_object = self.cache.get(cache_keys[file_path])
+                if gismo_object is None:
+                    continue
+                results[file_path] = dict(file_path=file_path,
+                                          file_id=gismo_object.file_id,
+                                          gismo_object=gismo_object,
+                                          error=None,
+                                          message='')
+                if progress_callback:
+                    progress_callback(len(results), nr_jobs, file_path)
+            logger.debug(f'{len(results)} of {nr_jobs} files found in file cache')
+
+        jobs_to_parse = [job for job in jobs if job['data_file_path'] not in results]
+        nr_processes = min(self.nr_processes, len(jobs_to_parse))
+        if nr_processes <= 1:
+            for job in jobs_to_parse:
+                result = _load_in_session(self.session, **job)
+                cache_key = cache_keys.get(job['data_file_path'])
+                if self.cache and cache_key and result['file_id']:
+                    self.cache.put(cache_key,
+                                   self.session.get_gismo_object(result['file_id']),
+                                   source_info=_get_source_info(job))
+                results[job['data_file_path']] = result
+                if progress_callback:
+                    progress_callback(len(results), nr_jobs, job['data_file_path'])
+        else:
+            cache_kwargs = None
+            if self.cache:
+                cache_kwargs = dict(directory=self.cache.directory, max_size_mb=self.cache.max_size_mb)
+            with ProcessPoolExecutor(max_workers=nr_processes,
+                                     initializer=_init_worker,
+                                     initargs=(self.session_kwargs, cache_kwargs)) as executor:
+                futures = {executor.submit(_load_in_worker, job, cache_keys.get(job['data_file_path'])): job
+                           for job in jobs_to_parse}
+                try:
+                    for future in as_completed(futures):
+                        job = futures[future]
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            # Typically a crashed worker or an object that could not be pickled
+                            result = dict(file_path=job['data_file_path'],
+                                          file_id=None,
+                                          gismo_object=None,
+                                          error=ERROR_UNKNOWN,
+                                          message=f'{e.__class__.__name__}: {e}')
+                        results[job['data_file_path']] = result
+                        if progress_callback:
+                            progress_callback(len(results), nr_jobs, job['data_file_path'])
+                except BaseException:
+                    # E.g. cancelled from progress_callback. Files not yet started are skipped.
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+            if self.cache:
+                self.cache.evict()
+
+        # Register in the order the files were given so that the session content is deterministic
+        loaded_file_ids = set(self.session.get_file_id_list())
+        for job in jobs:
+            result = results[job['data_file_path']]
+            gismo_object = result.pop('gismo_object', None)
+            # Same as reload=False in GISMOsession.load_file
+            if gismo_object is not None and gismo_object.file_id not in loaded_file_ids:
+                register_gismo_object(self.session, gismo_object, sampling_type)
+            if result['file_id']:
+                _load_jobs[result['file_id']] = dict(job)
+            report.add_result(result)
+        logger.debug(f'Batch load done: {report.nr_loaded} loaded, {report.nr_errors} errors')
+        return report
+
+    def _load_in_session(self, data_file_list, report, progress_callback=None, **kwargs):
+        nr_jobs = len(data_file_list)
+        for nr, file_path in enumerate(data_file_list):
+            job = dict(data_file_path=file_path, **kwargs)
+            result = _load_in_session(self.session, **job)
+            if result['file_id']:
+                _load_jobs[result['file_id']] = job
+            report.add_result(result)
+            if progress_callback:
+                progress_callback(nr + 1, nr_jobs, file_path)
+        logger.debug(f'Batch load done: {report.nr_loaded} loaded, {report.nr_errors} errors')
+        return report
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+LAYER_TRACK = 'track'
+LAYER_UNIQUE_POSITIONS = 'unique_positions'
+LAYER_CENTROID = 'centroid'
+
+# One BackgroundLayerCache per session. See get_background_layer_cache.
+_layer_caches = weakref.WeakKeyDictionary()
+
+
+def get_layer_type(sampling_type):
+    """
+    Returns how files of the given sampling type are drawn as background on the map. None if they are not drawn.
+    :param sampling_type:
+    :return: str or None
+    """
+    sampling_type = sampling_type.lower()
+    if 'ferrybox' in sampling_type:
+        return LAYER_TRACK
+    elif 'physicalchemical' in sampling_type:
+        return LAYER_UNIQUE_POSITIONS
+    elif 'fixed platform' in sampling_type:
+        return LAYER_CENTROID
+    elif 'ctd' in sampling_type:
+        return LAYER_CENTROID
+    return None
+
+
+def get_unique_positions(lat, lon):
+    """
+    Returns the unique (lat, lon) pairs sorted on lat, then lon. Positions with NaN are removed.
+    :return: tuple of arrays
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    valid = ~(np.isnan(lat) | np.isnan(lon))
+    if not np.any(valid):
+        return np.array([]), np.array([])
+    positions = np.unique(np.column_stack([lat[valid], lon[valid]]), axis=0)
+    return positions[:, 0], positions[:, 1]
+
+
+def get_file_geometry(lat, lon, layer_type, track_every=10):
+    """
+    Reduces the positions of a file to what is drawn in the background layer.
+    :param lat:
+    :param lon:
+    :param layer_type: see get_layer_type
+    :param track_every: Only every n:th position of a track is kept
+    :return: tuple of float arrays
+    """
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if layer_type == LAYER_TRACK:
+        return lat[::track_every], lon[::track_every]
+    elif layer_type == LAYER_UNIQUE_POSITIONS:
+        return get_unique_positions(lat, lon)
+    elif layer_type == LAYER_CENTROID:
+        if not len(lat) or np.all(np.isnan(lat)):
+            return np.array([np.nan]), np.array([np.nan])
+        return np.array([np.nanmean(lat)]), np.array([np.nanmean(lon)])
+    return np.array([]), np.array([])
+
+
+class BackgroundLayer(object):
+    """
+    Concatenated positions of all files of one sampling type. file_index tells which file (position in file_id_list)
+    each position belongs to so that a single file can be excluded without rebuilding the layer.
+    """
+    def __init__(self, sampling_type, layer_type, file_id_list, geometries):
+        self.sampling_type = sampling_type
+        self.layer_type = layer_type
+        self.file_id_list = list(file_id_list)
+        lat = [geometries[file_id][0] for file_id in self.file_id_list]
+        lon = [geometries[file_id][1] for file_id in self.file_id_list]
+        sizes = [len(item) for item in lat]
+        self.lat = np.concatenate(lat) if lat else np.array([])
+        self.lon = np.concatenate(lon) if lon else np.array([])
+        self.file_index = np.repeat(np.arange(len(self.file_id_list)), sizes)
+
+    def get_positions(self, exclude_file_id=None):
+        """
+        Returns lat and lon for the layer. Tracks are separated with NaN so that they can be drawn as one line.
+        :param exclude_file_id:
+        :return: tuple of arrays
+        """
+        boolean = np.ones(len(self.lat), dtype=bool)
+        if exclude_file_id in self.file_id_list:
+            boolean = self.file_index != self.file_id_list.index(exclude_file_id)
+        lat = self.lat[boolean]
+        lon = self.lon[boolean]
+        if self.layer_type != LAYER_TRACK or not len(lat):
+            return lat, lon
+        # Insert NaN where a new file starts
+        file_index = self.file_index[boolean]
+        breaks = np.flatnonzero(np.diff(file_index)) + 1
+        return np.insert(lat, breaks, np.nan), np.insert(lon, breaks, np.nan)
+
+
+class BackgroundLayerCache(object):
+    """
+    Background map layers for all files in a session, one per sampling type.
+    The positions of a file are read and reduced once. The layers are only rebuilt when files are added, removed
+    or reloaded.
+    """
+    def __init__(self, track_every=10):
+        self.track_every = track_every
+        self._geometries = {}
+        self._objects = {}
+        self._layers = {}
+        self._state = None
+        self.nr_builds = 0
+        self.nr_hits = 0
+
+    def _get_state(self, session):
+        state = []
+        for sampling_type in session.get_sampling_types():
+            for file_id in session.get_file_id_list(sampling_type=sampling_type):
+                state.append((sampling_type, file_id, id(session.get_gismo_object(file_id))))
+        return tuple(state), self.track_every
+
+    def get_layers(self, session):
+        """
+        Returns the layers for session, rebuilt if the loaded files have changed.
+        :param session:
+        :return: dict {sampling_type: BackgroundLayer}
+        """
+        state = self._get_state(session)
+        if state == self._state:
+            self.nr_hits += 1
+            return self._layers
+
+        files, track_every = state
+        if track_every != (self._state or (None, None))[1]:
+            self._geometries = {}
+            self._objects = {}
+        file_ids_by_sampling_type = {}
+        current_files = set()
+        for sampling_type, file_id, object_id in files:
+            current_files.add(file_id)
+            layer_type = get_layer_type(sampling_type)
+            if layer_type is None:
+                continue
+            file_ids_by_sampling_type.setdefault(sampling_type, []).append(file_id)
+            if file_id in self._geometries and self._objects.get(file_id) == object_id:
+                continue
+            data = session.get_data(file_id, 'lat', 'lon')
+            self._geometries[file_id] = get_file_geometry(data['lat'], data['lon'], layer_type,
+                                                          track_every=track_every)
+            self._objects[file_id] = object_id
+
+        for file_id in [file_id for file_id in self._geometries if file_id not in current_files]:
+            self._geometries.pop(file_id)
+            self._objects.pop(file_id, None)
+
+        self._layers = {sampling_type: BackgroundLayer(sampling_type, get_layer_type(sampling_type),
+                                                       file_id_list, self._geometries)
+                        for sampling_type, file_id_list in file_ids_by_sampling_type.items()}
+        self._state = state
+        self.nr_builds += 1
+        logger.debug(f'Background map layers built for {len(current_files)} files')
+        return self._layers
+
+    def clear(self):
+        self._geometries = {}
+        self._objects = {}
+        self._layers = {}
+        self._state = None
+
+
+def get_background_layer_cache(session):
+    """
+    Returns the BackgroundLayerCache for the given session.
+    :param session: GISMOsession
+    :return: BackgroundLayerCache
+    """
+    cache = _layer_caches.get(session)
+    if cache is None:
+        cache = BackgroundLayerCache()
+        _layer_caches[session] = cache
+    return cache
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import weakref
+import logging
+
+import numpy as np
+from sharkpylib.gismo.exceptions import *
+
+from .flag_index import get_flags_version
+from .flagging import get_time_array
+from .flagging import to_datetime64
+
+logger = logging.getLogger(__name__)
+
+# dist in the compare widget is given in meters
+EARTH_RADIUS_M = 6371000.
+MAX_PAIRS_PER_CHUNK = 2000000
+
+# One MatchIndex per file_id. See get_match_index.
+_match_indices = {}
+
+
+class MatchIndex(object):
+    """
+    Time sorted position data (time, lat, lon and depth) for one file.
+    Time is stored as int64 nanoseconds so that time windows, and the position closest in time to e.g. the mouse
+    pointer, can be found with searchsorted.
+    """
+    def __init__(self, gismo_object):
+        self._gismo_object_ref = weakref.ref(gismo_object)
+        time_array = get_time_array(gismo_object)
+        data = gismo_object.get_data('lat', 'lon')
+        lat = np.asarray(data['lat'], dtype=float)
+        lon = np.asarray(data['lon'], dtype=float)
+        try:
+            depth = np.asarray(gismo_object.get_data('depth')['depth'], dtype=float)
+        except GISMOException:
+            depth = np.full(len(time_array), np.nan)
+
+        # Rows without time can never match
+        valid_rows = np.flatnonzero(~np.isnat(time_array))
+        order = valid_rows[np.argsort(time_array[valid_rows], kind='stable')]
+        self.rows = order
+        self.time = time_array[order].astype('datetime64[ns]').astype(np.int64)
+        self.lat = lat[order]
+        self.lon = lon[order]
+        self.depth = depth[order]
+
+    @property
+    def gismo_object(self):
+        return self._gismo_object_ref()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_nearest_index(self, time_value, max_dt=None):
+        """
+        Returns the index (in the sorted arrays) of the time closest to time_value.
+        :param time_value: datetime, pd.Timestamp or np.datetime64
+        :param max_dt: pd.Timedelta/np.timedelta64. None is returned if no time is closer than this.
+        :return: int or None
+        """
+        if not len(self.time):
+            return None
+        value = to_datetime64(time_value).astype('datetime64[ns]').astype(np.int64)
+        index = int(np.searchsorted(self.time, value))
+        if index == len(self.time):
+            index -= 1
+        elif index > 0 and value - self.time[index-1] <= self.time[index] - value:
+            index -= 1
+        if max_dt is not None and abs(int(self.time[index]) - value) > np.timedelta64(max_dt, 'ns').astype(np.int64):
+            return None
+        return index
+
+    def get_nearest_position(self, time_value, max_dt=None):
+        """
+        Returns lat and lon of the row closest in time to time_value.
+        :param time_value:
+        :param max_dt: see get_nearest_index
+        :return: tuple (lat, lon) or None
+        """
+        index = self.get_nearest_index(time_value, max_dt=max_dt)
+        if index is None:
+            return None
+        return self.lat[index], self.lon[index]
+
+
+def get_match_index(gismo_object):
+    """
+    Returns the MatchIndex for gismo_object. Time and position does not change when flagging so the index is built
+    once per file and only rebuilt if the file is reloaded.
+    :param gismo_object:
+    :return: MatchIndex
+    """
+    index = _match_indices.get(gismo_object.file_id)
+    if index is None or index.gismo_object is not gismo_object:
+        index = MatchIndex(gismo_object)
+        _match_indices[gismo_object.file_id] = index
+    return index
+
+
+def remove_match_index(file_id=None):
+    """
+    :param file_id: all files if None
+    :return:
+    """
+    if file_id is None:
+        _match_indices.clear()
+        return
+    _match_indices.pop(file_id, None)
+
+
+def _get_distance_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def find_matching_rows(index, ref_index, hours, dist=None, depth=None):
+    """
+    Finds the matching row in index for each row in ref_index. As in the match of the GISMOsession a reference row
+    gives at most one match: the row in index closest in time that is within all the limits.
+    Candidates are found with a binary search in the time sorted index (O(log n) per reference row). Only the
+    candidates within the time window are checked for distance and depth, vectorized. There is no spatial index,
+    the time window is the selective limit for the time series and profiles compared here.
+    Missing positions or depths are treated as matching.
+
+    :param index: MatchIndex for the main file
+    :param ref_index: MatchIndex for the reference file
+    :param hours: max time difference
+    :param dist: max distance in meters (great circle)
+    :param depth: max depth difference
+    :return: tuple with row positions in the main file and the reference file, one pair per matched reference row
+    """
+    window = int(float(hours) * 3600 * 1e9)
+    start = np.searchsorted(index.time, ref_index.time - window, side='left')
+    end = np.searchsorted(index.time, ref_index.time + window, side='right')
+    counts = end - start
+
+    rows = []
+    ref_rows = []
+    cum_counts = np.cumsum(counts)
+    chunk_start = 0
+    while chunk_start < len(counts):
+        # Limit the number of pairs handled at the same time
+        offset = cum_counts[chunk_start] - counts[chunk_start]
+        chunk_end = max(np.searchsorted(cum_counts, offset + MAX_PAIRS_PER_CHUNK, side='right'), chunk_start + 1)
+        chunk_counts = counts[chunk_start:chunk_end]
+        nr_pairs = chunk_counts.sum()
+        if nr_pairs:
+            ref_pos = np.repeat(np.arange(chunk_start, chunk_end), chunk_counts)
+            first_pair = np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+            pos = np.repeat(start[chunk_start:chunk_end], chunk_counts) + np.arange(nr_pairs) - first_pair
+
+            keep = np.ones(nr_pairs, dtype=bool)
+            if dist is not None:
+                distance = _get_distance_m(index.lat[pos], index.lon[pos],
+                                            ref_index.lat[ref_pos], ref_index.lon[ref_pos])
+                keep &= ~(distance > float(dist))
+            if depth is not None:
+                keep &= ~(np.abs(index.depth[pos] - ref_index.depth[ref_pos]) > float(depth))
+            pos = pos[keep]
+            ref_pos = ref_pos[keep]
+            # Closest in time per reference row. Pairs are grouped by ref_pos, the earliest row wins a tie.
+            dt = np.abs(index.time[pos] - ref_index.time[ref_pos])
+            order = np.lexsort((dt, ref_pos))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = ref_pos[order][1:] != ref_pos[order][:-1]
+            rows.append(index.rows[pos[order[first]]])
+            ref_rows.append(ref_index.rows[ref_pos[order[first]]])
+        chunk_start = chunk_end
+
+    if not rows:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    return np.concatenate(rows), np.concatenate(ref_rows)
+
+
+class MatchCache(object):
+    """
+    Matches two files in a GISMOsession with the time sorted MatchIndex.
+    The matching rows are cached and only found again when the match limits (hours, dist, depth) are changed or when
+    one of the files has been flagged or reloaded. session.match_files is only called (match_session_files) for
+    the views that need the match object or the merge data of the session, e.g. when the merge data is saved.
+    """
+    def __init__(self):
+        self._results = {}
+        self._session_state = {}
+        self.nr_hits = 0
+        self.nr_matches = 0
+
+    def _get_state(self, session, file_id, ref_file_id, hours, dist, depth):
+        return (hours, dist, depth,
+                get_flags_version(session.get_gismo_object(file_id)),
+                get_flags_version(session.get_gismo_object(ref_file_id)))
+
+    def get_matching_rows(self, session, file_id, ref_file_id, hours=None, dist=None, depth=None):
+        """
+        Returns the (cached) row positions of the matching data.
+        :return: tuple with row positions in the main file and the reference file
+        """
+        key = (file_id, ref_file_id, hours, dist, depth)
+        state = self._get_state(session, *key)
+        cached = self._results.get(key)
+        if cached and cached[0] == state:
+            self.nr_hits += 1
+            return cached[1]
+        result = find_matching_rows(get_match_index(session.get_gismo_object(file_id)),
+                                    get_match_index(session.get_gismo_object(ref_file_id)),
+                                    hours, dist=dist, depth=depth)
+        self._results[key] = (state, result)
+        self.nr_matches += 1
+        return result
+
+    def match_files(self, session, file_id, ref_file_id, hours=None, dist=None, depth=None):
+        """
+        Finds the matching rows. session.match_files is not called.
+        :return: False if there are no matching rows
+        """
+        rows, ref_rows = self.get_matching_rows(session, file_id, ref_file_id, hours=hours, dist=dist, depth=depth)
+        if not len(rows):
+            logger.debug(f'No matching rows for {(file_id, ref_file_id, hours, dist, depth)}')
+            return False
+        return True
+
+    def match_session_files(self, session, file_id, ref_file_id, hours=None, dist=None, depth=None):
+        """
+        Same as session.match_files but only called when needed. Use when the match object or merge data of the
+        session is needed.
+        :return: False if there are no matching rows (session.match_files is then not called)
+        """
+        key = (file_id, ref_file_id, hours, dist, depth)
+        state = self._get_state(session, *key)
+        if self._session_state.get((file_id, ref_file_id)) == state:
+            return True
+        if not self.match_files(session, *key):
+            return False
+        session.match_files(file_id, ref_file_id, hours=hours, dist=dist, depth=depth)
+        self._session_state[(file_id, ref_file_id)] = state
+        return True
+
+    def invalidate(self, file_id=None):
+        """
+        Removes everything cached for file_id (all files if None). Flagging and reloading is detected
+        automatically, use this e.g. when a file is removed.
+        :param file_id:
+        :return:
+        """
+        remove_match_index(file_id)
+        if file_id is None:
+            self._results = {}
+            self._session_state = {}
+            return
+        for key in [key for key in self._results if file_id in key[:2]]:
+            self._results.pop(key)
+        for key in [key for key in self._session_state if file_id in key]:
+            self._session_state.pop(key)
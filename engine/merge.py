@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import numpy as np
+import pandas as pd
+
+from .flag_index import get_flag_index
+from .flagging import get_time_array
+
+
+def to_float_array(series):
+    """
+    Converts a column in a merge dataframe (often strings) to a float64 array. Empty or invalid values are NaN.
+    :param series: pd.Series
+    :return: np.ndarray
+    """
+    return pd.to_numeric(series, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+
+def get_float_data(gismo_object, par):
+    """
+    Returns par in gismo_object as a float64 array. Empty or invalid values are NaN.
+    :param gismo_object:
+    :param par:
+    :return: np.ndarray
+    """
+    return to_float_array(pd.Series(np.asarray(gismo_object.get_data(par)[par])))
+
+
+def build_match_data(gismo_object, par, rows, values, flags):
+    """
+    Splits matched data in flags (the flag of par in gismo_object) in one pass.
+    The rows are grouped by a per-row flag code from the flag index with one sort.
+
+    :param gismo_object: the main gismo object
+    :param par: parameter in gismo_object that holds the flags
+    :param rows: row positions in gismo_object, one per matched pair (see engine.MatchCache.get_matching_rows)
+    :param values: dict with key and float array (one value per matched pair). Ex: {'x': main, 'y': compare}
+    :param flags: flags to include
+    :return: tuple (dict {flag: {key: float64 array}}, time array of the matched rows in gismo_object)
+    """
+    rows = np.asarray(rows, dtype=int)
+
+    # Flag code per row in gismo_object: position in flags, -1 if the flag is not included
+    flag_index = get_flag_index(gismo_object)
+    time_array = get_time_array(gismo_object)
+    row_codes = np.full(len(time_array), -1, dtype=int)
+    for code, flag in enumerate(flags):
+        row_codes[flag_index.get_positions(par, flag)] = code
+    match_codes = row_codes[rows]
+
+    order = np.argsort(match_codes, kind='stable')
+    counts = np.bincount(match_codes + 1, minlength=len(flags) + 1)
+    groups = np.split(order, np.cumsum(counts)[:-1])[1:]
+
+    data = {}
+    for flag, group in zip(flags, groups):
+        data[flag] = {key: np.asarray(array)[group] for key, array in values.items()}
+    return data, time_array[rows]
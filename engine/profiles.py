@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import collections
+import logging
+
+import numpy as np
+import pandas as pd
+
+from .flag_index import get_column_version
+from .flag_index import get_flag_index
+
+logger = logging.getLogger(__name__)
+
+
+def _to_float(array):
+    return pd.to_numeric(pd.Series(np.asarray(array)), errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+
+
+def get_profile_by_flag(gismo_object, par, flags):
+    """
+    Returns the values of par and the (negative) depth split by flag.
+    :param gismo_object:
+    :param par:
+    :param flags: list of flags
+    :return: dict {flag: (value array, depth array)}
+    """
+    data = gismo_object.get_data('depth', par)
+    par_array = _to_float(data[par])
+    depth_array = -_to_float(data['depth'])
+    flag_positions = get_flag_index(gismo_object).get_flag_positions(par, flags)
+    return {flag: (par_array[positions], depth_array[positions]) for flag, positions in flag_positions.items()}
+
+
+class ProfileBackgroundCache(object):
+    """
+    Background profiles for the profile plot. All profiles are concatenated per flag so that each flag can be
+    drawn as a single artist instead of one per file and flag.
+    The data of each file is cached and only read again when the flags of the parameter in that file are changed
+    (or the file is reloaded). The concatenated arrays are cached per (files, parameter, flags).
+    """
+    def __init__(self, max_combined=8):
+        """
+        :param max_combined: Number of concatenated results kept.
+        """
+        self.max_combined = max_combined
+        self._files = {}
+        self._combined = collections.OrderedDict()
+        self.nr_file_reads = 0
+        self.nr_hits = 0
+
+    def _get_file_profile(self, gismo_object, par, flags):
+        key = (gismo_object.file_id, par, flags)
+        version = get_column_version(gismo_object, par)
+        cached = self._files.get(key)
+        if cached is not None and cached[0] == version:
+            return version, cached[1]
+        profile = get_profile_by_flag(gismo_object, par, list(flags))
+        self._files[key] = (version, profile)
+        self.nr_file_reads += 1
+        return version, profile
+
+    def get_profiles(self, gismo_objects, par, flags):
+        """
+        Returns the concatenated profiles of gismo_objects.
+        :param gismo_objects: list of gismo objects
+        :param par:
+        :param flags: list of flags
+        :return: dict {flag: (value array, depth array)}
+        """
+        flags = tuple(flags)
+        key = (tuple(gismo_object.file_id for gismo_object in gismo_objects), par, flags)
+        state = tuple(get_column_version(gismo_object, par) for gismo_object in gismo_objects)
+        cached = self._combined.get(key)
+        if cached is not None and cached[0] == state:
+            self._combined.move_to_end(key)
+            self.nr_hits += 1
+            return cached[1]
+
+        profiles = [self._get_file_profile(gismo_object, par, flags)[1] for gismo_object in gismo_objects]
+        combined = {}
+        for flag in flags:
+            values = [profile[flag][0] for profile in profiles]
+            depths = [profile[flag][1] for profile in profiles]
+            combined[flag] = (np.concatenate(values) if values else np.array([]),
+                              np.concatenate(depths) if depths else np.array([]))
+        self._combined[key] = (state, combined)
+        self._combined.move_to_end(key)
+        while len(self._combined) > self.max_combined:
+            self._combined.popitem(last=False)
+        self._remove_unused_files()
+        return combined
+
+    def _remove_unused_files(self):
+        used = set()
+        for file_id_list, par, flags in self._combined:
+            used.update((file_id, par, flags) for file_id in file_id_list)
+        for key in [key for key in self._files if key not in used]:
+            self._files.pop(key)
+
+    def clear(self):
+        self._files = {}
+        self._combined = collections.OrderedDict()
+
+
+_profile_background_cache = ProfileBackgroundCache()
+
+
+def get_profile_background_cache():
+    return _profile_background_cache
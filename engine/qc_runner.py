@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import os
+import logging
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from sharkpylib.gismo.exceptions import *
+
+from . import loader
+
+logger = logging.getLogger(__name__)
+
+
+class QCReport(object):
+    """
+    Result of ParallelQCRunner.run. Timing per qc routine is summed over all calls to run_automatic_qc.
+    file_timing is the time of the call that checked the file. Files checked in the same call share the time.
+    """
+    def __init__(self, file_id_list):
+        self.file_id_list = list(file_id_list)
+        self.qc_routines = []
+        self.errors = []
+        self.failures = []
+        self.stopped = False
+        self.timing = {}
+        self.file_timing = {}
+
+    def add_error(self, qc_routine, exception, tb=None):
+        """
+        Errors that stops the qc routine for all files (e.g. the routine can not be imported).
+        """
+        if tb is None:
+            tb = traceback.format_exc()
+        self.errors.append((qc_routine, exception, tb))
+
+    def add_failure(self, qc_routine, file_id, message):
+        """
+        Errors for a single file. The other files are still checked.
+        """
+        self.failures.append((qc_routine, file_id, message))
+
+    def get_errors(self, exception_class):
+        return [(qc_routine, e, tb) for qc_routine, e, tb in self.errors if isinstance(e, exception_class)]
+
+    def get_routine_errors(self, qc_routine):
+        return [(name, e, tb) for name, e, tb in self.errors if name == qc_routine]
+
+    @property
+    def nr_failures(self):
+        return len(self.failures)
+
+    def get_failure_summary(self, max_files=10):
+        """
+        Returns a text describing the files that failed, grouped by qc routine.
+        :param max_files: max number of files listed per qc routine
+        :return: str
+        """
+        by_routine = {}
+        for qc_routine, file_id, message in self.failures:
+            by_routine.setdefault(qc_routine, []).append((file_id, message))
+        lines = []
+        for qc_routine, items in by_routine.items():
+            lines.append(f'{qc_routine} failed for {len(items)} file(s):')
+            for file_id, message in items[:max_files]:
+                lines.append(f'    {file_id}: {message}')
+            if len(items) > max_files:
+                lines.append(f'    ...and {len(items) - max_files} more')
+        return '\n'.join(lines)
+
+
+def _get_changed_columns(df_before, df_after):
+    """
+    Returns the columns in df_after that are new or changed compared to df_before.
+    :return: dict {column: np.ndarray}
+    """
+    changed = {}
+    for col in df_after.columns:
+        values = df_after[col].values
+        if col not in df_before.columns:
+            changed[col] = values
+            continue
+        before = df_before[col].values
+        if len(before) != len(values):
+            changed[col] = values
+            continue
+        equal = before == values
+        if values.dtype.kind == 'f':
+            equal |= np.isnan(before) & np.isnan(values)
+        if not np.all(equal):
+            changed[col] = values
+    return changed
+
+
+def _run_routines(session, file_id_list, routine_options):
+    """
+    Runs the qc routines in the given order. Each routine is run once on file_id_list, as in
+    GISMOsession.run_automatic_qc, so routines that work across files see all of them. If a routine fails for the
+    list it is run again file by file to find the files that fails.
+    Errors that are the same for all files are returned in "error". Missing input arguments stops the run.
+    :param session: GISMOsession
+    :param file_id_list:
+    :param routine_options: list of (qc_routine, options)
+    :return: list of dict, one per qc routine run
+    """
+    results = []
+    for qc_routine, options in routine_options:
+        result = dict(qc_routine=qc_routine, error=None, message='', file_timing={}, failures={})
+        t0 = time.time()
+        try:
+            session.run_automatic_qc(file_id=list(file_id_list), qc_routine=qc_routine, **options)
+            duration = time.time() - t0
+            result['file_timing'] = {file_id: duration for file_id in file_id_list}
+        except (ImportError, GISMOExceptionMissingInputArgument) as e:
+            result['error'] = e
+            result['message'] = traceback.format_exc()
+        except Exception:
+            for file_id in file_id_list:
+                t_file = time.time()
+                try:
+                    session.run_automatic_qc(file_id=[file_id], qc_routine=qc_routine, **options)
+                except Exception as e:
+                    result['failures'][file_id] = f'{e.__class__.__name__}: {e}'
+                finally:
+                    result['file_timing'][file_id] = time.time() - t_file
+        result['duration'] = time.time() - t0
+        results.append(result)
+        if isinstance(result['error'], GISMOExceptionMissingInputArgument):
+            break
+    return results
+
+
+def _qc_in_worker(jobs, routine_options):
+    """
+    Runs in a worker process. Loads the files of one shard with session.load_file (same as the GUI, so the settings
+    file of the sampling type is loaded), applies the flags set in the main session since the files were loaded and
+    runs all qc routines on the shard. Returns the columns changed by the qc for each file.
+    :param jobs: list of dict with file_id, df (the data in the main session) and load (see loader.get_load_job)
+    :param routine_options: list of (qc_routine, options)
+    :return: dict
+    """
+    session = loader._worker_session
+    result = dict(routines=[], columns={}, failures={})
+    dfs = {}
+    for job in jobs:
+        file_id = job['file_id']
+        load_result = loader._load_in_session(session, **job['load'])
+        if load_result['error']:
+            result['failures'][file_id] = f'Could not load file in worker: {load_result["message"]}'
+            continue
+        if load_result['file_id'] != file_id:
+            result['failures'][file_id] = f'File loaded as {load_result["file_id"]} in worker'
+            session.remove_file(load_result['file_id'])
+            continue
+        df = session.get_gismo_object(file_id).df
+        if len(df) != len(job['df']):
+            result['failures'][file_id] = 'The file has changed since it was loaded'
+            session.remove_file(file_id)
+            continue
+        # Flags set in the main session since the file was loaded
+        for col, values in _get_changed_columns(df, job['df']).items():
+            df[col] = values
+        dfs[file_id] = job['df']
+
+    file_id_list = [job['file_id'] for job in jobs if job['file_id'] in dfs]
+    try:
+        if file_id_list:
+            result['routines'] = _run_routines(session, file_id_list, routine_options)
+        for file_id in file_id_list:
+            result['columns'][file_id] = _get_changed_columns(dfs[file_id], session.get_gismo_object(file_id).df)
+    finally:
+        for file_id in file_id_list:
+            session.remove_file(file_id)
+    return result
+
+
+class ParallelQCRunner(object):
+    """
+    Runs automatic qc with the files split in shards across a process pool. Each shard is sent to a worker process
+    once and every qc routine is run on the whole shard in the given order, since a routine might use the flags set
+    by the previous one. The worker loads the files with session.load_file and the same settings file as in the main
+    session. The changed columns are merged back into the gismo objects in the session in the order of
+    file_id_list, so the result does not depend on which worker finishes first.
+    Files that can not be loaded in a worker (not loaded by loader.BatchLoader or not held in a dataframe) are
+    checked in the session.
+    A file that fails is added to the failure list of the report and the other files are still checked.
+    """
+    def __init__(self, session, session_kwargs=None, nr_processes=None):
+        """
+        :param session: GISMOsession holding the files
+        :param session_kwargs: Used to create a session in each worker process. See loader.create_session.
+        :param nr_processes: Number of worker processes. The qc is run in the session if 1.
+        """
+        self.session = session
+        self.session_kwargs = session_kwargs or {}
+        self.nr_processes = nr_processes or os.cpu_count() or 1
+
+    def run(self, file_id_list, routine_options, cancel_token=None, progress_callback=None):
+        """
+        :param file_id_list:
+        :param routine_options: list of (qc_routine, options)
+        :param cancel_token: engine.tasks.CancelToken
+        :param progress_callback: called with (nr_done, nr_files, file_id) when files are checked
+        :return: QCReport
+        """
+        file_id_list = list(file_id_list)
+        routine_options = list(routine_options)
+        report = QCReport(file_id_list)
+        worker_file_ids = []
+        session_file_ids = []
+        if self.nr_processes > 1:
+            for file_id in file_id_list:
+                if loader.get_load_job(file_id) and hasattr(self.session.get_gismo_object(file_id), 'df'):
+                    worker_file_ids.append(file_id)
+                else:
+                    session_file_ids.append(file_id)
+        else:
+            session_file_ids = file_id_list
+        nr_processes = min(self.nr_processes, len(worker_file_ids))
+        if nr_processes <= 1:
+            session_file_ids, worker_file_ids = file_id_list, []
+
+        progress = _Progress(len(file_id_list), progress_callback)
+        if worker_file_ids:
+            with ProcessPoolExecutor(max_workers=nr_processes,
+                                     initializer=loader._init_worker,
+                                     initargs=(self.session_kwargs,)) as executor:
+                try:
+                    self._run_in_workers(executor, nr_processes, report, worker_file_ids, routine_options,
+                                         cancel_token, progress)
+                except BaseException:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+        if session_file_ids and not report.stopped:
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            self._add_routine_results(report, _run_routines(self.session, session_file_ids, routine_options))
+            progress.add(session_file_ids)
+        report.qc_routines = [qc_routine for qc_routine, options in routine_options
+                              if qc_routine in report.timing and not report.get_routine_errors(qc_routine)]
+        return report
+
+    def _run_in_workers(self, executor, nr_processes, report, file_id_list, routine_options, cancel_token, progress):
+        # Contiguous shards so that files next to each other in the list are checked together
+        shards = [list(shard) for shard in np.array_split(np.array(file_id_list, dtype=object), nr_processes)]
+        futures = {}
+        for shard in shards:
+            jobs = [dict(file_id=file_id,
+                         df=self.session.get_gismo_object(file_id).df,
+                         load=loader.get_load_job(file_id)) for file_id in shard]
+            futures[executor.submit(_qc_in_worker, jobs, routine_options)] = shard
+
+        results = {}
+        for future in as_completed(futures):
+            shard = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # Typically a crashed worker or data that could not be pickled
+                message = f'{e.__class__.__name__}: {e}'
+                result = dict(routines=[], columns={}, failures={file_id: message for file_id in shard})
+            results[shard[0]] = result
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            progress.add(shard)
+            if any(isinstance(item['error'], GISMOExceptionMissingInputArgument) for item in result['routines']):
+                # Same for all files
+                for other in futures:
+                    other.cancel()
+                break
+
+        # Merge in the given file order
+        for shard in shards:
+            result = results.get(shard[0])
+            if result is None:
+                continue
+            self._add_routine_results(report, result['routines'])
+            for file_id in shard:
+                if file_id in result['failures']:
+                    report.add_failure(', '.join(qc_routine for qc_routine, options in routine_options),
+                                       file_id, result['failures'][file_id])
+                    continue
+                df = self.session.get_gismo_object(file_id).df
+                for col, values in result['columns'].get(file_id, {}).items():
+                    df[col] = values
+
+    @staticmethod
+    def _add_routine_results(report, routine_results):
+        for result in routine_results:
+            qc_routine = result['qc_routine']
+            report.timing[qc_routine] = report.timing.get(qc_routine, 0) + result['duration']
+            for file_id, duration in result['file_timing'].items():
+                report.file_timing[(qc_routine, file_id)] = duration
+            if result['error'] is not None:
+                if not report.get_routine_errors(qc_routine):
+                    # Same error for all files
+                    report.add_error(qc_routine, result['error'], tb=result['message'])
+                if isinstance(result['error'], GISMOExceptionMissingInputArgument):
+                    report.stopped = True
+            for file_id, message in result['failures'].items():
+                report.add_failure(qc_routine, file_id, message)
+
+
+class _Progress(object):
+    def __init__(self, nr_files, callback):
+        self.nr_files = nr_files
+        self.nr_done = 0
+        self.callback = callback
+
+    def add(self, file_id_list):
+        for file_id in file_id_list:
+            self.nr_done += 1
+            if self.callback:
+                self.callback(self.nr_done, self.nr_files, file_id)
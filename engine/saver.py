@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import contextlib
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .incremental import clear_dirty_rows
+from .incremental import index_loaded_file
+from .incremental import save_qf_columns
+
+logger = logging.getLogger(__name__)
+
+
+def get_temp_file_path(file_path):
+    """
+    Returns a unique temporary file path in the same directory as file_path.
+    The temporary file must be on the same file system as file_path for os.replace to be atomic.
+    :param file_path:
+    :return: str
+    """
+    directory, file_name = os.path.split(os.path.abspath(file_path))
+    # The extension is kept in case the writer depends on it
+    name, ext = os.path.splitext(file_name)
+    return os.path.join(directory, f'.{name}.{os.getpid()}-{threading.get_ident()}.tmp{ext}')
+
+
+def fsync_file(file_path):
+    with open(file_path, 'rb') as fid:
+        os.fsync(fid.fileno())
+
+
+def fsync_directory(directory):
+    """
+    Makes a rename in directory durable. Not possible (nor needed) on Windows.
+    """
+    if os.name == 'nt':
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_file_mode(source_path, target_path):
+    """
+    Gives target_path the permission bits of source_path (if it exists).
+    """
+    if not os.path.exists(source_path):
+        return
+    try:
+        shutil.copymode(source_path, target_path)
+    except OSError as e:
+        logger.debug(f'Could not copy file mode of {source_path}: {e}')
+
+
+def save_file_atomic(session, file_id, file_path, user='unknown user', fsync=False, incremental=False,
+                     session_lock=None):
+    """
+    Saves file_id to file_path. The file is written to a temporary file in the same directory that then replaces
+    file_path with os.replace. file_path is therefore never missing or half written, even if the save is
+    interrupted. The permissions of an existing file_path are kept.
+    :param session: GISMOsession
+    :param file_id:
+    :param file_path:
+    :param user:
+    :param fsync: If True the file (and the directory entry) is flushed to disk before returning.
+    :param incremental: If True only the QF fields of rows with changed flags are rewritten in a copy of the
+                        original file when possible (see incremental.save_qf_columns). Otherwise a full save is made.
+                        Files with metadata lines are always fully saved so that user and qc metadata are written.
+    :param session_lock: Held while the session is used. GISMOsession is not thread safe so this must be given
+                         if several files are saved concurrently.
+    :return: True if the file was saved incrementally
+    """
+    session_lock = session_lock or contextlib.nullcontext()
+    directory = os.path.dirname(os.path.abspath(file_path))
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    temp_file_path = get_temp_file_path(file_path)
+    saved_incremental = False
+    try:
+        with session_lock:
+            original_file_path = session.get_file_path(file_id)
+            if incremental:
+                saved_incremental = save_qf_columns(session, file_id, temp_file_path)
+            if not saved_incremental:
+                session.save_file(file_id, file_path=temp_file_path, overwrite=True, user=user)
+        # Only the file system is used from here on
+        copy_file_mode(file_path, temp_file_path)
+        if fsync:
+            fsync_file(temp_file_path)
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+    if fsync:
+        fsync_directory(directory)
+    is_original = bool(original_file_path) and \
+        os.path.normcase(os.path.abspath(original_file_path)) == os.path.normcase(os.path.abspath(file_path))
+    if is_original:
+        # The original file is now in line with the data
+        with session_lock:
+            if incremental:
+                index_loaded_file(session, file_id)
+            else:
+                clear_dirty_rows(file_id)
+    return saved_incremental
+
+
+class SaveReport(object):
+    """
+    Result of FileSaver.save. One entry per file_id.
+    """
+    def __init__(self, file_path_mapping):
+        self.file_path_mapping = dict(file_path_mapping)
+        self.saved = []
+        self.saved_incremental = []
+        self.errors = {}
+        self.file_timing = {}
+        self.duration = 0
+
+    @property
+    def nr_saved(self):
+        return len(self.saved)
+
+    @property
+    def nr_errors(self):
+        return len(self.errors)
+
+    def get_summary(self, max_files=10):
+        """
+        Returns a text summary of the save suitable for a popup.
+        :param max_files: max number of failed files listed
+        :return: str
+        """
+        lines = [f'{self.nr_saved} file(s) saved']
+        if self.errors:
+            lines[0] += f', {self.nr_errors} file(s) could not be saved:'
+            for file_id, message in sorted(self.errors.items())[:max_files]:
+                lines.append(f'    {file_id}: {message}')
+            if self.nr_errors > max_files:
+                lines.append(f'    ...and {self.nr_errors - max_files} more')
+        return '\n'.join(lines)
+
+
+class FileSaver(object):
+    """
+    Saves several files with save_file_atomic. The data is written from the session one file at a time (the
+    session is not thread safe) while flushing to disk and replacing the files is done concurrently in a
+    thread pool. Several workers therefore mainly pays off with fsync=True or on slow (network) disks.
+    A file that fails is added to the errors of the report and the other files are still saved.
+    """
+    def __init__(self, session, nr_workers=4, fsync=False, incremental=False):
+        """
+        :param session: GISMOsession holding the files
+        :param nr_workers: Number of threads. Files are saved one by one in the calling thread if 1.
+        :param fsync: See save_file_atomic
+        :param incremental: See save_file_atomic
+        """
+        self.session = session
+        self.nr_workers = nr_workers or 1
+        self.fsync = fsync
+        self.incremental = incremental
+        self._session_lock = threading.Lock()
+
+    def _save(self, file_id, file_path, user):
+        t0 = time.time()
+        saved_incremental = save_file_atomic(self.session, file_id, file_path, user=user,
+                                             fsync=self.fsync, incremental=self.incremental,
+                                             session_lock=self._session_lock)
+        return time.time() - t0, saved_incremental
+
+    def save(self, file_path_mapping, user='unknown user', cancel_token=None, progress_callback=None):
+        """
+        :param file_path_mapping: dict with file_id as key and the path to save to as value
+        :param user:
+        :param cancel_token: engine.tasks.CancelToken. Files already saved are kept if cancelled.
+        :param progress_callback: called with (nr_done, nr_files, file_id) after each file
+        :return: SaveReport
+        """
+        report = SaveReport(file_path_mapping)
+        nr_files = len(file_path_mapping)
+        t0 = time.time()
+
+        def add_result(file_id, function):
+            try:
+                report.file_timing[file_id], saved_incremental = function()
+                report.saved.append(file_id)
+                if saved_incremental:
+                    report.saved_incremental.append(file_id)
+            except Exception as e:
+                logger.error(f'Could not save {file_id}: {e}')
+                report.errors[file_id] = f'{e.__class__.__name__}: {e}'
+            if progress_callback:
+                progress_callback(len(report.saved) + len(report.errors), nr_files, file_id)
+
+        nr_workers = min(self.nr_workers, nr_files)
+        if nr_workers <= 1:
+            for file_id, file_path in file_path_mapping.items():
+                if cancel_token:
+                    cancel_token.raise_if_cancelled()
+                add_result(file_id, lambda: self._save(file_id, file_path, user))
+        else:
+            with ThreadPoolExecutor(max_workers=nr_workers) as executor:
+                futures = {executor.submit(self._save, file_id, file_path, user): file_id
+                           for file_id, file_path in file_path_mapping.items()}
+                try:
+                    for future in as_completed(futures):
+                        add_result(futures[future], future.result)
+                        if cancel_token:
+                            cancel_token.raise_if_cancelled()
+                except BaseException:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+        report.duration = time.time() - t0
+        logger.debug(f'{report.nr_saved} files ({len(report.saved_incremental)} incremental) saved in '
+                     f'{report.duration:.2f} s using {nr_workers} thread(s)')
+        return report
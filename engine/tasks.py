@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class CancelToken(object):
+    """
+    Available to the running function as task.cancel_token if the task is submitted with pass_task=True.
+    Long running functions should call raise_if_cancelled() between steps.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def is_cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise TaskCancelled
+
+
+class Task(object):
+    """
+    One submitted function. Status, result and timing are set by the TaskExecutor.
+    """
+    def __init__(self, task_id, name, group=None, on_done=None, on_error=None, on_progress=None):
+        self.task_id = task_id
+        self.name = name
+        self.group = group
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.cancel_token = CancelToken()
+        self.status = STATUS_QUEUED
+        self.result = None
+        self.exception = None
+        self.time_submitted = time.time()
+        self.time_started = None
+        self.time_finished = None
+        self._queue = None
+
+    def __repr__(self):
+        return f'Task({self.task_id}, {self.name}, {self.status})'
+
+    @property
+    def is_active(self):
+        return self.status in [STATUS_QUEUED, STATUS_RUNNING]
+
+    @property
+    def duration(self):
+        if not self.time_started:
+            return None
+        return (self.time_finished or time.time()) - self.time_started
+
+    def cancel(self):
+        self.cancel_token.cancel()
+
+    def report_progress(self, *args, **kwargs):
+        """
+        Can be called from the running function. on_progress is called with the given arguments in the UI thread.
+        """
+        self.cancel_token.raise_if_cancelled()
+        if self.on_progress and self._queue is not None:
+            self._queue.put((self, 'progress', (args, kwargs)))
+
+
+class TaskExecutor(object):
+    """
+    Runs heavy functions in a pool of worker threads. Results are put on a thread safe queue that is polled
+    from the Tk main loop with after(). All callbacks (on_done, on_error, on_progress) are therefore called in the
+    UI thread and are free to update widgets.
+    Tasks in the same group (e.g. "session") are run one at a time since GISMOsession is not thread safe.
+    """
+    def __init__(self, nr_workers=2, poll_interval=50):
+        """
+        :param nr_workers: Number of worker threads
+        :param poll_interval: Milliseconds between polls of the result queue
+        """
+        self.nr_workers = nr_workers
+        self.poll_interval = poll_interval
+        self._pool = ThreadPoolExecutor(max_workers=nr_workers, thread_name_prefix='qc_sensors_task')
+        self._queue = queue.Queue()
+        self._group_locks = {}
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self._widget = None
+        self._after_id = None
+        self.tasks = {}
+        self.busy_callbacks = []
+
+    def attach(self, widget):
+        """
+        Starts polling the result queue from the main loop of the given tk widget.
+        :param widget:
+        :return:
+        """
+        self._widget = widget
+        self._schedule_poll()
+
+    def _schedule_poll(self):
+        if self._widget is None:
+            return
+        self._after_id = self._widget.after(self.poll_interval, self._poll)
+
+    def _get_group_lock(self, group):
+        with self._lock:
+            if group not in self._group_locks:
+                self._group_locks[group] = threading.Lock()
+            return self._group_locks[group]
+
+    def submit(self, name, function, *args, group=None, on_done=None, on_error=None, on_progress=None,
+               pass_task=False, **kwargs):
+        """
+        Runs function(*args, **kwargs) in a worker thread.
+        :param name: Description of the task, used in the registry and in logs
+        :param function:
+        :param group: Tasks with the same group are run one at a time in the order they are submitted
+        :param on_done: Called with the result in the UI thread
+        :param on_error: Called with the exception in the UI thread. TaskCancelled is given if the task is cancelled.
+        :param on_progress: Called in the UI thread with the arguments given to task.report_progress
+        :param pass_task: If True the task is passed to function as keyword argument task
+        :return: Task
+        """
+        task = Task(next(self._counter), name, group=group, on_done=on_done, on_error=on_error,
+                    on_progress=on_progress)
+        task._queue = self._queue
+        if pass_task:
+            kwargs['task'] = task
+        self.tasks[task.task_id] = task
+        self._pool.submit(self._run, task, function, args, kwargs)
+        self._on_busy_changed()
+        return task
+
+    def _run(self, task, function, args, kwargs):
+        lock = self._get_group_lock(task.group) if task.group else None
+        try:
+            if lock:
+                lock.acquire()
+            task.cancel_token.raise_if_cancelled()
+            task.status = STATUS_RUNNING
+            task.time_started = time.time()
+            result = function(*args, **kwargs)
+            self._queue.put((task, STATUS_DONE, result))
+        except TaskCancelled as e:
+            self._queue.put((task, STATUS_CANCELLED, e))
+        except Exception as e:
+            logger.exception(f'Task "{task.name}" failed')
+            self._queue.put((task, STATUS_FAILED, e))
+        finally:
+            task.time_finished = time.time()
+            if lock:
+                lock.release()
+        if self._widget is None:
+            # Not attached to a main loop, callbacks are run in the worker thread
+            self.poll()
+
+    def poll(self):
+        """
+        Handles all finished tasks and progress reports in the queue. Called from the main loop.
+        :return:
+        """
+        while True:
+            try:
+                task, status, value = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if status == 'progress':
+                args, kwargs = value
+                self._call(task.on_progress, *args, **kwargs)
+                continue
+            task.status = status
+            if status == STATUS_DONE:
+                task.result = value
+                logger.debug(f'Task "{task.name}" done in {task.duration:.2f} s')
+                self._call(task.on_done, value)
+            else:
+                task.exception = value
+                self._call(task.on_error, value)
+            self.tasks.pop(task.task_id, None)
+            self._on_busy_changed()
+
+    def _poll(self):
+        try:
+            self.poll()
+        finally:
+            self._schedule_poll()
+
+    def _call(self, callback, *args, **kwargs):
+        if not callback:
+            return
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            logger.exception('Exception in task callback')
+
+    def _on_busy_changed(self):
+        for callback in self.busy_callbacks:
+            self._call(callback, self.is_busy())
+
+    def get_active_tasks(self, name=None, group=None):
+        """
+        Returns the tasks that are queued or running.
+        :param name:
+        :param group:
+        :return: list of Task
+        """
+        return [task for task in list(self.tasks.values()) if task.is_active and
+                (name is None or task.name == name) and
+                (group is None or task.group == group)]
+
+    def is_busy(self, name=None, group=None):
+        return bool(self.get_active_tasks(name=name, group=group))
+
+    def cancel(self, name=None, group=None):
+        """
+        Cancels the active tasks matching name and group (all tasks if both are None).
+        A running function is stopped the next time it checks its cancel token.
+        :return: number of cancelled tasks
+        """
+        tasks = self.get_active_tasks(name=name, group=group)
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
+
+    def shutdown(self, cancel=True):
+        if cancel:
+            self.cancel()
+        if self._widget is not None and self._after_id is not None:
+            try:
+                self._widget.after_cancel(self._after_id)
+            except Exception:
+                pass
+        self._widget = None
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+"""
+Level gated tracing used instead of print in the gui modules. Tracing is off by default and then a call costs one
+level check. Field values that are functions (e.g. lambdas) are only called when the event is emitted, so expensive debug payloads
+(e.g. array statistics) are never computed when tracing is off:
+
+    tracer = get_tracer(__name__)
+    tracer.debug('plot_updated', par=par, values=lambda: array_summary(values))
+
+Tracing is only for the opt-in debug trace. Warnings and errors are logged with logging (e.g. self.logger in the
+app) so that they are not lost when tracing is off.
+"""
+
+import os
+import types
+import logging
+
+import numpy as np
+
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+OFF = logging.CRITICAL + 10
+
+LEVELS = {'OFF': OFF,
+          'ERROR': logging.ERROR,
+          'WARNING': logging.WARNING,
+          'INFO': logging.INFO,
+          'DEBUG': logging.DEBUG,
+          'TRACE': TRACE}
+
+ROOT_NAME = 'qc_sensors'
+
+# Overrides the level given to configure, e.g. QC_SENSORS_TRACE=DEBUG
+ENVIRONMENT_VARIABLE = 'QC_SENSORS_TRACE'
+
+_root_logger = logging.getLogger(ROOT_NAME)
+_root_logger.setLevel(OFF)
+_handlers = {}
+
+
+def get_level(level):
+    """
+    :param level: name in LEVELS or int
+    :return: int
+    """
+    if isinstance(level, str):
+        return LEVELS.get(level.upper(), OFF)
+    return int(level)
+
+
+def configure_tracing(level='OFF', file_path=None, stream=False):
+    """
+    Sets the level of all tracers.
+    :param level: name in LEVELS or int. The environment variable QC_SENSORS_TRACE has precedence.
+    :param file_path: Events are also written to this file if given.
+    :param stream: Events are also written to stderr
+    :return: the level used
+    """
+    level = get_level(os.environ.get(ENVIRONMENT_VARIABLE) or level)
+    _root_logger.setLevel(level)
+    targets = {}
+    if level < OFF:
+        if file_path:
+            targets[('file', os.path.abspath(file_path))] = lambda: logging.FileHandler(file_path, encoding='utf-8')
+        if stream:
+            targets[('stream', None)] = logging.StreamHandler
+    for key in [key for key in _handlers if key not in targets]:
+        _root_logger.removeHandler(_handlers.pop(key))
+    for key, create_handler in targets.items():
+        if key in _handlers:
+            continue
+        handler = create_handler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        _root_logger.addHandler(handler)
+        _handlers[key] = handler
+    # Events go to the application log unless they have their own handlers
+    _root_logger.propagate = not _handlers
+    return level
+
+
+def array_summary(array):
+    """
+    Short description of an array to trace instead of the array itself.
+    :param array:
+    :return: dict
+    """
+    array = np.asarray(array)
+    summary = dict(len=len(array), dtype=str(array.dtype))
+    if array.dtype.kind in 'fc':
+        summary['nr_nan'] = int(np.isnan(array).sum())
+    if len(array) and array.dtype.kind in 'iufM':
+        summary['min'] = str(np.nanmin(array))
+        summary['max'] = str(np.nanmax(array))
+    return summary
+
+
+def _format_fields(fields):
+    return ' '.join(f'{key}={value!r}' for key, value in fields.items())
+
+
+class Tracer(object):
+    """
+    Emits debug events with named fields. The fields are also given to the log record as record.fields.
+    There is no warning or error level, use logging for those.
+    """
+    def __init__(self, name):
+        if not name.startswith(ROOT_NAME):
+            name = f'{ROOT_NAME}.{name.split(".")[-1]}'
+        self.logger = logging.getLogger(name)
+
+    def is_enabled(self, level=logging.DEBUG):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, event, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        fields = {key: value() if isinstance(value, types.FunctionType) else value for key, value in fields.items()}
+        self.logger.log(level, '%s %s', event, _format_fields(fields), extra=dict(event=event, fields=fields))
+
+    def trace(self, event, **fields):
+        self.log(TRACE, event, **fields)
+
+    def debug(self, event, **fields):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.log(logging.INFO, event, **fields)
+
+
+_tracers = {}
+
+
+def get_tracer(name):
+    """
+    Returns the tracer for the given module name.
+    :param name: typically __name__
+    :return: Tracer
+    """
+    tracer = _tracers.get(name)
+    if tracer is None:
+        tracer = Tracer(name)
+        _tracers[name] = tracer
+    return tracer
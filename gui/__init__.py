@@ -24,6 +24,7 @@ from .communicate import update_profile_plot
 from .communicate import update_range_selection_widget
 from .communicate import update_scatter_route_map
 from .communicate import update_time_series_plot
+from .communicate import update_time_series_plot_flags
 
 from .communicate import save_limits_from_axis_float_widget
 from .communicate import save_limits_from_axis_time_widget
@@ -34,6 +35,12 @@ from .communicate import plot_map_background_data
 
 from .communicate import get_file_id
 
+#----------------------------------------------------------
+from .plot_lod import get_lod_layer
+from .plot_repaint import get_repainter
+from .redraw import RedrawScheduler
+from .redraw import Throttle
+
 #----------------------------------------------------------
 from .widgets import AxisSettingsBaseWidget
 from .widgets import AxisSettingsFloatWidget
@@ -6,7 +6,6 @@
 
 import numpy as np
 import os
-import shutil
 
 import pandas as pd
 import datetime
@@ -24,8 +23,30 @@ from core.exceptions import *
 from sharkpylib.gismo.exceptions import *
 from tkinter import messagebox
 
+from plugins.SHARKtools_qc_sensors.engine import flagging
+from plugins.SHARKtools_qc_sensors.engine import html_export
+from plugins.SHARKtools_qc_sensors.engine import merge
+from plugins.SHARKtools_qc_sensors.engine import saver
+from plugins.SHARKtools_qc_sensors.engine import get_flag_index
+from plugins.SHARKtools_qc_sensors.engine import get_time_extent
+from plugins.SHARKtools_qc_sensors.engine import invalidate_flag_index
+from plugins.SHARKtools_qc_sensors.engine import TaskCancelled
+from plugins.SHARKtools_qc_sensors.engine.instrumentation import instrumented
+from plugins.SHARKtools_qc_sensors.engine.map_layers import get_background_layer_cache
+from plugins.SHARKtools_qc_sensors.engine.map_layers import LAYER_TRACK
+from plugins.SHARKtools_qc_sensors.engine.map_layers import LAYER_UNIQUE_POSITIONS
+from plugins.SHARKtools_qc_sensors.engine.profiles import get_profile_background_cache
+from plugins.SHARKtools_qc_sensors.engine.tracing import array_summary
+from plugins.SHARKtools_qc_sensors.engine.tracing import get_tracer
+
+from .plot_lod import get_lod_layer
+from .plot_repaint import get_repainter
+
 import logging 
 
+tracer = get_tracer(__name__)
+
+@instrumented()
 def add_compare_to_profile_plot(plot_object=None,
                                 session=None,
                                 file_id=None,
@@ -61,6 +82,7 @@ def add_compare_to_profile_plot(plot_object=None,
 
     return match_data
 
+@instrumented()
 def add_compare_to_timeseries_plot(plot_object=None,
                                    session=None,
                                    file_id=None,
@@ -196,7 +218,7 @@ def get_flag_widget(parent=None,
     if settings_object:
         # Flags are sorted
         flags = settings_object.get_flag_list()
-        print('--- flags', flags)
+        tracer.debug('flag_widget_flags', flags=flags)
         descriptions  = []
         for flag in flags:
             descriptions.append(settings_object.get_flag_description(flag))
@@ -237,6 +259,7 @@ def get_flag_widget(parent=None,
 ================================================================================
 ================================================================================
 """ 
+@instrumented()
 def flag_data_time_series(flag_widget=None, 
                           gismo_object=None, 
                           plot_object=None, 
@@ -245,6 +268,7 @@ def flag_data_time_series(flag_widget=None,
     Flag data in the given gismo_object. 
     Takes limits from plot_object and 
     flag information from tkw.FlagWidget. 
+    Returns a dict with the row positions that changed flag (key is the old flag).
     """
     selection = flag_widget.get_selection()
     flag_nr = selection.flag
@@ -256,65 +280,40 @@ def flag_data_time_series(flag_widget=None,
     if not all([mark_from, mark_to]):
         raise GUIExceptionNoRangeSelection
 
-    # print(mark_from, type(mark_from))
-
-    import pandas as pd
     if plot_object.mark_range_orientation == 'vertical':
         time_from, time_to = plot_object.get_xlim()
         time_from = dates.num2date(time_from)
         time_to = dates.num2date(time_to)
 
-        time_from = pd.Timestamp.tz_localize(pd.to_datetime(time_from), None)
-        time_to = pd.Timestamp.tz_localize(pd.to_datetime(time_to), None)
-
+        data = gismo_object.get_data(par)
+        par_array = np.asarray(data[par], dtype=float)
 
-        data = gismo_object.get_data('time', par)
-        time_array = np.array([pd.to_datetime(item) for item in data['time']])
-        # print("time_array[0]", time_array[0], type(time_array[0]))
-        # print('time_from', time_from, type(time_from))
-        # print('time_to', time_to, type(time_to))
-        # print('mark_from', mark_from)
-        # print('mark_to', mark_to)
+        boolean = flagging.get_time_mask(gismo_object, time_start=time_from, time_end=time_to) & \
+                  (par_array >= mark_from) & \
+                  (par_array <= mark_to)
 
-        (time_array >= time_from)
-        (time_array <= time_to)
-        (data[par] >= mark_from)
-        (data[par] <= mark_to)
+        # Flag data. Returns the rows that changed flag.
+        return flagging.flag_data(gismo_object, flag_nr, par, index=boolean, flags=active_flags)
 
-        boolean = (time_array >= time_from) & \
-                  (time_array <= time_to) & \
-                  (data[par] >= mark_from) & \
-                  (data[par] <= mark_to)
-        times_to_flag = time_array[boolean]
-
-        # Flag data
-        gismo_object.flag_data(flag_nr, par, time=times_to_flag, flags=active_flags)
-        # Flag dependent parameters
-        # dependent_list = gismo_object.get_dependent_parameters(par)
-        # if dependent_list:
-        #     print('par', par)
-        #     for sub_par in dependent_list:
-        #         print('sub_par', sub_par)
-        #         gismo_object.flag_data(flag_nr, sub_par, time=times_to_flag)
-
-    else:
-        time_start = dates.num2date(mark_from)
-        time_end = dates.num2date(mark_to)
+    # The time window is given to gismo_object as it is
+    time_start = pd.Timestamp(flagging.to_datetime64(dates.num2date(mark_from)))
+    time_end = pd.Timestamp(flagging.to_datetime64(dates.num2date(mark_to)))
+    return flagging.flag_data(gismo_object, flag_nr, par, flags=active_flags, time_start=time_start,
+                              time_end=time_end)
 
-        time_start = pd.Timestamp.tz_localize(pd.to_datetime(time_start), None)
-        time_end = pd.Timestamp.tz_localize(pd.to_datetime(time_end), None)
 
-        # Flag data
-        gismo_object.flag_data(flag_nr, par, time_start=time_start, time_end=time_end, flags=active_flags)
-        # Flag dependent parameters
-        # dependent_list = gismo_object.get_dependent_parameters(par)
-        # if dependent_list:
-        #     print('par', par)
-        #     for sub_par in dependent_list:
-        #         print('sub_par', sub_par)
-        #         gismo_object.flag_data(flag_nr, sub_par, time_start=time_start, time_end=time_end)
-
-def run_automatic_qc(controller, automatic_qc_widget):
+@instrumented()
+def run_automatic_qc(controller, automatic_qc_widget, on_done=None, on_error=None):
+    """
+    Runs the qc routines checked in automatic_qc_widget on the current file.
+    If on_done is given the qc is run in a worker thread and on_done is called with the list of qc routines when
+    finished.
+    :param controller:
+    :param automatic_qc_widget:
+    :param on_done:
+    :param on_error:
+    :return: list of qc routines, False if cancelled by the user
+    """
     qc_routine_list = automatic_qc_widget.get_checked_item_list()
     nr_routines = len(qc_routine_list)
     if nr_routines == 0:
@@ -333,13 +332,64 @@ def run_automatic_qc(controller, automatic_qc_widget):
     if not messagebox.askyesno('Run QC', text):
         return False
 
-    controller.session.run_automatic_qc(controller.current_file_id, qc_routines=qc_routine_list)
+    file_id = controller.current_file_id
+    if on_done:
+        def on_finished(result):
+            invalidate_flag_index(file_id)
+            on_done(qc_routine_list)
+
+        def on_failed(exception):
+            invalidate_flag_index(file_id)
+            if on_error:
+                on_error(exception)
+
+        controller.parent_app.run_task('Run QC',
+                                       controller.session.run_automatic_qc,
+                                       file_id,
+                                       qc_routines=qc_routine_list,
+                                       on_done=on_finished,
+                                       on_error=on_failed)
+        return qc_routine_list
+
+    controller.session.run_automatic_qc(file_id, qc_routines=qc_routine_list)
+    invalidate_flag_index(file_id)
 
     # controller.controller.run_progress(lambda: controller.session.run_automatic_qc(controller.current_file_id,
     #                                    qc_routines=qc_routine_list),
     #                                    'Running qc on file: {}'.format(controller.current_file_id))
     return qc_routine_list
 
+def show_qc_report_errors(report, logger=None):
+    """
+    Shows the errors in a engine.qc_runner.QCReport.
+    :param report:
+    :param logger:
+    :return: True if the qc was stopped by an error
+    """
+    for qc_routine, e, tb in report.get_errors(ImportError):
+        main_gui.show_error('Import error', e)
+
+    logger = logger or logging.getLogger(__name__)
+    for qc_routine, e, tb in report.get_errors(GISMOExceptionMissingInputArgument):
+        if 'parameter' in e.message and 'list' in e.message:
+            main_gui.show_warning('No parameter selected', 'You need to specify parameters for QC routine {} '
+                                                          'Please open option ans select parameters.'.format(qc_routine))
+            logger.warning(e)
+        elif 'save' in e.message and 'directory' in e.message:
+            main_gui.show_warning('Invalid save directory', 'It seems like the saving directory for QC routine {} '
+                                                           'is not valid. Please open option and change or update '
+                                                           'directory.'.format(qc_routine))
+            logger.warning(e)
+        else:
+            main_gui.show_error('Unknown error', 'An unknown error related to missing input variable occurred. '
+                                            f'Please contact the suupport team: shark@smhi.se\n\n{tb}')
+            logger.error(e)
+
+    if report.failures:
+        logger.warning(report.get_failure_summary(max_files=len(report.failures)))
+        main_gui.show_warning('Automatic quality control', report.get_failure_summary())
+    return report.stopped
+
 def save_user_info_from_flag_widget(flag_widget, user_object):
     """
     Saves color and marker size to user profile (user_object)
@@ -357,11 +407,18 @@ def save_user_info_from_flag_widget(flag_widget, user_object):
     #     user_object.flag_color.set(f, c)
     #     user_object.flag_markersize.set(f, ms)
 
-def save_files(file_id_list=None, session=None, save_widget=None, **kwargs):
+@instrumented()
+def save_files(file_id_list=None, session=None, save_widget=None, run_task=None, nr_workers=4, fsync=False,
+               incremental=False, **kwargs):
     """
     Saves all gismo objects with original name in directory provided in save_widget.
+    Files are saved concurrently and atomically, see engine.saver.FileSaver.
     :param gimo_objects:
     :param save_widget:
+    :param run_task: If given (App.run_task) the files are saved in a worker thread
+    :param nr_workers: Number of files saved at the same time
+    :param fsync: Flush each file to disk before it replaces the old one
+    :param incremental: Only rewrite the changed flags when possible, see engine.saver.save_file_atomic
     :return:
     """
     directory = save_widget.get_directory()
@@ -412,20 +469,41 @@ def save_files(file_id_list=None, session=None, save_widget=None, **kwargs):
             files_to_save.extend(existing_files)
 
     # Save files
-    if files_to_save:
-        for file_id in files_to_save:
-            session.save_file(file_id, file_path=file_path_mapping[file_id], overwrite=True, user=user)
-    main_gui.show_information('Files saved!', '{} files have been saved to directory: \n {}'.format(len(files_to_save),
-                                                                                               directory))
+    file_saver = saver.FileSaver(session, nr_workers=nr_workers, fsync=fsync, incremental=incremental)
+    mapping = {file_id: file_path_mapping[file_id] for file_id in files_to_save}
+
+    def save(task=None):
+        if task is None:
+            return file_saver.save(mapping, user=user)
+        return file_saver.save(mapping, user=user,
+                               cancel_token=task.cancel_token,
+                               progress_callback=task.report_progress)
+
+    def on_done(report):
+        if report.nr_errors:
+            main_gui.show_warning('Save files', f'{report.get_summary()}\n\nDirectory: {directory}')
+            return
+        main_gui.show_information('Files saved!', '{} files have been saved to directory: \n {}'.format(report.nr_saved,
+                                                                                                   directory))
 
+    def on_error(e):
+        main_gui.show_error('Save files', f'Could not save files:\n{e}')
 
-def save_file(file_id=None, session=None, save_widget=None, **kwargs):
+    if run_task:
+        run_task('Save files', save, pass_task=True, on_done=on_done, on_error=on_error)
+        return
+    on_done(save())
+
+
+@instrumented()
+def save_file(file_id=None, session=None, save_widget=None, incremental=False, **kwargs):
     """
     Saves the gismo_object corresponding the file_id to using the information in save_widget
     save_widget is a gui.SaweWidget object
     :param file_id:
     :param session:
     :param save_widget:
+    :param incremental: Only rewrite the changed flags when possible, see engine.saver.save_file_atomic
     :return:
     """
     if not file_id:
@@ -444,11 +522,14 @@ def save_file(file_id=None, session=None, save_widget=None, **kwargs):
     if not file_name.endswith('.txt'):
         file_name = file_name + '.txt'
     output_file_path = os.path.join(directory, file_name)
-    print(output_file_path)
-    print(original_file_path)
+    tracer.debug('save_file', file_id=file_id, output_file_path=output_file_path,
+                 original_file_path=original_file_path)
     if not (os.path.exists(output_file_path) and os.path.samefile(output_file_path, original_file_path)):
         try:
-            session.save_file(file_id, file_path=output_file_path, user=user)
+            if incremental and not os.path.exists(output_file_path):
+                saver.save_file_atomic(session, file_id, output_file_path, user=user, incremental=True)
+            else:
+                session.save_file(file_id, file_path=output_file_path, user=user)
             main_gui.show_information('File saved', 'File saved to:\n{}'.format(output_file_path))
             return
         except GISMOExceptionFileExcists:
@@ -458,16 +539,10 @@ def save_file(file_id=None, session=None, save_widget=None, **kwargs):
     else:
         if not messagebox.askyesno('Overwrite file!', 'Do you want to replace the original file?'):
             return
-    print('CONTINUE!!!')
+    tracer.debug('save_file_overwrite', file_id=file_id, output_file_path=output_file_path)
 
-    # Create temporary file and then overwrite by changing the name. This is so that the process don't get interrupted.
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    temp_file_path = directory + '/temp_%s' % file_name
-    session.save_file(file_id, file_path=temp_file_path, overwrite=True, user=user)
-    os.remove(output_file_path)
-    shutil.copy2(temp_file_path, output_file_path)
-    os.remove(temp_file_path)
+    # Write to a temporary file that replaces the existing one. The file is never missing if the save is interrupted.
+    saver.save_file_atomic(session, file_id, output_file_path, user=user, incremental=incremental)
     main_gui.show_information('File saved', 'File saved to:\n{}'.format(output_file_path))
 
 
@@ -504,6 +579,7 @@ def save_plot(controller, plot_object, save_directory_widget, in_file_name='plot
     plot_object.save_fig(output_file_path)
 
 
+@instrumented()
 def save_html_plot(controller, save_widget_html, flag_widget=None, save_directory_widget=None):
 
     def get_par_list_by_file_id(parameter_list):
@@ -522,8 +598,6 @@ def save_html_plot(controller, save_widget_html, flag_widget=None, save_director
         return_dict['ref'] = sorted(return_dict['ref'])
         return return_dict
 
-    import sharkpylib.plot.html_plot as html_plot
-
     selection = save_widget_html.get_selection()
 
     # Check selection
@@ -559,76 +633,85 @@ def save_html_plot(controller, save_widget_html, flag_widget=None, save_director
 
     # Check nr of parameters and warn if too many
     nr_par = len(parameter_dict['main']+parameter_dict['ref'])
-    max_nr_par = controller.user.process.setdefault('warn_export_nr_parameters', 10)
+    max_nr_par = controller.user.process.setdefault('warn_export_nr_parameters', 50)
     if nr_par > max_nr_par:
         ok_to_continue = messagebox.askyesno('Export plots/maps',
                                                 'You have chosen to export {} parameters. '
-                                                'This might take some time and MAY cause the program to crash. '
-                                                'Do you wish to continue anyway? ')
+                                                'This might take some time. '
+                                                'Do you wish to continue anyway? '.format(nr_par))
         if not ok_to_continue:
             controller.update_help_information('Export aborted by user.')
             return
 
-    main_data = {}
-    ref_data = {}
-    if controller.current_file_id and parameter_dict.get('main'):
-        main_data = controller.session.get_data(controller.current_file_id, *parameter_dict.get('main'))
-    if controller.current_ref_file_id and parameter_dict.get('ref'):
-        ref_data = controller.session.get_data(controller.current_ref_file_id, *parameter_dict.get('ref'))
+    file_ids = dict(main=controller.current_file_id,
+                    ref=controller.current_ref_file_id)
+    jobs = []
 
     if export_combined_plots:
-        combined_plot_object = html_plot.PlotlyPlot()
-        # Add Main data
-        if main_data:
-            for par in main_data:
-                if par == 'time':
-                    continue
-                combined_plot_object.add_scatter_data(main_data['time'],
-                                                      main_data[par],
-                                                      name='{} (main)'.format(par),
-                                                      mode='markers')
-        if ref_data:
-            for par in ref_data:
+        combined_job = html_export.HtmlPlotJob(os.path.join(export_dir, 'plot_combined.html'))
+        for key in ['main', 'ref']:
+            if not file_ids[key] or not parameter_dict.get(key):
+                continue
+            # All parameters of the file in one call
+            data = controller.session.get_data(file_ids[key], *parameter_dict.get(key))
+            for par in data:
                 if par == 'time':
                     continue
-                combined_plot_object.add_scatter_data(ref_data['time'],
-                                                      ref_data[par],
-                                                      name='{} (ref)'.format(par),
-                                                      mode='markers')
-        combined_plot_object.plot_to_file(os.path.join(export_dir, 'plot_combined.html'))
+                combined_job.add_trace(data['time'], data[par], name='{} ({})'.format(par, key))
+        jobs.append(combined_job)
 
     if export_individual_plots and flag_widget:
         flag_selection = flag_widget.get_selection()
         selected_flags = flag_selection.selected_flags
         selected_descriptions = flag_selection.selected_descriptions
-        if main_data:
-            for par in main_data:
-                if par == 'time':
-                    continue
-                individual_plot_object = html_plot.PlotlyPlot(title='{} (main)'.format(par), yaxis_title='')
-                for qf, des in zip(selected_flags, selected_descriptions):
-                    data = controller.session.get_data(controller.current_file_id, 'time', par, mask_options={'include_flags': [qf]})
-                    individual_plot_object.add_scatter_data(data['time'], data[par],
-                                                            name='{} ({})'.format(qf, des),
-                                                            mode='markers')
-                individual_plot_object.plot_to_file(os.path.join(export_dir, 'plot_{}.html'.format(par.replace('/', '_'))))
-        if ref_data:
-            for par in ref_data:
+        file_names = set()
+        for key in ['main', 'ref']:
+            if not file_ids[key] or not parameter_dict.get(key):
+                continue
+            gismo_object = controller.session.get_gismo_object(file_ids[key])
+            for par in parameter_dict.get(key):
                 if par == 'time':
                     continue
-                individual_plot_object = html_plot.PlotlyPlot(title='{} (ref)'.format(par), yaxis_title='')
-                for qf, des in zip(selected_flags, selected_descriptions):
-                    data = controller.session.get_data(controller.current_ref_file_id, 'time', par, mask_options={'include_flags': [qf]})
-                    individual_plot_object.add_scatter_data(data['time'], data[par],
-                                                            name='{} ({})'.format(qf, des),
-                                                            mode='markers')
-                individual_plot_object.plot_to_file(os.path.join(export_dir, 'plot_{}.html'.format(par.replace('/', '_'))))
+                file_name = 'plot_{}.html'.format(par.replace('/', '_'))
+                if file_name in file_names:
+                    # Same parameter in main and ref
+                    file_name = 'plot_{}_{}.html'.format(par.replace('/', '_'), key)
+                file_names.add(file_name)
+                job = html_export.HtmlPlotJob(os.path.join(export_dir, file_name),
+                                              title='{} ({})'.format(par, key))
+                for name, x, y in html_export.get_flag_traces(gismo_object, par, selected_flags,
+                                                              selected_descriptions):
+                    job.add_trace(x, y, name=name)
+                jobs.append(job)
+
+    if not jobs:
+        return
+    exporter = html_export.HtmlExporter(nr_processes=controller.user.process.setdefault('export_nr_processes',
+                                                                                      os.cpu_count() or 1))
 
-def match_data(controller, compare_widget):
-    """
-    Match data from the active files. Only calculates if compare widget is updated.
-    :return:
-    """
+    def export(task=None):
+        if task is None:
+            return exporter.export(jobs)
+        return exporter.export(jobs, cancel_token=task.cancel_token, progress_callback=task.report_progress)
+
+    def on_done(report):
+        if report.nr_errors:
+            main_gui.show_warning('Export plots', report.get_summary())
+
+    def on_error(e):
+        if isinstance(e, TaskCancelled):
+            return
+        main_gui.show_error('Export plots', f'Could not export plots:\n{e}')
+
+    parent_app = getattr(controller, 'parent_app', None)
+    if parent_app is None:
+        on_done(export())
+        return
+    # The data is already taken from the session so the export does not block session tasks
+    parent_app.run_task('Export plots', export, group=None, pass_task=True, on_done=on_done, on_error=on_error)
+
+
+def _check_match_files(controller):
     if not all([controller.current_file_id, controller.current_ref_file_id]):
         if not controller.current_file_id:
             main_gui.show_information('No data loaded', 'No main file loaded!')
@@ -639,15 +722,75 @@ def match_data(controller, compare_widget):
         main_gui.show_information('Cant compare the same data', 'Cant compare with yourself!')
         raise GUIExceptionBreak
 
+
+def _get_match_limits(compare_widget):
     diffs = dict()
     diffs['hours'] = compare_widget.time
     diffs['dist'] = compare_widget.dist
     diffs['depth'] = compare_widget.depth
+    return diffs
+
 
-    # TODO: Match data every time. CHANGE THIS
-    controller.session.match_files(controller.current_file_id, controller.current_ref_file_id, **diffs)
+def _show_no_matching_data():
+    main_gui.show_information('No matching data', 'No data in the reference file matches the given limits!')
+
+
+@instrumented()
+def match_data(controller, compare_widget, session_match=False):
+    """
+    Match data from the active files. Only calculates if compare widget is updated.
+    :param session_match: Also match the files in the session. Needed for session.get_match_data,
+                          session.get_match_object and session.get_merge_data.
+    :return:
+    """
+    _check_match_files(controller)
+    match_cache = controller.parent_app.match_cache
+    match_function = match_cache.match_session_files if session_match else match_cache.match_files
+    # Only matched again if the limits are changed or if any of the files are flagged or reloaded
+    if not match_function(controller.session,
+                          controller.current_file_id,
+                          controller.current_ref_file_id,
+                          **_get_match_limits(compare_widget)):
+        _show_no_matching_data()
+        raise GUIExceptionBreak
     return True
 
+
+@instrumented()
+def match_data_in_background(controller, compare_widget, on_done=None, on_fail=None):
+    """
+    Same as match_data but the matching is done in a worker thread.
+    on_done is called (in the UI thread) when the data is matched. on_fail is called if there is no matching data
+    or if the matching fails.
+    Raises GUIExceptionBreak directly if the files can not be compared.
+    :return: engine.tasks.Task
+    """
+    _check_match_files(controller)
+
+    def on_matched(matched):
+        if not matched:
+            _show_no_matching_data()
+            if on_fail:
+                on_fail()
+            return
+        if on_done:
+            on_done()
+
+    def on_error(e):
+        main_gui.show_error('Match data', f'Could not match data:\n{e}')
+        if on_fail:
+            on_fail()
+
+    return controller.parent_app.run_task('Match data',
+                                          controller.parent_app.match_cache.match_files,
+                                          controller.session,
+                                          controller.current_file_id,
+                                          controller.current_ref_file_id,
+                                          on_done=on_matched,
+                                          on_error=on_error,
+                                          **_get_match_limits(compare_widget))
+
+@instrumented()
 def get_merge_data(controller, compare_widget, flag_widget, load_match_data=True):
     """
     Returns matching data for loaded information
@@ -663,49 +806,43 @@ def get_merge_data(controller, compare_widget, flag_widget, load_match_data=True
     ref_file_id = controller.current_ref_file_id
     parameter = controller.current_parameter
     gismo_object = controller.current_gismo_object
-
-    match_object = controller.session.get_match_object(file_id, ref_file_id)
-    merge_df = controller.session.get_merge_data(file_id, ref_file_id)
+    ref_gismo_object = controller.session.get_gismo_object(ref_file_id)
 
     compare_parameter = compare_widget.get_parameter()
 
-    # Find parameter names in merge df
+    # Matching rows from the match index. The match object of the session is not needed.
+    rows, ref_rows = controller.parent_app.match_cache.get_matching_rows(controller.session,
+                                                                         file_id,
+                                                                         ref_file_id,
+                                                                         **_get_match_limits(compare_widget))
+    if not len(rows):
+        _show_no_matching_data()
+        raise GUIExceptionBreak
+
+    main_par = parameter
+    comp_par = compare_parameter
     main_par_file_id = '{}_{}'.format(parameter, file_id)
     compare_par_file_id = '{}_{}'.format(compare_parameter, ref_file_id)
-    depth_compare_file_id = '{}_{}'.format('depth', ref_file_id)
 
-    main_par = match_object.get_merge_parameter(main_par_file_id)
-    comp_par = match_object.get_merge_parameter(compare_par_file_id)
-    depth_par = match_object.get_merge_parameter(depth_compare_file_id)
-
-    # Get list of active visit_depth_id
-    visit_depth_id_par = '{}_{}'.format('visit_depth_id', file_id)
-    visit_depth_id_list = merge_df[visit_depth_id_par]
+    try:
+        ref_depth = merge.get_float_data(ref_gismo_object, 'depth')[ref_rows]
+    except GISMOException:
+        ref_depth = np.full(len(ref_rows), np.nan)
+    values = dict(x=merge.get_float_data(gismo_object, parameter)[rows],
+                  y=merge.get_float_data(ref_gismo_object, compare_parameter)[ref_rows],
+                  depth=ref_depth)
 
     # Handle flags
     selection = flag_widget.get_selection()
 
     # Build data
-    all_values = []
-    all_times = []
+    flag_data, all_times = merge.build_match_data(gismo_object, parameter, rows, values,
+                                                  flags=selection.selected_flags)
 
     data = {}
     data['flags'] = {}
     for flag in selection.selected_flags:
-        masked_data = gismo_object.get_data('visit_depth_id', 'time', parameter,
-                                     visit_depth_id_list=visit_depth_id_list,
-                                     mask_options=dict(include_flags=[flag]))
-
-        boolean = ~np.isnan(np.array(masked_data[parameter]))
-        visit_depth_id_flag = masked_data['visit_depth_id'][boolean]
-        all_times.extend(list(masked_data['time']))
-
-        boolean = merge_df[visit_depth_id_par].isin(visit_depth_id_flag)
-
-        data['flags'][flag] = {}
-        data['flags'][flag]['x'] = [float(item) if item else np.nan for item in merge_df.loc[boolean, main_par]]
-        data['flags'][flag]['y'] = [float(item) if item else np.nan for item in merge_df.loc[boolean, comp_par]]
-        data['flags'][flag]['depth'] = [float(item) if item else np.nan for item in merge_df.loc[boolean, depth_par]]
+        data['flags'][flag] = flag_data[flag]
 
         prop = gismo_object.settings.get_flag_prop_dict(flag)
         prop.update(selection.get_prop(flag))  # Is empty if no settings file is added while loading data
@@ -714,10 +851,7 @@ def get_merge_data(controller, compare_widget, flag_widget, load_match_data=True
 
         data['flags'][flag]['prop'] = prop
 
-        all_values.extend(data['flags'][flag]['x'])
-        all_values.extend(data['flags'][flag]['y'])
-
-        # print('LEN', len(all_values))
+    all_values = np.concatenate([np.concatenate([item['x'], item['y']]) for item in flag_data.values()])
 
     data['min_value'] = np.nanmin(all_values)
     data['max_value'] = np.nanmax(all_values) * 1.05
@@ -726,8 +860,8 @@ def get_merge_data(controller, compare_widget, flag_widget, load_match_data=True
         data['min_value'] = data['min_value'] * 0.95
 
     # Set title and labels
-    data['time_from_str'] = pd.to_datetime(str(min(all_times))).strftime('%Y%m%d')
-    data['time_to_str'] = pd.to_datetime(str(max(all_times))).strftime('%Y%m%d')
+    data['time_from_str'] = pd.Timestamp(all_times.min()).strftime('%Y%m%d')
+    data['time_to_str'] = pd.Timestamp(all_times.max()).strftime('%Y%m%d')
 
     data['main_par'] = main_par
     data['compare_par'] = comp_par
@@ -742,6 +876,7 @@ def get_merge_data(controller, compare_widget, flag_widget, load_match_data=True
 ================================================================================
 ================================================================================
 """ 
+@instrumented()
 def flag_data_profile(flag_widget=None,
                       file_id=None,
                       session=None,
@@ -752,7 +887,6 @@ def flag_data_profile(flag_widget=None,
     Takes limits from plot_object and 
     flag information from tkw.FlagWidget.
     """
-    print('PROFILE!!!!!!!!!')
     selection = flag_widget.get_selection()
     flag_nr = selection.flag
     active_flags = selection.selected_flags
@@ -763,7 +897,8 @@ def flag_data_profile(flag_widget=None,
     if not all([mark_from, mark_to]):
         raise GUIExceptionNoRangeSelection
 
-    print('ORIENTATION', plot_object.mark_range_orientation)
+    tracer.debug('flag_data_profile', file_id=file_id, par=par, flag=flag_nr, mark_from=mark_from, mark_to=mark_to,
+                 orientation=plot_object.mark_range_orientation)
     if plot_object.mark_range_orientation == 'horizontal':
         value_from, value_to = plot_object.get_xlim()
         par_from = float(value_from)
@@ -771,21 +906,23 @@ def flag_data_profile(flag_widget=None,
 
         data = session.get_data(file_id, 'depth', par)
         par_array = data[par]
+        depth_array = np.asarray(data['depth'], dtype=float)
 
         boolean = (par_array >= par_from) & \
                   (par_array <= par_to) & \
-                  (data['depth'] >= mark_from) & \
-                  (data['depth'] <= mark_to)
-        depth_to_flag = -data['depth'][boolean]
+                  (depth_array >= mark_from) & \
+                  (depth_array <= mark_to)
+        depth_to_flag = -depth_array[boolean]
 
         # Flag data
         session.flag_data(file_id, flag_nr, par, depth=depth_to_flag, flags=active_flags)
+        # All rows at the given depths are flagged
+        flagging.register_flagged_rows(session.get_gismo_object(file_id), flag_nr, par,
+                                       np.isin(depth_array, depth_array[boolean]), flags=active_flags)
     else:
         depth_max = -float(mark_from)
         depth_min = -float(mark_to)
-
-        print('depth_min', depth_min)
-        print('depth_max', depth_max)
+        tracer.debug('flag_data_profile_depth', depth_min=depth_min, depth_max=depth_max)
 
         # Flag data
         kw = {}
@@ -793,6 +930,11 @@ def flag_data_profile(flag_widget=None,
             kw['qc_routine'] = 'Manual'
         session.flag_data(file_id, flag_nr, par, depth_min=depth_min, depth_max=depth_max,
                           flags=active_flags, **kw)
+        # Same limits as given to session.flag_data (positive depth)
+        depth_array = np.asarray(session.get_data(file_id, 'depth')['depth'], dtype=float)
+        flagging.register_flagged_rows(session.get_gismo_object(file_id), flag_nr, par,
+                                       (depth_array >= depth_min) & (depth_array <= depth_max),
+                                       flags=active_flags)
 
 """
 ================================================================================
@@ -801,6 +943,7 @@ def flag_data_profile(flag_widget=None,
 """ 
 
 #===========================================================================
+@instrumented()
 def update_range_selection_widget(plot_object=None, 
                                   range_selection_widget=None,
                                   time_axis=False):
@@ -927,6 +1070,7 @@ def old_update_profile_plot(profiles=None,
 ================================================================================
 ================================================================================
 """ 
+@instrumented()
 def update_highlighted_profile_in_plot(profile=None, 
                                         par=None, 
                                         plot_object=None, 
@@ -992,6 +1136,7 @@ def update_highlighted_profile_in_plot(profile=None,
 ================================================================================
 ================================================================================
 """ 
+@instrumented()
 def update_time_series_plot(gismo_object=None, 
                             par=None, 
                             plot_object=None, 
@@ -1023,32 +1168,34 @@ def update_time_series_plot(gismo_object=None,
     plot_object.set_x_label('Date/Time')
     plot_object.set_y_label(par)
 
-    # Check if data is available
-    check_data = gismo_object.get_data(par)
-    data = gismo_object.get_data('time', par, mask_options={'include_flags': selection.selected_flags})
-    print('='*30)
-    print('par', par)
-    print('data', data[par])
-    print('no', len(np.where(np.isnan(data[par]))[0]))
-    nr_data = len(np.where(~np.isnan(data[par]))[0])
-    print('yes', nr_data)
-
-    print('selection.selected_flags', selection.selected_flags)
-    if not nr_data:
+    # One fetch of the column. Split by flag using the flag index.
+    data = gismo_object.get_data('time', par)
+    time_array = np.asarray(data['time'])
+    par_array = np.asarray(data[par])
+    flag_index = get_flag_index(gismo_object)
+    flag_positions = flag_index.get_flag_positions(par, selection.selected_flags)
+    current_positions = flag_index.get_combined_positions(par, selection.selected_flags)
+    tracer.debug('update_time_series_plot', par=par, values=lambda: array_summary(par_array),
+                 nr_selected=len(current_positions))
+
+    if not len(current_positions):
         raise GISMOExceptionNoData
+
+    # Long series are decimated for the visible range
+    lod_layer = get_lod_layer(plot_object, value_axis='y')
     # Plot all flags combined. This is used for range selection.
 
     prop = {'linestyle': '', 
              'marker': None}
 
-    plot_object.set_data(x=data['time'], y=data[par], line_id='current_flags', call_targets=call_targets, **prop)
+    lod_layer.set_data(x=time_array[current_positions], y=par_array[current_positions], line_id='current_flags',
+                       call_targets=call_targets, **prop)
 
     # Plot individual flags
     for k, flag in enumerate(selection.selected_flags):
 
-        data = gismo_object.get_data('time', par, mask_options={'include_flags': [flag]})
-
-        if all(np.isnan(data[par])):
+        positions = flag_positions[flag]
+        if not len(positions):
 #            print 'No data for flag "%s", will not plot.' % flag
             continue
 
@@ -1056,7 +1203,8 @@ def update_time_series_plot(gismo_object=None,
         prop.update({'linestyle': '',
                      'marker': '.'})
 
-        plot_object.set_data(x=data['time'], y=data[par], line_id=flag, call_targets=call_targets, **prop)
+        lod_layer.set_data(x=time_array[positions], y=par_array[positions], line_id=flag,
+                           call_targets=call_targets, **prop)
 
     try:
         plot_object.set_title(gismo_object.get_station_name())
@@ -1067,11 +1215,70 @@ def update_time_series_plot(gismo_object=None,
         help_info_function('Done!')
 
 
+@instrumented()
+def update_time_series_plot_flags(gismo_object=None,
+                                  par=None,
+                                  plot_object=None,
+                                  flag_widget=None,
+                                  changed_rows=None):
+    """
+    Incremental version of update_time_series_plot used after flagging.
+    Only the lines of the flags that has changed are updated and only the data area of the plot is repainted.
+
+    :param gismo_object:
+    :param par:
+    :param plot_object:
+    :param flag_widget:
+    :param changed_rows: dict returned by flag_data_time_series
+    :return:
+    """
+    if not changed_rows:
+        return
+
+    selection = flag_widget.get_selection()
+    changed_flags = set(str(flag) for flag in changed_rows)
+    changed_flags.add(str(selection.flag))
+
+    data = gismo_object.get_data('time', par)
+    time_array = np.asarray(data['time'])
+    par_array = np.asarray(data[par])
+    flag_index = get_flag_index(gismo_object)
+    lod_layer = get_lod_layer(plot_object, value_axis='y')
+
+    # Existing lines are updated in place so that the plot can be repainted by blitting
+    for flag in selection.selected_flags:
+        if str(flag) not in changed_flags:
+            continue
+        positions = flag_index.get_positions(par, flag)
+        if lod_layer.update_data(x=time_array[positions], y=par_array[positions], line_id=flag):
+            continue
+        lod_layer.delete_data(flag)
+        if not len(positions):
+            continue
+        prop = selection.get_prop(flag)
+        prop.update({'linestyle': '',
+                     'marker': '.'})
+        lod_layer.set_data(x=time_array[positions], y=par_array[positions], line_id=flag,
+                           call_targets=False, **prop)
+
+    # Rows are moved out of the selected flags. Update the line used for range selection.
+    if str(selection.flag) not in [str(flag) for flag in selection.selected_flags]:
+        current_positions = flag_index.get_combined_positions(par, selection.selected_flags)
+        if not lod_layer.update_data(x=time_array[current_positions], y=par_array[current_positions],
+                                     line_id='current_flags'):
+            lod_layer.delete_data('current_flags')
+            lod_layer.set_data(x=time_array[current_positions], y=par_array[current_positions],
+                               line_id='current_flags', call_targets=False, linestyle='', marker=None)
+
+    get_repainter(plot_object).repaint()
+
+
 """
 ================================================================================
 ================================================================================
 ================================================================================
 """
+@instrumented()
 def update_profile_plot_background(gismo_objects=[],
                                    par=None,
                                    plot_object=None,
@@ -1084,7 +1291,7 @@ def update_profile_plot_background(gismo_objects=[],
     Updates the plot_object (profile) using information from gismo_object, par and flag_widget.
     If help_info_function (updating tkText) is given text information is passed to the function.
 
-    :param gismo_object:
+    :param gismo_objects: all files in the background. Lines from earlier calls are replaced.
     :param par:
     :param plot_object:
     :param flag_widget:
@@ -1099,38 +1306,30 @@ def update_profile_plot_background(gismo_objects=[],
     if clear_plot:
         plot_object.reset_plot()
 
-    for gismo_object in gismo_objects:
-        selection = flag_widget.get_selection()
-
-        # Set labels
-        plot_object.set_x_label(par)
-        plot_object.set_y_label('Depth')
-
-        # Plot all flags combined. This is used for range selection.
-        # data = gismo_object.get_data('depth', par, mask_options={'include_flags': selection.selected_flags})
-        #
-        # prop = {'linestyle': '',
-        #         'marker': None}
-
-        # Plot individual flags
-        for k, flag in enumerate(selection.selected_flags):
+    selection = flag_widget.get_selection()
 
-            data = gismo_object.get_data('depth', par, mask_options={'include_flags': [flag]})
+    # Set labels
+    plot_object.set_x_label(par)
+    plot_object.set_y_label('Depth')
 
-            if all(np.isnan(data[par])):
-                continue
-            prop = selection.get_prop(flag)  # Is empty if no settings file is added while loading data
-            prop.update({'linestyle': '',
-                         'marker': '.',
-                         'alpha': 0.2})
-
-            marker_id = '{}_{}'.format(gismo_object.file_id, flag)
-            plot_object.delete_data(marker_id)
-            plot_object.set_data(x=data[par], y=-data['depth'], line_id=marker_id, call_targets=False, **prop)
+    # All files are drawn as one line per flag. Only files with changed flags are read again.
+    profiles = get_profile_background_cache().get_profiles(gismo_objects, par, selection.selected_flags)
+    for flag in selection.selected_flags:
+        line_id = 'background_{}'.format(flag)
+        plot_object.delete_data(line_id)
+        x, y = profiles[flag]
+        if not len(x):
+            continue
+        prop = selection.get_prop(flag)  # Is empty if no settings file is added while loading data
+        prop.update({'linestyle': '',
+                     'marker': '.',
+                     'alpha': 0.2})
+        plot_object.set_data(x=x, y=y, line_id=line_id, call_targets=False, **prop)
     if call_targets:
         plot_object.call_targets()
 
 
+@instrumented()
 def update_profile_plot(gismo_object=None,
                         par=None,
                         plot_object=None,
@@ -1170,7 +1369,16 @@ def update_profile_plot(gismo_object=None,
     # print('yes', len(np.where(np.isnan(check_data[par]))[0]))
 
     # Plot all flags combined. This is used for range selection.
-    data = gismo_object.get_data('depth', par, mask_options={'include_flags': selection.selected_flags})
+    # One fetch of the column. Split by flag using the flag index.
+    data = gismo_object.get_data('depth', par)
+    par_array = np.asarray(data[par])
+    depth_array = -np.asarray(data['depth'], dtype=float)
+    flag_index = get_flag_index(gismo_object)
+    flag_positions = flag_index.get_flag_positions(par, selection.selected_flags)
+    current_positions = flag_index.get_combined_positions(par, selection.selected_flags)
+
+    # Long profiles are decimated for the visible range
+    lod_layer = get_lod_layer(plot_object, value_axis='x')
 
     prop = {'linestyle': '',
             'marker': None}
@@ -1179,8 +1387,9 @@ def update_profile_plot(gismo_object=None,
     # print(data['time'][0])
     # print(data[par][0])
     # print()
-    plot_object.delete_data('current_flags')
-    plot_object.set_data(x=data[par], y=-data['depth'], line_id='current_flags', call_targets=call_targets, **prop)
+    lod_layer.delete_data('current_flags')
+    lod_layer.set_data(x=par_array[current_positions], y=depth_array[current_positions], line_id='current_flags',
+                       call_targets=call_targets, **prop)
 
     # if par in ['time', 'lat', 'lon']:
     #
@@ -1192,17 +1401,18 @@ def update_profile_plot(gismo_object=None,
     # Plot individual flags
     for k, flag in enumerate(selection.selected_flags):
 
-        data = gismo_object.get_data('depth', par, mask_options={'include_flags': [flag]})
+        positions = flag_positions[flag]
 
-        plot_object.delete_data(flag)
-        if all(np.isnan(data[par])):
+        lod_layer.delete_data(flag)
+        if not len(positions):
             #            print 'No data for flag "%s", will not plot.' % flag
             continue
         prop = selection.get_prop(flag)
         prop.update({'linestyle': '',
                      'marker': '.'})
 
-        plot_object.set_data(x=data[par], y=-data['depth'], line_id=flag, call_targets=call_targets, **prop)
+        lod_layer.set_data(x=par_array[positions], y=depth_array[positions], line_id=flag,
+                           call_targets=call_targets, **prop)
 
     # print('STATION NAME:', gismo_object.get_station_name())
     try:
@@ -1218,6 +1428,7 @@ def update_profile_plot(gismo_object=None,
 ================================================================================
 ================================================================================
 """ 
+@instrumented()
 def update_scatter_route_map(gismo_object=None, 
                              par=None, 
                              map_object=None, 
@@ -1480,14 +1691,12 @@ def set_valid_time_in_time_axis(gismo_object=None,
     """
     Takes information from the plot_object and sets valid time range in the axis_widget
     """
-    data = gismo_object.get_data('time')
-    time_array = data['time']
-    if match_object:
-        match_data = gismo_object.get_data('time')
-        match_time_array = match_data['time']
-        time_array = np.append(time_array, match_time_array)
-        
-    time_axis_widget.set_valid_time_span_from_list(time_array)
+    # The first and last time is enough to set the valid time span. match_object used to add the time of the same
+    # gismo_object again, which does not change the span.
+    time_list = [pd.Timestamp(t).to_pydatetime() for t in get_time_extent(gismo_object) if not pd.isnull(t)]
+    if not time_list:
+        return
+    time_axis_widget.set_valid_time_span_from_list(time_list)
     
     
 """
@@ -1682,7 +1891,7 @@ def save_limits_from_axis_float_widget(user_object=None,
     min_value = axis_float_widget.stringvar_min.get()
     max_value = axis_float_widget.stringvar_max.get()
 
-    print('type:', type(min_value), min_value)
+    tracer.debug('save_limits', par=par, min_value=min_value, max_value=max_value)
     user_object.range.set(par, 'min', float(min_value))
     user_object.range.set(par, 'max', float(max_value))
     
@@ -1726,6 +1935,7 @@ def save_limits_from_axis_float_widget(user_object=None,
 #     user_object.range.set(par, 'max', float(max_value))
 
 
+@instrumented()
 def plot_map_background_data(map_widget=None, session=None, user=None, current_file_id=None, **kwargs):
     """
     Plots "background" data to plot object. Background data is data not associated with current_file_id.
@@ -1746,52 +1956,40 @@ def plot_map_background_data(map_widget=None, session=None, user=None, current_f
     physicalchemical_color = user.map_prop.setdefault('physicalchemical_color_background', 'gray')
     physicalchemical_markersize = user.map_prop.setdefault('physicalchemical_markersize_background', 5)
 
+    layer_cache = get_background_layer_cache(session)
+    layer_cache.track_every = ferrybox_track_every
+
+    # One marker collection per sampling type (instead of one per file). The layers are cached and only rebuilt
+    # when files are loaded or removed.
+
     map_widget.delete_all_markers()
     map_widget.delete_all_map_items()
-    for sampling_type in session.get_sampling_types():
-        for file_id in session.get_file_id_list(sampling_type=sampling_type):
-            if not kwargs.get('exclude_current_file') and file_id == current_file_id:
-                continue
-            # print('SAMPLING TYPE:', sampling_type, file_id)
-            if 'ferrybox' in sampling_type.lower():
-                zorder = 10
-                data = session.get_data(file_id, 'lat', 'lon')
-                map_widget.add_line(data['lat'][::ferrybox_track_every],
-                                    data['lon'][::ferrybox_track_every],
-                                    marker_id=file_id,
-                                    color=ferrybox_track_color,
-                                    zorder=zorder,
-                                    marker='.',
-                                    linestyle='')
-
-            elif 'physicalchemical' in sampling_type.lower():
-                zorder = 11
-                data = session.get_data(file_id, 'lat', 'lon')
-                # Get unique positions
-                lat_lon = sorted(set(zip(data['lat'], data['lon'])))
-                lat_list, lon_list = zip(*lat_lon)
-                map_widget.add_markers(list(lat_list), list(lon_list), marker_id=file_id, linestyle='None', marker='D',
-                                       color=physicalchemical_color, markersize=physicalchemical_markersize, zorder=zorder)
-
-            elif 'fixed platform' in sampling_type.lower():
-                zorder = 12
-                data = session.get_data(file_id, 'lat', 'lon')
-                lat = np.nanmean(data['lat'])
-                lon = np.nanmean(data['lon'])
-                # print('lat', lat)
-                # print('lon', lon)
-                map_widget.add_markers(lat, lon, marker_id=file_id, linestyle='None', marker='s',
-                                       color=fixed_platforms_color, markersize=fixed_platforms_markersize, zorder=zorder)
-
-            elif 'ctd' in sampling_type.lower():
-                zorder = 13
-                data = session.get_data(file_id, 'lat', 'lon')
-                lat = np.nanmean(data['lat'])
-                lon = np.nanmean(data['lon'])
-                # print('lat', lat)
-                # print('lon', lon)
-                map_widget.add_markers(lat, lon, marker_id=file_id, linestyle='None', marker='d',
-                                       color=ctd_shark_color, markersize=ctd_shark_markersize, zorder=zorder)
+    exclude_file_id = None if kwargs.get('exclude_current_file') else current_file_id
+    for sampling_type, layer in layer_cache.get_layers(session).items():
+        lat, lon = layer.get_positions(exclude_file_id=exclude_file_id)
+        if not len(lat):
+            continue
+        marker_id = 'background_{}'.format(sampling_type)
+        if layer.layer_type == LAYER_TRACK:
+            map_widget.add_line(lat, lon,
+                                marker_id=marker_id,
+                                color=ferrybox_track_color,
+                                zorder=10,
+                                marker='.',
+                                linestyle='')
+
+        elif layer.layer_type == LAYER_UNIQUE_POSITIONS:
+            map_widget.add_markers(lat, lon, marker_id=marker_id, linestyle='None', marker='D',
+                                   color=physicalchemical_color, markersize=physicalchemical_markersize, zorder=11)
+
+        elif 'fixed platform' in sampling_type.lower():
+            map_widget.add_markers(lat, lon, marker_id=marker_id, linestyle='None', marker='s',
+                                   color=fixed_platforms_color, markersize=fixed_platforms_markersize, zorder=12)
+
+        else:
+            map_widget.add_markers(lat, lon, marker_id=marker_id, linestyle='None', marker='d',
+                                   color=ctd_shark_color, markersize=ctd_shark_markersize, zorder=13)
+
 
 def get_file_id(string):
     """
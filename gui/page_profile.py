@@ -24,8 +24,11 @@ from sharkpylib.gismo.exceptions import *
 import core
 import gui as main_gui
 from core.exceptions import *
+from plugins.SHARKtools_qc_sensors import engine
 from plugins.SHARKtools_qc_sensors import gui
 
+tracer = engine.get_tracer(__name__)
+
 """
 ================================================================================
 ================================================================================
@@ -59,6 +62,10 @@ class PageProfile(tk.Frame):
         self.toplevel_map_widget_1 = None
         self.toplevel_map_widget_2 = None
 
+        self._hover_throttle = gui.Throttle(self, self._update_hover_position,
+                                            interval=self.user.map_prop.setdefault('ferrybox_pos_update_interval', 16),
+                                            is_locked=self.parent_app.is_session_locked)
+
         self.info_popup = self.parent_app.info_popup
 
         self.current_correlation_plot = None
@@ -78,6 +85,8 @@ class PageProfile(tk.Frame):
     def update_page(self, **kwargs):
         self.user = self.user_manager.user
         self.info_popup = self.parent_app.info_popup
+        gui.get_lod_layer(self.plot_object, value_axis='x').max_points = \
+            self.user.options.setdefault('max_plot_points_per_line', 4000)
 
         # Update filter widget
         self.select_data_widget.update_widget(**kwargs)
@@ -85,22 +94,21 @@ class PageProfile(tk.Frame):
         # Update referens file
         self._update_frame_reference_file()
 
-        self._update_map_1()  # To add background data
+        self._request_map_update(1)  # To add background data
 
     def _update_plot_background(self, file_id=None):
         if not self.current_parameter:
             return
 
-        gismo_objects = []
         if file_id:
-            gismo_objects.append(self.session.get_gismo_object(file_id))
+            # Flags changed in file_id. The background is redrawn but only file_id is read again.
+            file_id_list = self.current_file_id_list
             clear_plot = False
         else:
             file_id_list = self.select_data_widget.get_filtered_file_id_list()
-            for file_id in file_id_list:
-                gismo_objects.append(self.session.get_gismo_object(file_id))
             clear_plot = True
             self.current_file_id_list = file_id_list
+        gismo_objects = [self.session.get_gismo_object(f_id) for f_id in file_id_list]
 
         gui.communicate.update_profile_plot_background(gismo_objects=gismo_objects,
                                                                         par=self.current_parameter,
@@ -134,8 +142,7 @@ class PageProfile(tk.Frame):
         add_ref_file_list = []
 
         selected_file_id_dict = self.select_data_widget.get_selected()
-        print('selected_file_id_dict')
-        print(selected_file_id_dict)
+        tracer.debug('update_reference_files', selected=selected_file_id_dict)
 
         for item in loaded_file_list:
             if item == None:
@@ -238,44 +245,31 @@ class PageProfile(tk.Frame):
                                                     button=3)
 
     def _on_plot_hover(self):
+        # Mouse moves are collapsed to at most one position update per display refresh
+        self._hover_throttle()
+
+    def _update_hover_position(self):
         if 'ferrybox' not in self.current_sampling_type.lower():
             return
         time_num = self.plot_object.hover_x
-        # print(time_num)
-        # return
-        if not time_num:
+        if not time_num or not self.current_file_id:
             return
-        # datetime_object = datetime.datetime.fromordinal(int(time_num))
-        datetime_object = pd.Timestamp.tz_localize(pd.to_datetime(matplotlib.dates.num2date(time_num)), None)
-        # The time is rounded so we wont find the exakt time in data. Widen the search for data and pick closest point.
-        dt = pd.Timedelta(hours=1)
-        # dt = pd.to_timedelta(datetime.timedelta(days=1))
-        data = self.session.get_data(self.current_file_id, 'time', 'lat', 'lon',
-                                     filter_options={'time_start': datetime_object-dt,
-                                                     'time_end': datetime_object+dt})
-        if not len(data['time']):
+        datetime_object = matplotlib.dates.num2date(time_num)
+        # The time is rounded so we wont find the exakt time in data. Pick the closest point within an hour.
+        match_index = engine.get_match_index(self.session.get_gismo_object(self.current_file_id))
+        position = match_index.get_nearest_position(datetime_object, max_dt=pd.Timedelta(hours=1))
+        if position is None:
             self.map_widget_1.delete_marker(marker_id='position')
             return
-
-        index = 0
-        closest_t = None
-        for i, t in enumerate(data['time']):
-            t = pd.to_datetime(t)
-            dt = abs(t - datetime_object)
-            if not closest_t:
-                closest_t = dt
-            else:
-                if dt < closest_t:
-                    closest_t = dt
-                    index = i
+        lat, lon = position
 
         map_list = [self.map_widget_1, self.toplevel_map_widget_1]
 
         for map_widget in map_list:
             if not map_widget:
                 continue
-            map_widget.add_markers(lat=data['lat'][index],
-                                   lon=data['lon'][index],
+            map_widget.add_markers(lat=lat,
+                                   lon=lon,
                                    marker_id='position',
                                    marker=self.user.map_prop.setdefault('ferrybox_pos_marker', 'o'),
                                    markersize=self.user.map_prop.setdefault('ferrybox_pos_markersize', 10),
@@ -447,9 +441,11 @@ class PageProfile(tk.Frame):
 
         self.button_run_automatic_qc = tk.Button(frame, text='Run QC', command=self._run_qc)
         self.button_run_automatic_qc.grid(row=2, column=0, sticky='sw', padx=padx, pady=pady)
+        self.parent_app.add_session_widget(self.button_run_automatic_qc)
 
         tkw.grid_configure(frame, nr_rows=3)
 
+    @engine.instrumented()
     def _run_qc(self):
         """
         Runs quality control on the given file_id_list.
@@ -467,35 +463,38 @@ class PageProfile(tk.Frame):
                 return
             else:
                 file_id_list = [self.current_file_id]
+        if self.parent_app.check_session_lock('Run QC'):
+            return
         selected_qc_routines = self.qc_routine_widget.get_selected_qc_routines()
-        for qc_routine in selected_qc_routines:
-            options = self.user.qc_routine_options.get_settings(par=qc_routine)
-            # Run QC with matching file_id and qc_routines
-            try:
-                self.session.run_automatic_qc(file_id=file_id_list, qc_routine=qc_routine, **options)
-            except ImportError as e:
-                main_gui.show_error('Import error', e)
-
-            except GISMOExceptionMissingInputArgument as e:
-                if 'parameter' in e.message and 'list' in e.message:
-                    main_gui.show_warning('No parameter selected', 'You need to specify parameters for QC routine {} '
-                                                                  'Please open option ans select parameters.'.format(qc_routine))
-                    self.logger.warning(e)
-                elif 'save' in e.message and 'directory' in e.message:
-                    main_gui.show_warning('Invalid save directory', 'It seems like the saving directory for QC routine {} '
-                                                               'is not valid. Please open option and change or update '
-                                                               'directory.'.format(qc_routine))
-                    self.logger.warning(e)
-                else:
-                    main_gui.show_error('Unknown error', 'An unknown error related to missing input variable occurred. '
-                                                    f'Please contact the suupport team: shark@smhi.se\n\n{traceback.format_exc()}')
-                    self.logger.error(e)
-                return
+        routine_options = [(qc_routine, self.user.qc_routine_options.get_settings(par=qc_routine))
+                           for qc_routine in selected_qc_routines]
+
+        # Run QC with matching file_id and qc_routines
+        self.button_run_automatic_qc.configure(state='disabled')
+        self.parent_app.run_qc(file_id_list, routine_options,
+                               on_done=self._on_qc_done,
+                               on_error=lambda e: self._on_qc_error(e, file_id_list))
+
+    def _on_qc_done(self, report):
+        self.button_run_automatic_qc.configure(state='normal')
+        # Flags are changed by the qc routine
+        engine.invalidate_flag_index(report.file_id_list)
+        if gui.communicate.show_qc_report_errors(report, logger=self.logger):
+            return
 
         self.update_page(update_plot_background=True)
-        select_str = '\n'.join(selected_qc_routines)
+        select_str = '\n'.join(report.qc_routines)
         main_gui.show_information('Automatic quality control',
-                                  f'Successfully performed the following quality control(s) on {len(file_id_list)} files: \n{select_str}')
+                                  f'Successfully performed the following quality control(s) on {len(report.file_id_list)} files: \n{select_str}')
+
+    def _on_qc_error(self, exception, file_id_list):
+        self.button_run_automatic_qc.configure(state='normal')
+        engine.invalidate_flag_index(file_id_list)
+        if isinstance(exception, engine.TaskCancelled):
+            self.main_app.update_help_information('Quality control cancelled!', bg='yellow')
+        else:
+            main_gui.show_error('Run QC', f'Quality control failed:\n{exception}')
+        self.update_page()
 
     def _set_notebook_frame_map(self):
         frame = self.notebook_options.frame_map
@@ -684,6 +683,7 @@ class PageProfile(tk.Frame):
                                                     text=u'Load/update reference file',
                                                     command=self._update_file_reference)
         self.button_load_current_sample.grid(row=0, column=1, sticky='w', **pad)
+        self.parent_app.add_session_widget(self.button_load_current_sample)
 
         file_frame = tk.Frame(self.labelframe_reference)
         file_frame.grid(row=1, column=0, columnspan=2, sticky='w', **pad)
@@ -751,7 +751,7 @@ class PageProfile(tk.Frame):
             self._add_ref_data_to_plot()
 
     def old_save_correlation_plot_html(self):
-        if not gui.communicate.match_data(self, self.compare_widget):
+        if not gui.communicate.match_data(self, self.compare_widget, session_match=True):
             self.plot_object_compare.reset_plot()
             return
         match_object = self.session.get_match_object(self.current_file_id, self.current_ref_file_id)
@@ -793,8 +793,8 @@ class PageProfile(tk.Frame):
             # print('FLAG', flag)
             data = self.current_gismo_object.get_data('visit_depth_id', 'time', self.current_parameter, visit_depth_id_list=visit_depth_id_list,
                                                       mask_options=dict(include_flags=[flag]))
-            print('len()', len(self.current_gismo_object.df))
-            print('len(data)', data['visit_depth_id'])
+            tracer.debug('html_compare_flag', flag=flag, nr_rows=len(self.current_gismo_object.df),
+                         visit_depth_id=lambda: engine.array_summary(data['visit_depth_id']))
             boolean = ~np.isnan(np.array(data[self.current_parameter]))
             visit_depth_id_flag = data['visit_depth_id'][boolean]
 
@@ -843,7 +843,6 @@ class PageProfile(tk.Frame):
                                                                                       self.compare_widget,
                                                                                       self.flag_widget,
                                                                                       load_match_data=load_match_data)
-            self.current_gismo_match_object = self.session.get_match_object(self.current_file_id, self.current_ref_file_id)
             self.current_compare_selection = selection
         except GUIExceptionBreak:
             self._reset_merge_data()
@@ -860,7 +859,11 @@ class PageProfile(tk.Frame):
         #         return
 
         if 'in_timeseries' in args:
-            print('in_timeseries')
+            # The reference data is taken from the match in the session
+            try:
+                gui.communicate.match_data(self, self.compare_widget, session_match=True)
+            except GUIExceptionBreak:
+                return
             gui.communicate.add_compare_to_timeseries_plot(plot_object=self.plot_object,
                                                                             session=self.session,
                                                                             file_id=self.current_file_id,
@@ -884,13 +887,10 @@ class PageProfile(tk.Frame):
                                               color=self.user.plot_color.setdefault('correlation_line', 'red'))
 
             if 'color_by_depth' in args:
-                xx = []
-                yy = []
-                cc = []
-                for flag in sorted(data['flags']):
-                    xx.extend(list(data['flags'][flag]['x']))
-                    yy.extend(list(data['flags'][flag]['y']))
-                    cc.extend(list(data['flags'][flag]['depth']))
+                flags = sorted(data['flags'])
+                xx = np.concatenate([data['flags'][flag]['x'] for flag in flags])
+                yy = np.concatenate([data['flags'][flag]['y'] for flag in flags])
+                cc = np.concatenate([data['flags'][flag]['depth'] for flag in flags])
 
                 self.plot_object_compare.set_data(xx, yy, c=cc,
                                                   cmap='cmo.deep',
@@ -918,7 +918,7 @@ class PageProfile(tk.Frame):
 
 
     def old_compare_data_save_data(self):
-        if not gui.communicate.match_data(self, self.compare_widget):
+        if not gui.communicate.match_data(self, self.compare_widget, session_match=True):
             return
         merge_df = self.session.get_merge_data(self.current_file_id, self.current_ref_file_id)
         directory = self.save_correlation_directory_widget.get_directory()
@@ -1019,6 +1019,7 @@ class PageProfile(tk.Frame):
         self.button_save_correlation_plot_html = tk.Button(html_frame, text='Show and save correlation plots\nin HTML format',
                                                            comman=self._save_correlation_plot_html)
         self.button_save_correlation_plot_html.grid(row=0, column=0, **prop)
+        self.parent_app.add_session_widget(self.button_save_correlation_plot_html)
 
         tkw.grid_configure(html_frame, nr_rows=1)
 
@@ -1036,17 +1037,26 @@ class PageProfile(tk.Frame):
         tkw.grid_configure(frame, nr_rows=3)
 
     def _callback_save_file(self, *args, **kwargs):
+        if self.parent_app.check_session_lock('Save file'):
+            return
         gui.communicate.save_file(file_id=self.current_file_id,
                                   session=self.session,
                                   save_widget=self.save_file_widget,
+                                  incremental=self.user.process.setdefault('save_incremental', False),
                                   user=self.user.name)
         self.user.path.set('export_directory', self.save_file_widget.get_directory())
 
     def _callback_save_all_files(self, *args, **kwargs):
+        if self.parent_app.check_session_lock('Save files'):
+            return
         file_id_list = self.select_data_widget.get_filtered_file_id_list()
         gui.communicate.save_files(file_id_list=file_id_list,
                                    session=self.session,
                                    save_widget=self.save_all_files_widget,
+                                   run_task=self.parent_app.run_task,
+                                   nr_workers=self.user.process.setdefault('save_nr_threads', 4),
+                                   fsync=self.user.process.setdefault('save_fsync', False),
+                                   incremental=self.user.process.setdefault('save_incremental', False),
                                    user=self.user.name)
 
         self.user.path.set('export_directory', self.save_all_files_widget.get_directory())
@@ -1095,14 +1105,16 @@ class PageProfile(tk.Frame):
 
 
     def _callback_zaxis_widgets(self):
-        self._sync_z_axis('axis', call_targets=True)
-        self._update_map_1()
-        self._update_map_2()
+        self.parent_app.redraw_scheduler.request((id(self), 'axis', 'z'),
+                                                 lambda: self._sync_z_axis('axis', call_targets=True))
+        self._request_map_update(1)
+        self._request_map_update(2)
 
     def _callback_xaxis_widgets(self):
-        self._sync_x_axis('axis', call_targets=True)
+        self.parent_app.redraw_scheduler.request((id(self), 'axis', 'x'),
+                                                 lambda: self._sync_x_axis('axis', call_targets=True))
         # self._update_map_1()
-        self._update_map_2()
+        self._request_map_update(2)
 
     def _callback_plot_range(self):
         if not self.plot_object.mark_range_orientation:
@@ -1157,6 +1169,7 @@ class PageProfile(tk.Frame):
         self.xrange_selection_widget.reset_widget()
         self.zrange_selection_widget.reset_widget()
 
+    @engine.instrumented()
     def _on_select_parameter(self):
         # Reset plot
         # self.parent_app.update_help_information()
@@ -1168,8 +1181,7 @@ class PageProfile(tk.Frame):
         if not self.current_parameter:
             return
 
-        print('OLD', self.old_parameter)
-        print('NEW', self.current_parameter)
+        tracer.debug('select_parameter', old_parameter=self.old_parameter, parameter=self.current_parameter)
         if self.current_parameter != self.old_parameter:
             self._update_plot_background()
 
@@ -1188,7 +1200,7 @@ class PageProfile(tk.Frame):
         self._sync_x_axis('user', call_targets=False)
         self._sync_z_axis('plot', call_targets=True)
 
-        self._update_map_2()
+        self._request_map_update(2)
 
         # self.parent_app.update_help_information('Parameter updated', bg='green')
 
@@ -1209,6 +1221,8 @@ class PageProfile(tk.Frame):
         return True
 
     def _on_flag_widget_flag(self):
+        if self.parent_app.check_session_lock('Flag data'):
+            return
         if not self._check_loaded_data():
             return
         try:
@@ -1253,13 +1267,10 @@ class PageProfile(tk.Frame):
             return
         par_list = self.current_contour_parameters[contour_par]
 
-        z = []
-        y = []
-        for par in par_list:
-            z.append(self.session.get_data(self.current_file_id, par)[par])
-            y.append(float(re.findall('_\d*', par)[0].strip('_')))
-
-        x = self.session.get_data(self.current_file_id, 'time')['time']
+        # Only parameters with changed flags are read again
+        contour_grid = engine.get_contour_grid(self.session.get_gismo_object(self.current_file_id),
+                                               contour_par, par_list)
+        x, y, z = contour_grid.get_data()
         self.plot_object_contour.set_data(x, y, z, contour_plot=True)
 
     def _on_flag_widget_change(self):
@@ -1337,9 +1348,8 @@ class PageProfile(tk.Frame):
         par_list = self.session.get_parameter_list(self.current_file_id)
         striped_pars = []
         nr_list = []
-        print('='*50)
+        tracer.trace('contour_parameters', parameters=par_list)
         for par in par_list:
-            print(par, type(par))
             striped_pars.append(re.sub('_\d*', '', par))
             found = re.findall('_\d*', par)
             if found:
@@ -1391,6 +1401,16 @@ class PageProfile(tk.Frame):
         # TODO: Set directory
         self.save_file_widget.set_file_path(self.current_file_path)
 
+    def _request_map_update(self, map_nr):
+        """
+        Updates map 1 or 2 (embedded and toplevel) the next time Tk is idle. Several requests are drawn once.
+        :param map_nr:
+        :return:
+        """
+        update_function = getattr(self, f'_update_map_{map_nr}')
+        self.parent_app.redraw_scheduler.request((id(self), 'map', map_nr), update_function)
+
+    @engine.instrumented()
     def _update_map_1(self, *args, **kwargs):
         title_position = [0.5, 1.1]
         if args:
@@ -1472,6 +1492,7 @@ class PageProfile(tk.Frame):
 
 
 
+    @engine.instrumented()
     def _update_map_2(self, *args, **kwargs):
         title_position = [0.5, 1.05]
         if args:
@@ -12,6 +12,9 @@ from sharkpylib.gismo.sampling_types import SamplingTypeSettings
 
 import gui as main_gui
 from core.exceptions import *
+from plugins.SHARKtools_qc_sensors import engine
+
+tracer = engine.get_tracer(__name__)
 
 SETTINGS_FILES_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'settings_files')
 MAPPING_FILES_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'mapping_files')
@@ -524,8 +527,7 @@ class PageSamplingTypeSettings(tk.Frame):
 
         popup_geometry = f'{400}x{200}+{px}+{py}'
         popup_frame.geometry(popup_geometry)
-        print('self.main_app.geometry()', self.main_app.geometry())
-        print('popup_frame.geometry()', popup_frame.geometry())
+        tracer.trace('popup_geometry', app=self.main_app.geometry(), popup=popup_frame.geometry())
         popup_frame.protocol('WM_DELETE_WINDOW', _cancel)
         current_parameter_list = self._get_parameter_list_from_user()
 
@@ -633,7 +635,8 @@ class PageSamplingTypeSettings(tk.Frame):
                 current_par = self.combobox_widget_dependent_parameters.get_value()
                 # Add parameter to settings
                 self.settings_object.add_data('dependent_parameters', parameter, [])
-                print(self.settings_object.get_data('dependent_parameters'))
+                tracer.debug('dependent_parameters',
+                             parameters=lambda: self.settings_object.get_data('dependent_parameters'))
                 # Set parameter list
                 self.combobox_widget_dependent_parameters.update_items(self._get_dependent_parameters_from_settings())
                 if intvar_show_parameter.get():
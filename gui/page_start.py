@@ -6,6 +6,9 @@
 
 import tkinter as tk
 
+import sharkpylib.tklib.tkinter_widgets as tkw
+
+import gui as main_gui
 from plugins import SHARKtools_qc_sensors
 
 """
@@ -86,7 +89,79 @@ class PageStart(tk.Frame):
                 c = 0
                 r += 1
 
+        # Cache
+        frame_cache = self.frames[nr_rows-1][nr_columns-1]
+        self.button_clear_file_cache = tk.Button(frame_cache,
+                                                 text='Clear file cache',
+                                                 command=self._clear_file_cache)
+        self.button_clear_file_cache.grid(row=0, column=0, padx=padx, pady=pady, sticky='se')
+        frame_cache.grid_rowconfigure(0, weight=1)
+        frame_cache.grid_columnconfigure(0, weight=1)
+
+        # Timing of the instrumented functions (communicate and page callbacks)
+        self._set_frame_timing(row=nr_rows, columnspan=nr_columns, padx=padx, pady=pady)
+
+    def _set_frame_timing(self, row=0, columnspan=1, **pad):
+        frame = tk.LabelFrame(self, text='Timing')
+        frame.grid(row=row, column=0, columnspan=columnspan, sticky='nsew', **pad)
+        self.grid_rowconfigure(row, weight=1)
+
+        self.timing_columns = ['Function', 'Calls', 'Total [s]', 'Mean [ms]', 'Max [ms]', 'Last rows', 'Max mem [MB]']
+        self.table_widget_timing = tkw.TableWidget(frame,
+                                                   columns=self.timing_columns,
+                                                   row=0,
+                                                   columnspan=6,
+                                                   sticky='nsew')
+
+        instrumentation = self.controller.instrumentation
+        self.boolvar_timing_profile = tk.BooleanVar(value=instrumentation.profile)
+        self.boolvar_timing_memory = tk.BooleanVar(value=instrumentation.trace_memory)
+        tk.Checkbutton(frame, text='cProfile', variable=self.boolvar_timing_profile,
+                       command=self._on_change_timing_options).grid(row=1, column=0, sticky='w')
+        tk.Checkbutton(frame, text='Trace memory', variable=self.boolvar_timing_memory,
+                       command=self._on_change_timing_options).grid(row=1, column=1, sticky='w')
+        self.stringvar_redraws = tk.StringVar()
+        tk.Label(frame, textvariable=self.stringvar_redraws).grid(row=1, column=2, sticky='w')
+        tk.Button(frame, text='Update', command=self._update_timing).grid(row=1, column=3, sticky='e')
+        tk.Button(frame, text='Reset', command=self._reset_timing).grid(row=1, column=4, sticky='e')
+        tk.Button(frame, text='Save to log directory', command=self._dump_timing).grid(row=1, column=5, sticky='e')
+        tkw.grid_configure(frame, nr_rows=2, nr_columns=6, r0=10)
+
+    def _update_timing(self):
+        rows = []
+        for stats in self.controller.instrumentation.get_stats():
+            rows.append([stats.name,
+                         stats.nr_calls,
+                         f'{stats.total_time:.3f}',
+                         f'{stats.mean_time * 1000:.1f}',
+                         f'{stats.max_time * 1000:.1f}',
+                         '' if stats.last_size is None else stats.last_size,
+                         '' if stats.max_memory is None else f'{stats.max_memory / 1024 ** 2:.1f}'])
+        self.table_widget_timing.reset_table()
+        if rows:
+            self.table_widget_timing.set_table(rows)
+        counters = self.controller.redraw_scheduler.get_counters()
+        self.stringvar_redraws.set(f'Redraws: {counters["requests"]} requested, {counters["renders"]} rendered, '
+                                   f'{counters["saved"]} saved')
+
+    def _reset_timing(self):
+        self.controller.instrumentation.reset()
+        self.controller.redraw_scheduler.reset_counters()
+        self._update_timing()
+
+    def _on_change_timing_options(self):
+        self.controller.set_instrumentation_options(profile=self.boolvar_timing_profile.get(),
+                                                    trace_memory=self.boolvar_timing_memory.get())
+
+    def _dump_timing(self):
+        file_path = self.controller.dump_timing()
+        main_gui.show_information('Timing', f'Timing saved to:\n{file_path}')
+
+    def _clear_file_cache(self):
+        nr_removed, removed_size = self.controller.clear_file_cache()
+        main_gui.show_information('Clear file cache',
+                                  f'{nr_removed} parsed files ({removed_size/1024/1024:.1f} MB) removed from cache.')
 
     #===========================================================================
     def update_page(self):
-        pass
\ No newline at end of file
+        self._update_timing()
\ No newline at end of file
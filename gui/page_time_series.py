@@ -7,7 +7,6 @@
 import datetime
 import logging
 import os
-import re
 from pathlib import Path
 import tkinter as tk
 from tkinter import messagebox
@@ -28,8 +27,11 @@ from sharkpylib.odv.create import SimpleODVfile
 import core
 import gui as main_gui
 from core.exceptions import *
+from plugins.SHARKtools_qc_sensors import engine
 from plugins.SHARKtools_qc_sensors import gui
 
+tracer = engine.get_tracer(__name__)
+
 """
 ================================================================================
 ================================================================================
@@ -60,6 +62,10 @@ class PageTimeSeries(tk.Frame):
         self.toplevel_map_widget_1 = None
         self.toplevel_map_widget_2 = None
 
+        self._hover_throttle = gui.Throttle(self, self._update_hover_position,
+                                            interval=self.user.map_prop.setdefault('ferrybox_pos_update_interval', 16),
+                                            is_locked=self.parent_app.is_session_locked)
+
         self.info_popup = self.parent_app.info_popup
 
         self.current_correlation_plot = None
@@ -78,12 +84,14 @@ class PageTimeSeries(tk.Frame):
     def update_page(self):
         self.user = self.user_manager.user
         self.info_popup = self.parent_app.info_popup
+        gui.get_lod_layer(self.plot_object, value_axis='y').max_points = \
+            self.user.options.setdefault('max_plot_points_per_line', 4000)
 
         self._update_frame_data_file()
         self._update_frame_reference_file()
         self._check_on_remove_file()
 
-        self._update_map_1() # To add background data
+        self._request_map_update(1) # To add background data
 
     def _reset_merge_data(self):
         self.current_gismo_match_object = None
@@ -186,44 +194,31 @@ class PageTimeSeries(tk.Frame):
                                          include_toolbar=False)
 
     def _on_plot_hover(self):
+        # Mouse moves are collapsed to at most one position update per display refresh
+        self._hover_throttle()
+
+    def _update_hover_position(self):
         if 'ferrybox' not in self.current_sampling_type.lower():
             return
         time_num = self.plot_object.hover_x
-        # print(time_num)
-        # return
-        if not time_num:
+        if not time_num or not self.current_file_id:
             return
-        # datetime_object = datetime.datetime.fromordinal(int(time_num))
-        datetime_object = pd.Timestamp.tz_localize(pd.to_datetime(matplotlib.dates.num2date(time_num)), None)
-        # The time is rounded so we wont find the exakt time in data. Widen the search for data and pick closest point.
-        dt = pd.Timedelta(hours=1)
-        # dt = pd.to_timedelta(datetime.timedelta(days=1))
-        data = self.session.get_data(self.current_file_id, 'time', 'lat', 'lon',
-                                     filter_options={'time_start': datetime_object-dt,
-                                                     'time_end': datetime_object+dt})
-        if not len(data['time']):
+        datetime_object = matplotlib.dates.num2date(time_num)
+        # The time is rounded so we wont find the exakt time in data. Pick the closest point within an hour.
+        match_index = engine.get_match_index(self.session.get_gismo_object(self.current_file_id))
+        position = match_index.get_nearest_position(datetime_object, max_dt=pd.Timedelta(hours=1))
+        if position is None:
             self.map_widget_1.delete_marker(marker_id='position')
             return
-
-        index = 0
-        closest_t = None
-        for i, t in enumerate(data['time']):
-            t = pd.to_datetime(t)
-            dt = abs(t - datetime_object)
-            if not closest_t:
-                closest_t = dt
-            else:
-                if dt < closest_t:
-                    closest_t = dt
-                    index = i
+        lat, lon = position
 
         map_list = [self.map_widget_1, self.toplevel_map_widget_1]
 
         for map_widget in map_list:
             if not map_widget:
                 continue
-            map_widget.add_markers(lat=data['lat'][index],
-                                   lon=data['lon'][index],
+            map_widget.add_markers(lat=lat,
+                                   lon=lon,
                                    marker_id='position',
                                    marker=self.user.map_prop.setdefault('ferrybox_pos_marker', 'o'),
                                    markersize=self.user.map_prop.setdefault('ferrybox_pos_markersize', 10),
@@ -306,6 +301,7 @@ class PageTimeSeries(tk.Frame):
                                              text='Update data file',
                                              command=self._update_file)
         self.button_load_current.grid(row=0, column=1, sticky='w', **pad)
+        self.parent_app.add_session_widget(self.button_load_current)
 
         file_frame = tk.Frame(self.labelframe_data)
         file_frame.grid(row=1, column=0, columnspan=2, sticky='w', **pad)
@@ -394,6 +390,7 @@ class PageTimeSeries(tk.Frame):
 
         self.button_run_automatic_qc = tk.Button(frame, text='Run QC', command=self._run_qc)
         self.button_run_automatic_qc.grid(row=2, column=0, sticky='sw', padx=padx, pady=pady)
+        self.parent_app.add_session_widget(self.button_run_automatic_qc)
 
         tkw.grid_configure(frame, nr_rows=3, nr_columns=2)
 
@@ -408,6 +405,7 @@ class PageTimeSeries(tk.Frame):
         # self.button_run_automatic_qc.grid(row=0, column=1, **grip_prop)
         # tkw.grid_configure(frame, nr_columns=2)
 
+    @engine.instrumented()
     def _run_qc(self):
         """
         Runs quality control on the given file_id_list.
@@ -425,35 +423,38 @@ class PageTimeSeries(tk.Frame):
                 return
             else:
                 file_id_list = [self.current_file_id]
+        if self.parent_app.check_session_lock('Run QC'):
+            return
         selected_qc_routines = self.qc_routine_widget.get_selected_qc_routines()
-        for qc_routine in selected_qc_routines:
-            options = self.user.qc_routine_options.get_settings(par=qc_routine)
-            # Run QC with matching file_id and qc_routines
-            try:
-                self.session.run_automatic_qc(file_id=file_id_list, qc_routine=qc_routine, **options)
-            except ImportError as e:
-                main_gui.show_error('Import error', e)
-
-            except GISMOExceptionMissingInputArgument as e:
-                if 'parameter' in e.message and 'list' in e.message:
-                    main_gui.show_warning('No parameter selected', 'You need to specify parameters for QC routine {} '
-                                                                  'Please open option ans select parameters.'.format(qc_routine))
-                    self.logger.warning(e)
-                elif 'save' in e.message and 'directory' in e.message:
-                    main_gui.show_warning('Invalid save directory', 'It seems like the saving directory for QC routine {} '
-                                                               'is not valid. Please open option and change or update '
-                                                               'directory.'.format(qc_routine))
-                    self.logger.warning(e)
-                else:
-                    main_gui.show_error('Unknown error', 'An unknown error related to missing input variable occurred. '
-                                                   f'Please contact the suupport team: shark@smhi.se\n\n{traceback.format_exc()}')
-                    self.logger.error(e)
-                return
+        routine_options = [(qc_routine, self.user.qc_routine_options.get_settings(par=qc_routine))
+                           for qc_routine in selected_qc_routines]
+
+        # Run QC with matching file_id and qc_routines
+        self.button_run_automatic_qc.configure(state='disabled')
+        self.parent_app.run_qc(file_id_list, routine_options,
+                               on_done=self._on_qc_done,
+                               on_error=lambda e: self._on_qc_error(e, file_id_list))
+
+    def _on_qc_done(self, report):
+        self.button_run_automatic_qc.configure(state='normal')
+        # Flags are changed by the qc routine
+        engine.invalidate_flag_index(report.file_id_list)
+        if gui.communicate.show_qc_report_errors(report, logger=self.logger):
+            return
 
         self.update_page()
-        select_str = '\n'.join(selected_qc_routines)
+        select_str = '\n'.join(report.qc_routines)
         main_gui.show_information('Automatic quality control',
-                                  f'Successfully performed the following quality control(s) on {len(file_id_list)} files: \n{select_str}')
+                                  f'Successfully performed the following quality control(s) on {len(report.file_id_list)} files: \n{select_str}')
+
+    def _on_qc_error(self, exception, file_id_list):
+        self.button_run_automatic_qc.configure(state='normal')
+        engine.invalidate_flag_index(file_id_list)
+        if isinstance(exception, engine.TaskCancelled):
+            self.main_app.update_help_information('Quality control cancelled!', bg='yellow')
+        else:
+            main_gui.show_error('Run QC', f'Quality control failed:\n{exception}')
+        self.update_page()
 
     def _set_notebook_frame_map(self):
         frame = self.notebook_options.frame_map
@@ -596,15 +597,17 @@ class PageTimeSeries(tk.Frame):
 #        self.button_lasso_select.grid(row=r, column=c, padx=padx, pady=pady, sticky='se')
 
     def _run_automatic_qc(self):
-        try:
-            qc_routine_list = gui.communicate.run_automatic_qc(self, self.widget_automatic_qc_options)
-            if qc_routine_list:
-                if messagebox.askyesno('Automatic QC',
-                                       'The following automatic quality control(s) are finished:\n\n{}\n\n'
-                                       'Do you want to reload plots?'.format('\n'.join(sorted(qc_routine_list)))):
-                    self._on_select_parameter()
-        except GISMOExceptionInvalidFlag as e:
-            gui.show_information('QC failed', e.message)
+        def on_done(qc_routine_list):
+            if messagebox.askyesno('Automatic QC',
+                                   'The following automatic quality control(s) are finished:\n\n{}\n\n'
+                                   'Do you want to reload plots?'.format('\n'.join(sorted(qc_routine_list)))):
+                self._on_select_parameter()
+
+        def on_error(e):
+            if isinstance(e, GISMOExceptionInvalidFlag):
+                gui.show_information('QC failed', e.message)
+
+        gui.communicate.run_automatic_qc(self, self.widget_automatic_qc_options, on_done=on_done, on_error=on_error)
 
     def _update_notebook_frame_flag(self):
         """
@@ -670,6 +673,7 @@ class PageTimeSeries(tk.Frame):
                                                     text=u'Load/update reference file',
                                                     command=self._update_file_reference)
         self.button_load_current_sample.grid(row=0, column=1, sticky='w', **pad)
+        self.parent_app.add_session_widget(self.button_load_current_sample)
 
         file_frame = tk.Frame(self.labelframe_reference)
         file_frame.grid(row=1, column=0, columnspan=2, sticky='w', **pad)
@@ -695,20 +699,24 @@ class PageTimeSeries(tk.Frame):
         self.button_compare_plot_in_timeseries = tk.Button(button_frame, text='Plot in time series',
                                                       comman=lambda: self._compare_data_plot('in_timeseries'))
         self.button_compare_plot_in_timeseries.grid(row=0, column=0, sticky='nsew', **pad)
+        self.parent_app.add_session_widget(self.button_compare_plot_in_timeseries)
 
         self.button_compare_plot_by_flags = tk.Button(button_frame, text='Plot correlation plot\n(color by flag)',
                                                   comman=lambda: self._compare_data_plot('color_by_flag'))
         self.button_compare_plot_by_flags.grid(row=0, column=1, sticky='nsew', **pad)
+        self.parent_app.add_session_widget(self.button_compare_plot_by_flags)
 
         self.button_compare_plot_by_depth = tk.Button(button_frame, text='Plot correlation plot\n(color by depth)',
                                                       comman=lambda: self._compare_data_plot('color_by_depth'))
         self.button_compare_plot_by_depth.grid(row=0, column=2, sticky='nsew', **pad)
+        self.parent_app.add_session_widget(self.button_compare_plot_by_depth)
 
         # Button save data
         self.button_compare_save_data = tk.Button(button_frame, text='Save correlated dataset\n'
                                                                      '(tab separated ascii file)',
                                                   comman=self._compare_data_save_data)
         self.button_compare_save_data.grid(row=0, column=3, sticky='nsew', **pad)
+        self.parent_app.add_session_widget(self.button_compare_save_data)
 
         self.save_correlation_directory_widget = tkw.DirectoryWidgetLabelframe(button_frame,
                                                                                label='Save directory',
@@ -722,7 +730,9 @@ class PageTimeSeries(tk.Frame):
         tkw.grid_configure(frame, nr_rows=3)
 
     def _save_correlation_plot_html(self):
-        if not gui.communicate.match_data(self, self.compare_widget):
+        if self.parent_app.check_session_lock('Save correlation plots'):
+            return
+        if not gui.communicate.match_data(self, self.compare_widget, session_match=True):
             self.plot_object_compare.reset_plot()
             return
         match_object = self.session.get_match_object(self.current_file_id, self.current_ref_file_id)
@@ -764,8 +774,8 @@ class PageTimeSeries(tk.Frame):
             # print('FLAG', flag)
             data = self.current_gismo_object.get_data('visit_depth_id', 'time', self.current_parameter, visit_depth_id_list=visit_depth_id_list,
                                                       mask_options=dict(include_flags=[flag]))
-            print('len()', len(self.current_gismo_object.df))
-            print('len(data)', data['visit_depth_id'])
+            tracer.debug('html_compare_flag', flag=flag, nr_rows=len(self.current_gismo_object.df),
+                         visit_depth_id=lambda: engine.array_summary(data['visit_depth_id']))
             boolean = ~np.isnan(np.array(data[self.current_parameter]))
             visit_depth_id_flag = data['visit_depth_id'][boolean]
 
@@ -800,21 +810,30 @@ class PageTimeSeries(tk.Frame):
         plot_object.plot_to_file(os.path.join(self.save_plots_directory_widget.get_directory(),
                                               '{}_{}.html'.format(current_par_name, compare_par_name)))
 
-    def _compare_data_plot(self, *args):
+    def _compare_data_plot(self, *args, matched=False):
+
+        if self.parent_app.check_session_lock('Compare data'):
+            return
+        selection = self.compare_widget.get_selection()
+        if selection != self.current_compare_selection and not matched:
+            # Match in a worker thread and plot when done
+            try:
+                gui.communicate.match_data_in_background(self,
+                                                         self.compare_widget,
+                                                         on_done=lambda: self._compare_data_plot(*args, matched=True),
+                                                         on_fail=self._reset_merge_data)
+            except GUIExceptionBreak:
+                self._reset_merge_data()
+            return
 
         # Recreate plot object if
         self._set_notebook_compare_plot()
 
-        selection = self.compare_widget.get_selection()
-        load_match_data = False
-        if selection != self.current_compare_selection:
-            load_match_data = True
         try:
             self.current_merge_data = gui.communicate.get_merge_data(self,
                                                                                       self.compare_widget,
                                                                                       self.flag_widget,
-                                                                                      load_match_data=load_match_data)
-            self.current_gismo_match_object = self.session.get_match_object(self.current_file_id, self.current_ref_file_id)
+                                                                                      load_match_data=False)
             self.current_compare_selection = selection
         except GUIExceptionBreak:
             self._reset_merge_data()
@@ -831,7 +850,11 @@ class PageTimeSeries(tk.Frame):
         #         return
 
         if 'in_timeseries' in args:
-            print('in_timeseries')
+            # The reference data is taken from the match in the session
+            try:
+                gui.communicate.match_data(self, self.compare_widget, session_match=True)
+            except GUIExceptionBreak:
+                return
             gui.communicate.add_compare_to_timeseries_plot(plot_object=self.plot_object,
                                                                             session=self.session,
                                                                             file_id=self.current_file_id,
@@ -855,13 +878,10 @@ class PageTimeSeries(tk.Frame):
                                               color=self.user.plot_color.setdefault('correlation_line', 'red'))
 
             if 'color_by_depth' in args:
-                xx = []
-                yy = []
-                cc = []
-                for flag in sorted(data['flags']):
-                    xx.extend(list(data['flags'][flag]['x']))
-                    yy.extend(list(data['flags'][flag]['y']))
-                    cc.extend(list(data['flags'][flag]['depth']))
+                flags = sorted(data['flags'])
+                xx = np.concatenate([data['flags'][flag]['x'] for flag in flags])
+                yy = np.concatenate([data['flags'][flag]['y'] for flag in flags])
+                cc = np.concatenate([data['flags'][flag]['depth'] for flag in flags])
 
                 self.plot_object_compare.set_data(xx, yy, c=cc,
                                                   cmap='cmo.deep',
@@ -888,7 +908,9 @@ class PageTimeSeries(tk.Frame):
             self.plot_object_compare.set_y_label(data['compare_par_file_id'])
 
     def _compare_data_save_data(self):
-        if not gui.communicate.match_data(self, self.compare_widget):
+        if self.parent_app.check_session_lock('Save correlated dataset'):
+            return
+        if not gui.communicate.match_data(self, self.compare_widget, session_match=True):
             return
         merge_df = self.session.get_merge_data(self.current_file_id, self.current_ref_file_id)
         directory = self.save_correlation_directory_widget.get_directory()
@@ -982,6 +1004,7 @@ class PageTimeSeries(tk.Frame):
         self.button_save_correlation_plot_html = tk.Button(html_frame, text='Show and save correlation plots\nin HTML format',
                                                            comman=self._save_correlation_plot_html)
         self.button_save_correlation_plot_html.grid(row=0, column=0, **prop)
+        self.parent_app.add_session_widget(self.button_save_correlation_plot_html)
 
         tkw.grid_configure(html_frame, nr_rows=1)
 
@@ -999,10 +1022,13 @@ class PageTimeSeries(tk.Frame):
         tkw.grid_configure(frame, nr_rows=3)
 
     def _callback_save_file(self, *args, **kwargs):
+        if self.parent_app.check_session_lock('Save file'):
+            return
         try:
             gui.communicate.save_file(file_id=self.current_file_id,
                                       session=self.session,
-                                      save_widget=self.save_file_widget)
+                                      save_widget=self.save_file_widget,
+                                      incremental=self.user.process.setdefault('save_incremental', False))
         except Exception as e:
             main_gui.show_warning('Save file', f'Something went wrong when trying to save file: {e}')
 
@@ -1052,26 +1078,13 @@ class PageTimeSeries(tk.Frame):
                                                           call_targets=False,
                                                           source='axis')
         """
-        gui.communicate.sync_limits_in_plot_user_and_axis(plot_object=self.plot_object,
-                                                                           user_object=self.user,
-                                                                           axis_widget=self.xrange_widget,
-                                                                           par='time',
-                                                                           axis='x',
-                                                                           call_targets=True,
-                                                                           source='axis')
-
-        self._update_map_1()
-        self._update_map_2()
+        self._request_axis_sync('x')
+        self._request_map_update(1)
+        self._request_map_update(2)
 
     def _callback_yaxis_widgets(self):
 
-        gui.communicate.sync_limits_in_plot_user_and_axis(plot_object=self.plot_object,
-                                                                           user_object=self.user,
-                                                                           axis_widget=self.yrange_widget,
-                                                                           par=self.current_parameter,
-                                                                           axis='y',
-                                                                           call_targets=True,
-                                                                           source='axis')
+        self._request_axis_sync('y')
         """
         gui.communicate.sync_limits_in_plot_user_and_axis(plot_object=self.plot_object,
                                                           user_object=self.user,
@@ -1082,7 +1095,7 @@ class PageTimeSeries(tk.Frame):
                                                           source='axis')
         """
         # self._update_map_1()
-        self._update_map_2()
+        self._request_map_update(2)
 
     def _callback_plot_range(self):
         if not self.plot_object.mark_range_orientation:
@@ -1130,6 +1143,7 @@ class PageTimeSeries(tk.Frame):
         self.xrange_selection_widget.reset_widget()
         self.yrange_selection_widget.reset_widget()
 
+    @engine.instrumented()
     def _on_select_parameter(self):
         # Reset plot
         self.main_app.update_help_information()
@@ -1137,7 +1151,7 @@ class PageTimeSeries(tk.Frame):
 
         self.current_parameter = self.parameter_widget.get_value()
 
-        print('current_parameter', self.current_parameter)
+        tracer.debug('select_parameter', parameter=self.current_parameter)
         if not self.current_parameter:
             raise GISMOException('No parameter selected')
 
@@ -1167,7 +1181,7 @@ class PageTimeSeries(tk.Frame):
                                                                            call_targets=True,
                                                                            source='plot')
 
-        self._update_map_2()
+        self._request_map_update(2)
 
         self.main_app.update_help_information('Parameter updated', bg='green')
 
@@ -1188,16 +1202,25 @@ class PageTimeSeries(tk.Frame):
         return True
 
     def _on_flag_widget_flag(self):
+        if self.parent_app.check_session_lock('Flag data'):
+            return
         if not self._check_loaded_data():
             return
         try:
-            gui.flag_data_time_series(flag_widget=self.flag_widget,
-                                      gismo_object=self.current_gismo_object,
-                                      plot_object=self.plot_object,
-                                      par=self.current_parameter)
-            self._update_plot()
+            changed_rows = gui.flag_data_time_series(flag_widget=self.flag_widget,
+                                                     gismo_object=self.current_gismo_object,
+                                                     plot_object=self.plot_object,
+                                                     par=self.current_parameter)
             self.xrange_selection_widget.clear_widget()
             self.yrange_selection_widget.clear_widget()
+            if self.user.options.setdefault('incremental_plot_update_on_flag', True):
+                gui.update_time_series_plot_flags(gismo_object=self.current_gismo_object,
+                                                  par=self.current_parameter,
+                                                  plot_object=self.plot_object,
+                                                  flag_widget=self.flag_widget,
+                                                  changed_rows=changed_rows)
+            else:
+                self._update_plot()
         except GUIExceptionNoRangeSelection:
             self.logger.info('You need to make a selection under tab "Select data to flag" before you can flag data')
             messagebox.showinfo('Could not flag data',
@@ -1236,13 +1259,10 @@ class PageTimeSeries(tk.Frame):
             return
         par_list = self.current_contour_parameters[contour_par]
 
-        z = []
-        y = []
-        for par in par_list:
-            z.append(self.session.get_data(self.current_file_id, par)[par])
-            y.append(float(re.findall('_\d*', par)[0].strip('_')))
-
-        x = self.session.get_data(self.current_file_id, 'time')['time']
+        # Only parameters with changed flags are read again
+        contour_grid = engine.get_contour_grid(self.session.get_gismo_object(self.current_file_id),
+                                               contour_par, par_list)
+        x, y, z = contour_grid.get_data()
         self.plot_object_contour.set_data(x, y, z, contour_plot=True)
 
     def _on_flag_widget_change(self):
@@ -1316,44 +1336,12 @@ class PageTimeSeries(tk.Frame):
         :return:
         """
         par_list = self.session.get_parameter_list(self.current_file_id)
-        striped_pars = []
-        nr_list = []
-        print('='*50)
-        for par in par_list:
-            print(par, type(par))
-            striped_pars.append(re.sub('_\d*', '', par))
-            found = re.findall('_\d*', par)
-            if found:
-                nr_list.append(int(found[0].strip('_')))
-            else:
-                nr_list.append(0)
-
-        par_list = np.array(par_list)
-        striped_pars = np.array(striped_pars)
-        nr_list = np.array(nr_list)
-
-        self.current_contour_parameters = dict()
-        for spar in set(striped_pars):
-            if list(striped_pars).count(spar) > 1:
-                boolean = striped_pars == spar
-                par_dict = dict(zip(par_list[boolean], nr_list[boolean]))
-                sorted_par_list = [item[0] for item in sorted(par_dict.items(), key=lambda kv: kv[1], reverse=True)]
-                self.current_contour_parameters[spar] = sorted_par_list
-
-        #     self.current_contour_parameters[par] = sorted_par_listself.current_contour_parameters = dict()
-        # for par in set(striped_pars):
-        #     if list(striped_pars).count(par) > 1:
-        #         self.current_contour_parameters[par] = []
-        #
-        # for spar in self.current_contour_parameters:
-        #     boolean = striped_pars == spar
-        #     par_dict = dict(zip(striped_pars[boolean], nr_list[boolean]))
-        #     sorted_par_list = [item[0] for item in sorted(par_dict.items(), key=lambda kv: kv[1], reverse=True)]
-        #     self.current_contour_parameters[par] = sorted_par_list
+        self.current_contour_parameters = engine.get_contour_parameters(par_list)
 
         self.parameter_contour_plot_widget.update_items(sorted(self.current_contour_parameters))
 
     #===========================================================================
+    @engine.instrumented()
     def _update_file(self):
         self._set_current_file()
 
@@ -1376,7 +1364,7 @@ class PageTimeSeries(tk.Frame):
 
         self._on_select_parameter()
 
-        self._update_map_1()
+        self._request_map_update(1)
 
         self._update_frame_save_widgets()
 
@@ -1404,6 +1392,36 @@ class PageTimeSeries(tk.Frame):
         # TODO: Set directory
         self.save_file_widget.set_file_path(self.current_file_path)
 
+    def _request_axis_sync(self, axis):
+        """
+        Syncs the plot with the axis widget the next time Tk is idle.
+        :param axis: "x" (time) or "y" (parameter)
+        :return:
+        """
+        def sync():
+            if axis == 'x':
+                axis_widget, par = self.xrange_widget, 'time'
+            else:
+                axis_widget, par = self.yrange_widget, self.current_parameter
+            gui.communicate.sync_limits_in_plot_user_and_axis(plot_object=self.plot_object,
+                                                              user_object=self.user,
+                                                              axis_widget=axis_widget,
+                                                              par=par,
+                                                              axis=axis,
+                                                              call_targets=True,
+                                                              source='axis')
+        self.parent_app.redraw_scheduler.request((id(self), 'axis', axis), sync)
+
+    def _request_map_update(self, map_nr):
+        """
+        Updates map 1 or 2 (embedded and toplevel) the next time Tk is idle. Several requests are drawn once.
+        :param map_nr:
+        :return:
+        """
+        update_function = getattr(self, f'_update_map_{map_nr}')
+        self.parent_app.redraw_scheduler.request((id(self), 'map', map_nr), update_function)
+
+    @engine.instrumented()
     def _update_map_1(self, *args, **kwargs):
         title_position = [0.5, 1.1]
         if args:
@@ -1461,6 +1479,7 @@ class PageTimeSeries(tk.Frame):
 
                 map_widget.set_title(title, position=title_position)
 
+    @engine.instrumented()
     def _update_map_2(self, *args, **kwargs):
         title_position = [0.5, 1.05]
         if args:
@@ -1537,7 +1556,7 @@ class PageTimeSeries(tk.Frame):
     def _check_on_remove_file(self):
         if not self.stringvar_current_data_file.get():
             self.plot_object.reset_plot()
-            self._update_map_1()
+            self._request_map_update(1)
             # self._update_map_2()
             self.save_file_widget.set_file_path()  # Resets the plot
             # self.save_plot_widget.set_file_path()  # Resets the plot
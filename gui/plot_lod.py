@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import weakref
+
+import numpy as np
+import pandas as pd
+import matplotlib.dates as dates
+
+from plugins.SHARKtools_qc_sensors.engine.decimate import decimate_for_view
+
+# One LodLayer per plot_object. See get_lod_layer.
+_lod_layers = weakref.WeakKeyDictionary()
+
+
+def _to_num(array):
+    """
+    Returns array as floats. Time is converted to matplotlib date numbers.
+    """
+    array = np.asarray(array)
+    if array.dtype.kind in 'mM':
+        return dates.date2num(array)
+    if array.dtype.kind == 'O':
+        try:
+            return np.asarray(array, dtype=float)
+        except (TypeError, ValueError):
+            return dates.date2num(pd.to_datetime(array).values)
+    return array.astype(float)
+
+
+class LodLayer(object):
+    """
+    Level of detail layer between the plot functions in communicate and a plot_selector.Plot.
+    Lines with more than max_points points are decimated (min/max) before they are given to the plot object.
+    The full resolution data is kept and the lines are decimated again for the visible range when the
+    axes limits change. The data of a line can be replaced in place with update_data. Flagging always works on the data in the gismo object and is not affected.
+    """
+    def __init__(self, plot_object, value_axis='y', max_points=4000):
+        """
+        :param plot_object: sharkpylib.plot.plot_selector.Plot
+        :param value_axis: The axis holding the parameter values. 'y' for time series and 'x' for profiles.
+        :param max_points: Max number of points per line within the view.
+        """
+        self.plot_object = plot_object
+        self.value_axis = value_axis
+        self.max_points = max_points
+        self._lines = {}
+        self._ax = None
+        self._callbacks = None
+
+    def _get_ax(self):
+        return self.plot_object.fig.axes[0]
+
+    def _connect(self):
+        # The callback registry of the axes is replaced when the axes is cleared
+        ax = self._get_ax()
+        if ax is self._ax and ax.callbacks is self._callbacks:
+            return
+        self._ax = ax
+        self._callbacks = ax.callbacks
+        ax.callbacks.connect('xlim_changed', self._on_limits_changed)
+        ax.callbacks.connect('ylim_changed', self._on_limits_changed)
+
+    def set_data(self, x=None, y=None, line_id=None, call_targets=True, **prop):
+        """
+        Same as plot_object.set_data.
+        """
+        x = np.asarray(x)
+        y = np.asarray(y)
+        self._lines.pop(line_id, None)
+        self._connect()
+        item = self._get_item(x, y)
+        positions = item['positions']
+
+        ax = self._get_ax()
+        lines_before = set(ax.lines)
+        self.plot_object.set_data(x=x[positions], y=y[positions], line_id=line_id, call_targets=call_targets, **prop)
+        new_lines = [line for line in ax.lines if line not in lines_before]
+        if len(new_lines) != 1:
+            # The line can not be identified. Keep the decimation for the full range.
+            return
+        item['line'] = new_lines[0]
+        self._lines[line_id] = item
+
+    def update_data(self, x=None, y=None, line_id=None):
+        """
+        Replaces the data of the line added with set_data in place (Line2D.set_data). The line keeps its artist and
+        properties, so only the data area of the plot has to be repainted.
+        :return: False if there is no line for line_id. Use set_data then.
+        """
+        old_item = self._lines.get(line_id)
+        if old_item is None or not self._is_in_plot(old_item['line']):
+            self._lines.pop(line_id, None)
+            return False
+        x = np.asarray(x)
+        y = np.asarray(y)
+        ax = old_item['line'].axes
+        item = self._get_item(x, y, view=(tuple(ax.get_xlim()), tuple(ax.get_ylim())))
+        item['line'] = old_item['line']
+        self._lines[line_id] = item
+        item['line'].set_data(x[item['positions']], y[item['positions']])
+        return True
+
+    def _get_item(self, x, y, view=None):
+        """
+        Returns the full resolution data of a line and the positions to plot (within view if given).
+        """
+        if len(x) <= self.max_points:
+            return dict(x=x, y=y, decimated=False, positions=slice(None), view=None)
+        x_num = _to_num(x)
+        y_num = _to_num(y)
+        values = y_num if self.value_axis == 'y' else x_num
+        view_mask = None
+        if view is not None:
+            view_mask = self._get_view_mask(x_num, y_num, view)
+        return dict(x=x,
+                    y=y,
+                    x_num=x_num,
+                    y_num=y_num,
+                    values=values,
+                    decimated=True,
+                    positions=decimate_for_view(values, self.max_points, view_mask=view_mask),
+                    view=view)
+
+    @staticmethod
+    def _get_view_mask(x_num, y_num, view):
+        (x_min, x_max), (y_min, y_max) = view
+        return (x_num >= min(x_min, x_max)) & (x_num <= max(x_min, x_max)) & \
+               (y_num >= min(y_min, y_max)) & (y_num <= max(y_min, y_max))
+
+    @staticmethod
+    def _is_in_plot(line):
+        return line.axes is not None and line in line.axes.lines
+
+    def delete_data(self, line_id):
+        """
+        Same as plot_object.delete_data.
+        """
+        self._lines.pop(line_id, None)
+        self.plot_object.delete_data(line_id)
+
+    def _on_limits_changed(self, ax):
+        view = (tuple(ax.get_xlim()), tuple(ax.get_ylim()))
+        for line_id, item in list(self._lines.items()):
+            line = item['line']
+            if line.axes is not ax or line not in ax.lines:
+                # Removed by plot_object (e.g. reset_plot)
+                self._lines.pop(line_id)
+                continue
+            if not item['decimated'] or item['view'] == view:
+                continue
+            item['view'] = view
+            view_mask = self._get_view_mask(item['x_num'], item['y_num'], view)
+            positions = decimate_for_view(item['values'], self.max_points, view_mask=view_mask)
+            line.set_data(item['x'][positions], item['y'][positions])
+
+
+def get_lod_layer(plot_object, value_axis='y'):
+    """
+    Returns the LodLayer for the given plot_object.
+    :param plot_object: sharkpylib.plot.plot_selector.Plot
+    :param value_axis: Used when the layer is created.
+    :return: LodLayer
+    """
+    lod_layer = _lod_layers.get(plot_object)
+    if lod_layer is None:
+        lod_layer = LodLayer(plot_object, value_axis=value_axis)
+        _lod_layers[plot_object] = lod_layer
+    return lod_layer
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import weakref
+
+# One AxesRepainter per matplotlib axes. See get_repainter.
+_repainters = weakref.WeakKeyDictionary()
+
+
+class AxesRepainter(object):
+    """
+    Repaints only the data area of a matplotlib axes (blitting).
+    The lines of the axes are marked as animated so that ordinary draws of the canvas leave them out. The
+    background (the axes without its lines) is then captured in every draw_event and the lines are drawn on top.
+    On repaint the captured background is restored, the lines are drawn and only the axes area of the canvas is
+    updated. Ticks, labels, title and other widgets are not redrawn.
+    Animated lines are still included when the figure is saved.
+    """
+    def __init__(self, ax):
+        self.ax = ax
+        self._background = None
+        self._background_key = None
+        self.nr_repaints = 0
+        self.nr_full_draws = 0
+        self.ax.figure.canvas.mpl_connect('draw_event', self._on_draw)
+
+    @property
+    def canvas(self):
+        # The canvas is replaced when the figure is added to a tk widget
+        return self.ax.figure.canvas
+
+    def _set_lines_animated(self):
+        """
+        Marks lines added since the last draw as animated.
+        :return: True if any line was changed
+        """
+        changed = False
+        for line in self.ax.lines:
+            if not line.get_animated():
+                line.set_animated(True)
+                changed = True
+        return changed
+
+    def _draw_lines(self):
+        for line in self.ax.lines:
+            if line.get_visible():
+                self.ax.draw_artist(line)
+
+    def _get_background_key(self):
+        return tuple(self.ax.get_xlim()), tuple(self.ax.get_ylim()), tuple(self.ax.bbox.bounds)
+
+    def _on_draw(self, event):
+        canvas = event.canvas
+        if canvas.is_saving() or not getattr(canvas, 'supports_blit', False):
+            return
+        if self._set_lines_animated():
+            # The new lines were drawn as ordinary artists and are part of this draw
+            self._background = None
+            return
+        self._background = canvas.copy_from_bbox(self.ax.bbox)
+        self._background_key = self._get_background_key()
+        # Animated lines are left out of the draw. Drawn here on top of the captured background.
+        self._draw_lines()
+
+    def repaint(self):
+        """
+        Repaints the lines in the axes.
+        :return:
+        """
+        canvas = self.canvas
+        if not getattr(canvas, 'supports_blit', False):
+            canvas.draw_idle()
+            return
+        if self._set_lines_animated() or self._background is None or \
+                self._background_key != self._get_background_key():
+            # The background is captured and the lines are drawn in _on_draw
+            canvas.draw()
+            self.nr_full_draws += 1
+            return
+        canvas.restore_region(self._background)
+        self._draw_lines()
+        canvas.blit(self.ax.bbox)
+        self.nr_repaints += 1
+
+
+def get_repainter(plot_object, ax_nr=0):
+    """
+    Returns the AxesRepainter for the given axes in plot_object (sharkpylib.plot.plot_selector.Plot).
+    :param plot_object:
+    :param ax_nr:
+    :return: AxesRepainter
+    """
+    ax = plot_object.fig.axes[ax_nr]
+    repainter = _repainters.get(ax)
+    if repainter is None:
+        repainter = AxesRepainter(ax)
+        _repainters[ax] = repainter
+    return repainter
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright (c) 2018 SMHI, Swedish Meteorological and Hydrological Institute
+# License: MIT License (see LICENSE.txt or http://opensource.org/licenses/mit).
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RedrawScheduler(object):
+    """
+    Coalesces redraw requests. A request marks a view (key) as dirty. All dirty views are rendered once when Tk is
+    idle (after_idle), so many requests for the same view within one tick (e.g. when typing in an axis widget or
+    zooming) give a single redraw.
+    Nothing is rendered while is_locked() is True. The dirty views are kept and rendered by resume().
+    """
+    def __init__(self, widget, is_locked=None):
+        """
+        :param widget: tk widget used for after_idle
+        :param is_locked: callable without arguments. Redraws are postponed while it returns True.
+        """
+        self.widget = widget
+        self.is_locked = is_locked
+        self._dirty = {}
+        self._after_id = None
+        self.nr_requests = 0
+        self.nr_renders = 0
+
+    @property
+    def nr_saved(self):
+        """
+        Number of redraws that has been avoided by coalescing.
+        """
+        return self.nr_requests - self.nr_renders - len(self._dirty)
+
+    def request(self, key, function):
+        """
+        Marks key as dirty. function is called (once) the next time Tk is idle.
+        If the same key is requested again before that, the latest function is used.
+        :param key: hashable, e.g. (page, 'map_1')
+        :param function: callable without arguments
+        :return:
+        """
+        self.nr_requests += 1
+        # Keep the order of the first request
+        self._dirty[key] = function
+        if self._after_id is None:
+            self._after_id = self.widget.after_idle(self.flush)
+
+    def is_dirty(self, key):
+        return key in self._dirty
+
+    def cancel(self, key):
+        self._dirty.pop(key, None)
+
+    def flush(self):
+        """
+        Renders all dirty views now.
+        :return:
+        """
+        self._after_id = None
+        if self.is_locked and self.is_locked():
+            return
+        while self._dirty:
+            key = next(iter(self._dirty))
+            function = self._dirty.pop(key)
+            self.nr_renders += 1
+            try:
+                function()
+            except Exception:
+                logger.exception(f'Redraw of {key} failed')
+
+    def resume(self):
+        """
+        Renders the views requested while locked. Call when the lock is released.
+        :return:
+        """
+        if self._dirty and self._after_id is None:
+            self._after_id = self.widget.after_idle(self.flush)
+
+    def get_counters(self):
+        return dict(requests=self.nr_requests,
+                    renders=self.nr_renders,
+                    saved=self.nr_saved)
+
+    def reset_counters(self):
+        # Requests still waiting for the next flush are counted again
+        self.nr_requests = len(self._dirty)
+        self.nr_renders = 0
+
+
+class Throttle(object):
+    """
+    Limits how often a function is called, e.g. on mouse move. Calls within interval are collapsed into one call
+    with the latest arguments, made when the interval has passed. Calls made while is_locked() is True are dropped.
+    """
+    def __init__(self, widget, function, interval=16, is_locked=None):
+        """
+        :param widget: tk widget used for after
+        :param function:
+        :param interval: minimum time between calls in milliseconds. 16 ms is about the refresh rate of a display.
+        :param is_locked: callable without arguments
+        """
+        self.widget = widget
+        self.function = function
+        self.interval = interval
+        self.is_locked = is_locked
+        self._after_id = None
+        self._args = None
+        self.nr_requests = 0
+        self.nr_calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.nr_requests += 1
+        self._args = (args, kwargs)
+        if self._after_id is None:
+            self._after_id = self.widget.after(self.interval, self._run)
+
+    def _run(self):
+        self._after_id = None
+        if self._args is None:
+            return
+        args, kwargs = self._args
+        self._args = None
+        if self.is_locked and self.is_locked():
+            return
+        self.nr_calls += 1
+        try:
+            self.function(*args, **kwargs)
+        except Exception:
+            logger.exception(f'Throttled call to {self.function} failed')
+
+    def cancel(self):
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+        self._after_id = None
+        self._args = None
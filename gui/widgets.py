@@ -17,6 +17,7 @@ import pandas as pd
 #import shutil
 
 from sharkpylib import loglib
+from plugins.SHARKtools_qc_sensors import engine
 from plugins.SHARKtools_qc_sensors import gui
 import gui.widgets as main_gui_widgets
 
@@ -24,6 +25,7 @@ import sharkpylib.tklib.tkinter_widgets as tkw
 import sharkpylib.tklib.tkmap as tkmap
 
 logger = loglib.get_logger(name='gismo_gui')
+tracer = engine.get_tracer(__name__)
 
 
 class RangeSelectorFloatWidget(ttk.Labelframe):
@@ -797,7 +799,7 @@ class AxisSettingsTimeWidget(AxisSettingsBaseWidget):
         # print(time_from, type(time_from))
         # print(time_to, type(time_to))
         if time_to < time_from:
-            print('time_to < time_from')
+            tracer.debug('time_to_before_time_from', time_from=time_from, time_to=time_to)
             self.time_widget_to.set_time(datetime_object=time_from)
 
         if self.callback:
@@ -836,6 +838,11 @@ class AxisSettingsTimeWidget(AxisSettingsBaseWidget):
 
 
 class CompareWidget(tk.Frame):
+    """
+    Limits used to match the main file with the reference file. Each reference row is matched with the row in the
+    main file that is closest in time within the limits, see engine.matching.find_matching_rows.
+    Distance is given in meters.
+    """
     def __init__(self, 
                  parent,
                  parent_app=None,
@@ -1027,6 +1034,7 @@ class FilterPopup(object):
                                                     user=self.user,
                                                     # parent_app=None,
                                                     session=self.session,
+                                                    catalog=self.parent_app.file_catalog,
                                                     callback=None,
                                                     prop_frame={},
                                                     padx=padx,
@@ -1084,7 +1092,7 @@ class FilterPopup(object):
 
 
         if filter_dict == old_filter:
-            print('Unchanged filter. Will not save filter to user!')
+            tracer.debug('filter_unchanged')
             self._exit()
         else:
             # Save to user
@@ -1212,7 +1220,7 @@ class QCroutineOptionsPopup(object):
                 # Saved in different user settings
                 self.user.directory.set('save_directory_qc', value)
                 # self.user.qc_routine_options.set(self.qc_routine, key, value)
-            print(self.qc_routine, '=>', key, '=>', value)
+            tracer.trace('save_qc_option', qc_routine=self.qc_routine, key=key, value=value)
             self.user.qc_routine_options.set(self.qc_routine, key, value)
 
     def _exit(self, event=None, **kwargs):
@@ -1302,11 +1310,16 @@ class FilterWidgetTable(tk.Frame):
 
         tkw.grid_configure(self, nr_rows=2, nr_columns=3, r0=10)
 
+    def _get_catalog(self):
+        catalog = self.parent_app.file_catalog
+        catalog.update(self.session)
+        return catalog
+
     def _filter_data(self):
         if self.filter_popup:
             self.filter_popup.display()
             return
-        if not self.session.get_filtered_file_id_list(startswith=self.file_id_startswith):
+        if not self._get_catalog().get_file_id_list(startswith=self.file_id_startswith):
             main_gui_widgets.show_information('No files loaded', 'No files loaded for this sampling type.')
             return
         self.filter_popup = FilterPopup(self,
@@ -1342,31 +1355,20 @@ class FilterWidgetTable(tk.Frame):
         #         except:
         #             pass
 
-        filtered_file_id_list = self.session.get_filtered_file_id_list(**user_filter)
+        catalog = self._get_catalog()
+        filtered_file_id_list = catalog.get_filtered_file_id_list(session=self.session, **user_filter)
         # print('filtered_file_id_list'.upper(), filtered_file_id_list)
 
         if not filtered_file_id_list:
             self.filter_popup = None
             return
-        data = []
-        for file_id in filtered_file_id_list:
-            data_line = []
-            # File id
-            data_line.append(file_id)
-            gismo_object = self.session.get_gismo_object(file_id)
-            # Station name
-            data_line.append(gismo_object.get_station_name())
-            # Time
-            t = pd.to_datetime(str(gismo_object.get_time()[0]))
-            data_line.append(t.strftime('%Y-%m-%d %H:%M'))
-            data.append(data_line)
 
-        self.table_widget.set_table(data)
+        self.table_widget.set_table(catalog.get_table_data(filtered_file_id_list))
 
         self.filter_popup = None
 
-        # Check if filter is set
-        if sorted(self.session.get_filtered_file_id_list(startswith=self.file_id_startswith)) == sorted(filtered_file_id_list):
+        # Check if filter is set. The filtered files are always a subset of all files.
+        if len(catalog.get_file_id_list(startswith=self.file_id_startswith)) == len(filtered_file_id_list):
             # self.button_filter_data.config(bg='green')
             self.stringvar_info.set('Filter is not set')
             self.label_info.config(bg=self.bg_color)
@@ -1407,6 +1409,7 @@ class FilterWidgetSelection(tk.Frame):
                  user=None,
                  # parent_app=None,
                  session=None,
+                 catalog=None,
                  callback=None,
                  prop_frame={},
                  **kwargs):
@@ -1414,6 +1417,7 @@ class FilterWidgetSelection(tk.Frame):
         self.prop_frame.update(prop_frame)
         # self.parent_app = parent_app
         self.session = session
+        self.catalog = catalog
         self.user = user
         self.callback = callback
 
@@ -1511,7 +1515,11 @@ class FilterWidgetSelection(tk.Frame):
         self.map_widget.zoom(**self.user.filter.get_settings())
 
     def _add_data_to_station_widgets(self):
-        station_list = self.session.get_station_list()
+        if self.catalog is not None:
+            self.catalog.update(self.session)
+            station_list = self.catalog.get_station_list()
+        else:
+            station_list = self.session.get_station_list()
 
         # Add stations
         self.station_widget.update_items(station_list)
@@ -1521,14 +1529,27 @@ class FilterWidgetSelection(tk.Frame):
         if user_station_list:
             self.station_widget.move_items_to_selected(user_station_list)
 
+    def _get_time_extent(self):
+        if self.catalog is not None:
+            self.catalog.update(self.session)
+            return self.catalog.get_time_extent()
+        time_first = []
+        time_last = []
+        for file_id in self.session.get_file_id_list():
+            extent = engine.get_time_extent(self.session.get_gismo_object(file_id))
+            time_first.append(extent[0])
+            time_last.append(extent[1])
+        return pd.to_datetime(time_first).min(), pd.to_datetime(time_last).max()
+
     def _add_data_to_time_widgets(self):
         file_id_list = self.session.get_file_id_list()
         if not file_id_list:
             return
 
-        time_list = []
-        for file_id in file_id_list:
-            time_list.extend(self.session.get_gismo_object(file_id).get_time())
+        # Only the first and last time is needed to set the valid time span
+        time_list = [t.to_pydatetime() for t in self._get_time_extent() if not pd.isnull(t)]
+        if not time_list:
+            return
 
         self.from_time_widget.set_valid_time_span_from_list(time_list)
         self.to_time_widget.set_valid_time_span_from_list(time_list)
@@ -1703,9 +1724,8 @@ class QCroutineOptionsWidget(tk.Frame):
     def get_options(self):
         options_dict = {}
         for key in sorted(self.options):
-            print('KEY =>', key)
             options_dict[key] = self.widgets[key].get_value()
-        print('options_dict', options_dict)
+        tracer.trace('qc_options', options=options_dict)
         return options_dict
 
 